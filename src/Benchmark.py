@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+
+'''
+Benchmark harness for the map editor hot paths.
+
+Runs GenerateGraph, CheckEdgeLocation, FindIntersections, DeleteSelection,
+LoadNodes/LoadEdges, SaveGraph, FindImageLimit, TourPlanner, the image export, panning
+over a graph and the ROSNode map conversion against the bundled maps and against synthetic
+OccupancyGrid messages. Every case runs in its own process so that the recorded
+peak memory belongs to that case only.
+
+Usage:
+    python Benchmark.py [-o bench.json] [-r 3] [-s 1234] [-c case,case] [-m map,map]
+                        [--sampler uniform|halton|sobol|free|gaussian|bridge]
+    python Benchmark.py --compare old.json new.json [--threshold 1.10]
+
+The results file is JSON and can be compared between runs with --compare.
+wxPython needs a display: on a headless machine run under xvfb-run.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import MapIO
+from optparse import OptionParser
+
+SRC_DIR     = os.path.dirname(os.path.abspath(__file__))
+MAP_DIR     = os.path.join(SRC_DIR, '..', 'maps')
+MAPS        = ['map2.png', 'map1b.png', 'willow_full.png']
+GRID_SIZES  = ['512', '1024', '2048', '8000x1500']
+GG_CONST    = {'n':100, 'k':5, 'd':20, 'w':8, 'e':80, 'sampler':'uniform', 'seed':None}
+NUM_EDGE_CHECKS = 2000
+NODE_MARGIN = 20
+TOUR_TIME_BUDGET = 2.0
+PAN_STEPS   = 40
+PAN_STEP    = 100           # pixels
+PAN_ZOOM    = 4.0
+
+#---------------------------------------------------------------------------------------------#
+#    Synthetic OccupancyGrid message, used when nav_msgs is not importable                    #
+#---------------------------------------------------------------------------------------------#
+class _Struct(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def MakeOccupancyGrid(width, seed, height=None):
+    '''
+    Builds an OccupancyGrid (square unless a height is given): unknown border, free
+    interior and a seeded set of rectangular obstacles.
+    '''
+    if height is None:
+        height = width
+    rs = np.random.RandomState(seed)
+    grid = np.empty((height, width), dtype=np.int8)
+    grid[:] = -1
+    bx, by = width/8, height/8
+    grid[by:height-by, bx:width-bx] = 0
+    size = min(width, height)
+    for i in range(max(width, height)/16):
+        x = rs.randint(bx, width-bx)
+        y = rs.randint(by, height-by)
+        w, h = rs.randint(2, size/20+3, size=2)
+        grid[y:y+h, x:x+w] = 100
+    data = grid.ravel().tolist()
+
+    try:
+        from nav_msgs.msg import OccupancyGrid                  #@UnresolvedImport
+        msg = OccupancyGrid()
+        msg.data = data
+        msg.info.width = width
+        msg.info.height = height
+        msg.info.resolution = 0.05
+        return msg
+    except ImportError:
+        position = _Struct(x=0.0, y=0.0, z=0.0)
+        orientation = _Struct(x=0.0, y=0.0, z=0.0, w=1.0)
+        origin = _Struct(position=position, orientation=orientation)
+        info = _Struct(width=width, height=height, resolution=0.05, origin=origin)
+        return _Struct(data=data, info=info)
+
+#---------------------------------------------------------------------------------------------#
+#    Wraps instance methods so that the number of calls made during a case can be recorded    #
+#---------------------------------------------------------------------------------------------#
+class CallCounter(object):
+    def __init__(self):
+        self.counts = {}
+        self.patched = []
+
+    def Watch(self, obj, names, prefix=''):
+        for name in names:
+            fn = getattr(obj, name)
+            key = prefix + name
+            self.counts.setdefault(key, 0)
+            obj.__dict__[name] = self._Wrap(fn, key)
+            self.patched.append((obj, name))
+
+    def _Wrap(self, fn, key):
+        counts = self.counts
+        def wrapper(*args, **kwargs):
+            counts[key] += 1
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def Reset(self):
+        for key in self.counts:
+            self.counts[key] = 0
+
+    def Release(self):
+        for obj, name in self.patched:
+            del obj.__dict__[name]
+        self.patched = []
+
+#---------------------------------------------------------------------------------------------#
+#    Records modal dialogs instead of showing them, so that a timed-out GenerateGraph does    #
+#    not block a headless run.                                                                #
+#---------------------------------------------------------------------------------------------#
+class _DialogRecorder(object):
+    shown = 0
+    def __init__(self, *args, **kwargs):
+        pass
+    def ShowModal(self):
+        _DialogRecorder.shown += 1
+        return 0
+    def Destroy(self):
+        pass
+
+#---------------------------------------------------------------------------------------------#
+#    Minimal host window for a MapFrame. It provides the attributes that MapFrame and         #
+#    ROSNode expect from MainPanel/MainFrame, without the control panel or a ROS connection.  #
+#---------------------------------------------------------------------------------------------#
+def CreateHost():
+    import wx
+    import MapFrame
+
+    class BenchPanel(wx.Panel):
+        def __init__(self, parent):
+            wx.Panel.__init__(self, parent)
+            self.gg_const = dict(GG_CONST)
+            self.ros = None
+            self.saved = True
+            self.buttons = []
+            self.btn_exit = wx.Button(self)
+            self.btn_rf = wx.Button(self)
+            self.mframe = None
+        def SetSaveStatus(self, bool_save):
+            self.saved = bool_save
+
+    app = wx.App(False)
+    frame = wx.Frame(None)
+    panel = BenchPanel(frame)
+    frame.mp = panel
+    MapFrame.wx.MessageDialog = _DialogRecorder
+    mframe = MapFrame.MapFrame(panel, title="Benchmark", size=(800,800))
+    panel.mframe = mframe
+    mframe.SetModes('Benchmark', {'verbose':False})
+    return app, frame, mframe
+
+class Bench(object):
+    def __init__(self, case, map_name, seed, repeat, sampler):
+        self.case = case
+        self.map_name = map_name
+        self.seed = seed
+        self.repeat = repeat
+        self.walls = []
+        self.counts = {}
+        self.app, self.frame, self.mf = CreateHost()
+        self.mf.gg_const['sampler'] = sampler
+        # Measured draws include the whole frame, not only its first slice
+        self.mf.Canvas.SliceObjects = sys.maxint
+        self.counter = CallCounter()
+        self.counter.Watch(self.mf, ['CreateNode', 'CreateEdges', 'CheckNodeLocation',
+                                     'CheckEdgeLocation', 'FindIntersections',
+                                     'ConnectNeighbors', 'ConnectNodes', 'AddEdge',
+                                     'CheckEdgeLocations', 'DeleteSelection', 'SelectOneNode',
+                                     'SelectOneEdge', 'DeselectAll'])
+        self.counter.Watch(self.mf.Canvas, ['Draw', 'AddObject', 'RemoveObject'], 'Canvas.')
+
+    def Seed(self):
+        random.seed(self.seed)
+        np.random.seed(self.seed)
+
+    def Measure(self, fn, *args):
+        self.counter.Reset()
+        st = time.time()
+        result = fn(*args)
+        self.walls.append(time.time()-st)
+        for key, val in self.counter.counts.iteritems():
+            self.counts[key] = max(val, self.counts.get(key, 0))
+        return result
+
+    def MapPath(self):
+        return os.path.join(MAP_DIR, self.map_name)
+
+    def LoadMap(self, with_graph):
+        mf = self.mf
+        mf.ClearGraph()
+        graph_filename = MapIO.GraphFilename(self.MapPath())
+        if with_graph and os.path.exists(graph_filename):
+            f = open(graph_filename, "r")
+            mf.ImportGraph(f)
+            f.close()
+        else:
+            mf.ImportGraph(None)
+        mf.SetImage(self.MapPath())
+
+    def Generate(self):
+        self.Seed()
+        g = self.mf.gg_const
+        g['seed'] = self.seed
+        self.mf.GenerateGraph(g['n'], g['k'], g['d'], g['w'], g['e'])
+
+#---------------------------------------------------------------------------------------------#
+#    Benchmark cases. Each one does its own setup and calls Measure() around the operation.   #
+#---------------------------------------------------------------------------------------------#
+def CaseSetImage(b):
+    b.mf.ClearGraph()
+    b.mf.ImportGraph(None)
+    b.Measure(b.mf.SetImage, b.MapPath())
+
+def CaseOpenMapServer(b):
+    b.LoadMap(False)
+    filename = b.mf.ExportMap(os.path.join(tempfile.mkdtemp(), 'map.yaml'))
+    b.mf.ClearGraph()
+    b.mf.ImportGraph(None)
+    b.Measure(b.mf.SetImage, filename)
+    b.counts['cells'] = b.mf.image_width*b.mf.image_height
+
+def CaseLoadGraph(b):
+    graph_filename = MapIO.GraphFilename(b.MapPath())
+    if not os.path.exists(graph_filename):
+        raise _Skip("no graph file for %s" % b.map_name)
+    b.LoadMap(False)
+    f = open(graph_filename, "r")
+    b.mf.ImportGraph(f)
+    f.close()
+    def load():
+        b.mf.LoadNodes()
+        b.mf.LoadEdges()
+        b.mf.GenerateConnectionMatrix()
+    b.Measure(load)
+    b.counts['nodes'] = len(b.mf.nodelist)
+    b.counts['edges'] = len(b.mf.edgelist)
+
+def CaseFindImageLimit(b):
+    b.LoadMap(False)
+    b.Measure(b.mf.FindImageLimit)
+
+def CaseGenerateGraph(b):
+    b.LoadMap(False)
+    _DialogRecorder.shown = 0
+    b.Measure(b.Generate)
+    b.counts['nodes'] = len(b.mf.nodelist)
+    b.counts['edges'] = len(b.mf.edgelist)
+    b.counts['timeouts'] = _DialogRecorder.shown
+
+def CaseCheckEdgeLocation(b):
+    b.LoadMap(False)
+    lim = b.mf.FindImageLimit()
+    b.Seed()
+    pts = []
+    for i in range(NUM_EDGE_CHECKS):
+        p1 = (random.randint(lim[2], lim[3]-1), random.randint(lim[0], lim[1]-1))
+        p2 = (p1[0]+random.randint(-80,80), p1[1]+random.randint(-80,80))
+        pts.append((p1, p2))
+    data = b.mf.image_data
+    lo = NODE_MARGIN
+    hi_x = b.mf.image_width-NODE_MARGIN
+    hi_y = b.mf.image_height-NODE_MARGIN
+    pts = [p for p in pts if min(p[0]+p[1]) > lo and 
+           max(p[0][0], p[1][0]) < hi_x and max(p[0][1], p[1][1]) < hi_y]
+    def check():
+        passed = 0
+        for p1, p2 in pts:
+            if b.mf.CheckEdgeLocation(data, p1, p2, 1):
+                passed += 1
+        return passed
+    passed = b.Measure(check)
+    b.counts['passed'] = passed
+
+def CaseFindIntersections(b):
+    b.LoadMap(False)
+    b.Generate()
+    def find():
+        for edge in b.mf.edgelist:
+            b.mf.FindIntersections(edge)
+    b.Measure(find)
+    b.counts['edges'] = len(b.mf.edgelist)
+
+def CaseDeleteSelection(b):
+    b.LoadMap(False)
+    b.Generate()
+    b.Seed()
+    mf = b.mf
+    mf.SetModes('BenchDelete', {'redraw':False})
+    mf.DeselectAll(None)
+    for node in random.sample(mf.nodelist, len(mf.nodelist)/2):
+        mf.SelectOneNode(mf.graphics_nodes[node.id], False)
+    mf.RestoreModes('BenchDelete')
+    b.counts['selected'] = len(mf.sel_nodes)
+    b.Measure(mf.DeleteSelection, None)
+
+def CaseSaveGraph(b):
+    b.LoadMap(False)
+    b.Generate()
+    b.Seed()
+    mf = b.mf
+    # A full snapshot first, opened again as from the File menu, then a small edit: saving
+    # it only appends to the log
+    graph_filename = os.path.join(tempfile.mkdtemp(), 'map.graph')
+    mf.SaveGraph(graph_filename)
+    mf.ClearGraph()
+    mf.OpenGraph(graph_filename)
+    mf.SetImage(b.MapPath())
+    mf.SetModes('BenchSave', {'redraw':False})
+    mf.DeselectAll(None)
+    for node in random.sample(mf.nodelist, min(5, len(mf.nodelist))):
+        mf.SelectOneNode(mf.graphics_nodes[node.id], False)
+    mf.DeleteSelection(None)
+    mf.RestoreModes('BenchSave')
+    b.counts['nodes'] = len(mf.nodelist)
+    b.counts['records'] = len(mf.edit_log.pending)
+    b.Measure(mf.SaveGraph, mf.edit_log.graph_filename)
+
+def CaseExportImage(b):
+    import ExportRenderer
+    b.LoadMap(False)
+    b.Generate()
+    filename = os.path.join(tempfile.mkdtemp(), 'export.png')
+    size = b.Measure(ExportRenderer.Export, filename, b.mf.GetExportScene(), 2.0)
+    b.counts['pixels'] = size[0]*size[1]
+
+def CasePlanTour(b):
+    import TourPlanner
+    graph_filename = "%sgraph" % b.MapPath().rstrip("png")
+    if not os.path.exists(graph_filename):
+        raise _Skip("no graph file for %s" % b.map_name)
+    b.LoadMap(True)
+    def plan():
+        b.mf.planner = None
+        return TourPlanner.PlanTour(b.mf.GetRoutePlanner(), 0, TOUR_TIME_BUDGET)
+    tour = b.Measure(plan)
+    b.counts['nodes'] = len(tour['visits'])
+    b.counts['steps'] = len(tour['route'])-1
+    b.counts['unreachable'] = len(tour['unreachable'])
+    b.counts['cost'] = round(tour['cost'], 3)
+    b.counts['initial_cost'] = round(tour['initial_cost'], 3)
+
+def CaseDrawRoute(b):
+    import TourPlanner
+    graph_filename = "%sgraph" % b.MapPath().rstrip("png")
+    if not os.path.exists(graph_filename):
+        raise _Skip("no graph file for %s" % b.map_name)
+    b.LoadMap(True)
+    route = TourPlanner.PlanTour(b.mf.GetRoutePlanner(), 0, TOUR_TIME_BUDGET)['route']
+    b.Measure(b.mf.DrawRoute, route, True, True)
+    b.counts['steps'] = len(route)-1
+
+def CasePanGraph(b):
+    b.LoadMap(False)
+    b.Generate()
+    mf = b.mf
+    mf.Canvas.Zoom(PAN_ZOOM)
+    mf.Canvas.Draw(True)
+    live = []
+    def pan():
+        for i in range(PAN_STEPS):
+            mf.Canvas.MoveImage((PAN_STEP, 0), 'Pixel')
+            live.append(len(mf.node_layer.Live) + len(mf.edge_layer.Live))
+    b.Measure(pan)
+    b.counts['nodes'] = len(mf.nodelist)
+    b.counts['edges'] = len(mf.edgelist)
+    b.counts['live_objects'] = max(live)
+
+def CaseMapCB(b):
+    try:
+        import ROSNode
+    except ImportError, e:
+        raise _Skip("ROSNode unavailable (%s)" % e)
+    # Map names are "W" for a square grid or "WxH"
+    size = [int(s) for s in b.map_name.split('x')]
+    msg = MakeOccupancyGrid(size[0], b.seed, size[-1])
+    ros = ROSNode.ROSNode(b.frame)
+    ros.SetAttributes()
+    b.mf.current_map = []
+    os.chdir(tempfile.mkdtemp())
+    b.Measure(ros.ProcessMap, msg)
+    b.counts['cells'] = len(msg.data)
+
+CASES = [
+    ('set_image',           CaseSetImage,           MAPS),
+    ('open_map_server',     CaseOpenMapServer,      MAPS),
+    ('load_graph',          CaseLoadGraph,          MAPS),
+    ('find_image_limit',    CaseFindImageLimit,     MAPS),
+    ('generate_graph',      CaseGenerateGraph,      MAPS),
+    ('check_edge_location', CaseCheckEdgeLocation,  MAPS),
+    ('find_intersections',  CaseFindIntersections,  MAPS),
+    ('delete_selection',    CaseDeleteSelection,    MAPS),
+    ('save_graph',          CaseSaveGraph,          MAPS),
+    ('export_image',        CaseExportImage,        MAPS),
+    ('plan_tour',           CasePlanTour,           MAPS),
+    ('draw_route',          CaseDrawRoute,          MAPS),
+    ('pan_graph',           CasePanGraph,           MAPS),
+    ('map_cb',              CaseMapCB,              GRID_SIZES),
+]
+
+class _Skip(Exception):
+    pass
+
+#---------------------------------------------------------------------------------------------#
+#    Runs one case in the current process and writes its result as JSON on stdout             #
+#---------------------------------------------------------------------------------------------#
+def RunCase(case, map_name, seed, repeat, sampler):
+    result = {'case':case, 'map':map_name, 'seed':seed, 'repeat':repeat, 'sampler':sampler}
+    fn = dict((c[0], c[1]) for c in CASES)[case]
+    try:
+        b = Bench(case, map_name, seed, repeat, sampler)
+        for i in range(repeat):
+            fn(b)
+        result['status'] = 'ok'
+        result['wall_s'] = b.walls
+        result['wall_min'] = min(b.walls)
+        result['wall_median'] = float(np.median(b.walls))
+        result['counts'] = b.counts
+    except _Skip, e:
+        result['status'] = 'skipped'
+        result['reason'] = str(e)
+    except Exception, e:
+        result['status'] = 'error'
+        result['reason'] = "%s: %s" % (type(e).__name__, e)
+    # ru_maxrss is reported in kilobytes on Linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sys.stdout.write("\n__RESULT__%s\n" % json.dumps(result))
+    sys.stdout.flush()
+
+def RunAll(options):
+    selected = options.cases.split(',') if options.cases else None
+    maps = options.maps.split(',') if options.maps else None
+    results = []
+    for case, fn, targets in CASES:
+        if selected and case not in selected:
+            continue
+        for target in targets:
+            if maps and target in MAPS and target not in maps:
+                continue
+            cmd = [sys.executable, os.path.abspath(__file__), '--run-case', case,
+                   '--map', target, '--seed', str(options.seed), '--repeat', str(options.repeat),
+                   '--sampler', options.sampler]
+            out = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=SRC_DIR).communicate()[0]
+            result = None
+            for line in out.splitlines():
+                if line.startswith('__RESULT__'):
+                    result = json.loads(line[len('__RESULT__'):])
+            if result is None:
+                result = {'case':case, 'map':target, 'status':'error',
+                          'reason':'benchmark process crashed'}
+            results.append(result)
+            print "%-20s %-16s %-8s %s" % (case, target, result['status'],
+                                            result.get('wall_median', result.get('reason', '')))
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'seed': options.seed,
+            'repeat': options.repeat,
+            'sampler': options.sampler,
+        },
+        'results': results,
+    }
+    f = open(options.output, 'w')
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.close()
+    print "Wrote %s" % options.output
+
+#---------------------------------------------------------------------------------------------#
+#    Compares two result files. Returns 1 if any case got slower than the threshold allows.   #
+#---------------------------------------------------------------------------------------------#
+def Compare(old_file, new_file, threshold):
+    old = json.load(open(old_file))
+    new = json.load(open(new_file))
+    old_results = dict(((r['case'], r['map']), r) for r in old['results'])
+    regressed = False
+
+    print "%-20s %-16s %10s %10s %8s %10s" % ('case', 'map', 'old (s)', 'new (s)', 'ratio', 'rss ratio')
+    for r in new['results']:
+        key = (r['case'], r['map'])
+        o = old_results.get(key)
+        if o is None or o.get('status') != 'ok' or r.get('status') != 'ok':
+            print "%-20s %-16s %s" % (key[0], key[1], "n/a")
+            continue
+        ratio = r['wall_median'] / max(o['wall_median'], 1e-9)
+        rss = float(r['peak_rss_kb']) / max(o['peak_rss_kb'], 1)
+        flag = ''
+        if ratio > threshold:
+            flag = '  <-- slower'
+            regressed = True
+        print "%-20s %-16s %10.4f %10.4f %8.2f %10.2f%s" % (key[0], key[1], o['wall_median'],
+                                                          r['wall_median'], ratio, rss, flag)
+        for name, val in sorted(r.get('counts', {}).iteritems()):
+            if o.get('counts', {}).get(name) not in (None, val):
+                print "%40s %s: %s -> %s" % ('', name, o['counts'][name], val)
+    return 1 if regressed else 0
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-o', '--output', default='bench_output.json')
+    parser.add_option('-r', '--repeat', type='int', default=3)
+    parser.add_option('-s', '--seed', type='int', default=1234)
+    parser.add_option('-c', '--cases', default=None, help="comma-separated case names")
+    parser.add_option('-m', '--maps', default=None, help="comma-separated map file names")
+    parser.add_option('--sampler', default='uniform', help="sampler used by GenerateGraph")
+    parser.add_option('--compare', nargs=2, default=None)
+    parser.add_option('--threshold', type='float', default=1.10)
+    parser.add_option('--run-case', dest='run_case', default=None)
+    parser.add_option('--map', default=None)
+    options, args = parser.parse_args()
+
+    sys.path.insert(0, SRC_DIR)
+    if options.compare:
+        sys.exit(Compare(options.compare[0], options.compare[1], options.threshold))
+    elif options.run_case:
+        RunCase(options.run_case, options.map, options.seed, options.repeat, options.sampler)
+    else:
+        RunAll(options)
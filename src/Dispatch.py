@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+'''
+Hand-off of ROS messages from the rospy threads to the GUI thread.
+
+rospy callbacks must not call wx, and one wx.CallAfter per message lets a burst of
+messages pile up in the GUI event queue. Instead, each topic gets a slot in a Dispatcher:
+
+    - a Mailbox keeps only the latest value (amcl_pose, obstacles, /map): a newer message
+      replaces one that hasn't been handled yet
+    - a Ring keeps the last 'size' values in order (route, destination and status
+      events, where every message matters but the backlog must stay bounded)
+
+Post() only takes a lock and stores a reference, so it never blocks a rospy thread.
+A wx.Timer on the GUI thread drains every slot once per tick and calls its handler.
+
+@author: jon
+'''
+
+import wx
+import threading
+import traceback
+import Instrument
+from collections import deque
+
+DISPATCH_INTERVAL   = 50        # milliseconds between two drains
+
+class Mailbox(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+        self.full = False
+
+    def Put(self, value):
+        with self.lock:
+            if self.full:
+                Instrument.Count('msgs_coalesced')
+            self.value = value
+            self.full = True
+
+    def Take(self):
+        with self.lock:
+            if not self.full:
+                return []
+            value = self.value
+            self.value = None
+            self.full = False
+        return [value]
+
+class Ring(object):
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.items = deque(maxlen=size)
+
+    def Put(self, value):
+        with self.lock:
+            if len(self.items) == self.items.maxlen:
+                Instrument.Count('msgs_dropped')
+            self.items.append(value)
+
+    def Take(self):
+        with self.lock:
+            items = list(self.items)
+            self.items.clear()
+        return items
+
+#---------------------------------------------------------------------------------------------#
+#    Set of named slots drained by a timer owned by a wx window. Slots are drained in the     #
+#    order they were registered.                                                              #
+#---------------------------------------------------------------------------------------------#
+class Dispatcher(object):
+    def __init__(self, owner, interval=DISPATCH_INTERVAL):
+        self.slots = []
+        self.by_name = {}
+        self.timer = wx.Timer(owner)
+        owner.Bind(wx.EVT_TIMER, self.OnTimer, self.timer)
+        self.interval = interval
+
+    def Register(self, name, handler, size=None):
+        if size is None:
+            slot = Mailbox()
+        else:
+            slot = Ring(size)
+        self.slots.append((name, slot, handler))
+        self.by_name[name] = slot
+
+    # Can be called from any thread
+    def Post(self, name, value):
+        self.by_name[name].Put(value)
+
+    def Start(self):
+        self.timer.Start(self.interval)
+
+    def Stop(self):
+        self.timer.Stop()
+
+    def OnTimer(self, event):
+        self.Drain()
+
+    # A handler that raises is reported, and the other values are still handled
+    def Drain(self):
+        for name, slot, handler in self.slots:
+            for value in slot.Take():
+                try:
+                    handler(value)
+                except Exception:
+                    Instrument.Count('msgs_failed')
+                    print "Error while handling a '%s' message:" % name
+                    traceback.print_exc()
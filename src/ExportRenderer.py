@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+'''
+Offscreen rendering of the map and its graph to a PNG image, at any scale.
+
+The live canvas is not used: the image is rasterized from the map data and the node and
+edge coordinates with numpy, STRIP_ROWS rows at a time, and each strip is compressed into
+the PNG file as soon as it is done. Memory use depends on the width of the image and not
+on its height, so a 4000x4000 map can be exported at 2x (or more) without holding the whole
+image. Nothing here touches wx, so Export() can run as a background job:
+
+    scene = mframe.GetExportScene()
+    job = QueueThread.Job(ExportRenderer.Export, (filename, scene, 2.0), cancellable=True)
+
+A Scene holds everything the renderer needs, copied from the editor: the map cells (with
+the bottom row first, as on the canvas) and a color table for them, the node and edge
+coordinates in map pixels, and the Style (colors and sizes) of the canvas.
+
+@author: jon
+'''
+
+import os
+import zlib
+import struct
+import numpy as np
+import Image, ImageDraw, ImageFont
+import Instrument
+
+STRIP_ROWS      = 256               # image rows rendered at a time
+PNG_COMPRESSION = 6                 # zlib level
+FONT_FILES      = ('DejaVuSans-Bold.ttf', 'FreeSansBold.ttf', 'Arial Bold.ttf')
+
+class Style(object):
+    def __init__(self, node_fill, node_border, edge_color, text_color, node_diam,
+                 node_border_width, edge_width, font_sizes):
+        self.node_fill = node_fill
+        self.node_border = node_border
+        self.edge_color = edge_color
+        self.text_color = text_color
+        self.node_diam = node_diam                      # map pixels
+        self.node_border_width = node_border_width      # image pixels at scale 1
+        self.edge_width = edge_width                    # image pixels at scale 1
+        self.font_sizes = font_sizes                    # (ids < 100, ids >= 100), map pixels
+
+#---------------------------------------------------------------------------------------------#
+#    cells: (height, width) array of map values, bottom row first; colors: (N, 3) uint8 table #
+#    indexed by the cell values; nodes: (n, 2) coordinates; edges: (m, 2) node indices.       #
+#---------------------------------------------------------------------------------------------#
+class Scene(object):
+    def __init__(self, cells, colors, nodes, edges, style):
+        self.cells = cells
+        self.colors = colors
+        self.nodes = np.asarray(nodes, dtype=float).reshape(-1, 2)
+        self.edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+        self.style = style
+
+    @property
+    def height(self):
+        return self.cells.shape[0]
+
+    @property
+    def width(self):
+        return self.cells.shape[1]
+
+#---------------------------------------------------------------------------------------------#
+#    Renders a scene at the given scale (image pixels per map pixel) and writes it as a PNG.  #
+#    The file is written under a temporary name and renamed when it is complete. Returns the  #
+#    size of the image.                                                                       #
+#---------------------------------------------------------------------------------------------#
+def Export(filename, scene, scale, token=None):
+    span = Instrument.Span('ExportImage')
+    width = int(round(scene.width*scale))
+    height = int(round(scene.height*scale))
+    renderer = Renderer(scene, scale)
+
+    tmp_filename = filename + ".tmp"
+    f = open(tmp_filename, 'wb')
+    try:
+        try:
+            png = PNGWriter(f, width, height)
+            for y0 in range(0, height, STRIP_ROWS):
+                if token is not None:
+                    token.Check()
+                png.Write(renderer.Strip(y0, min(y0+STRIP_ROWS, height)))
+            png.Close()
+        finally:
+            f.close()
+        if token is not None:
+            token.Check()
+    except Exception:
+        # Cancelled (e.g. by a newer export) or failed: no partial file is left behind
+        os.remove(tmp_filename)
+        raise
+    os.rename(tmp_filename, filename)
+    span.Stop()
+    return width, height
+
+#---------------------------------------------------------------------------------------------#
+#    Rasterizes horizontal strips of a scene. Image row 0 is the top of the map. Nodes and    #
+#    edges are converted to image coordinates once, and each strip only draws those whose     #
+#    bounding box crosses it.                                                                 #
+#---------------------------------------------------------------------------------------------#
+class Renderer(object):
+    def __init__(self, scene, scale):
+        self.scene = scene
+        self.scale = float(scale)
+        self.width = int(round(scene.width*scale))
+        self.height = int(round(scene.height*scale))
+        style = scene.style
+
+        # Map cell of each image column, and map row (bottom first) of each image row
+        cols = (np.arange(self.width) + 0.5) / scale
+        rows = (np.arange(self.height) + 0.5) / scale
+        self.cols = np.minimum(cols, scene.width-1).astype(int)
+        self.rows = scene.height-1 - np.minimum(rows, scene.height-1).astype(int)
+
+        # Node coordinates in the image (y down). As on the canvas, map pixel (x, y) covers
+        # [x, x+1) x [y, y+1), so a node sits on the corner of its pixel
+        nodes = scene.nodes
+        self.nodes = np.empty_like(nodes)
+        self.nodes[:, 0] = nodes[:, 0]*scale
+        self.nodes[:, 1] = (scene.height - nodes[:, 1])*scale
+        self.radius = style.node_diam*scale/2.0
+        self.border = style.node_border_width*scale
+        self.half_width = style.edge_width*scale/2.0
+
+        p1 = self.nodes[scene.edges[:, 0]]
+        p2 = self.nodes[scene.edges[:, 1]]
+        self.edge_p1 = p1
+        self.edge_p2 = p2
+        self.edge_y0 = np.minimum(p1[:, 1], p2[:, 1]) - self.half_width
+        self.edge_y1 = np.maximum(p1[:, 1], p2[:, 1]) + self.half_width
+
+        self.fonts = [LoadFont(int(round(size*scale))) for size in style.font_sizes]
+
+    def Strip(self, y0, y1):
+        scene = self.scene
+        style = scene.style
+        cells = scene.cells[self.rows[y0:y1]][:, self.cols]
+        strip = scene.colors[cells.view(np.uint8) if cells.dtype == np.int8 else cells]
+
+        edges = np.flatnonzero((self.edge_y1 >= y0) & (self.edge_y0 < y1))
+        if len(edges) > 0:
+            mask = self.Mask(self.edge_p1[edges], self.edge_p2[edges], self.half_width, y0, y1)
+            strip[mask] = style.edge_color
+
+        r = self.radius
+        ys = self.nodes[:, 1]
+        visible = np.flatnonzero((ys + r >= y0) & (ys - r < y1))
+        if len(visible) > 0:
+            centers = self.nodes[visible]
+            strip[self.Mask(centers, centers, r, y0, y1)] = style.node_border
+            inner = max(r - self.border, 0)
+            strip[self.Mask(centers, centers, inner, y0, y1)] = style.node_fill
+            strip = self.DrawLabels(strip, y0, visible, style)
+        return strip
+
+#---------------------------------------------------------------------------------------------#
+#    Returns the pixels of rows [y0,y1) whose center is within w of one of the segments       #
+#    p1[i]-p2[i] (a disc if p1[i] == p2[i]). Each shape is convex, so it covers one run of    #
+#    pixels per row: the runs are computed for all (shape, row) pairs at once and filled by a #
+#    cumulative sum, which costs the same whatever the length of the segments.                #
+#---------------------------------------------------------------------------------------------#
+    def Mask(self, p1, p2, w, y0, y1):
+        top = np.minimum(p1[:, 1], p2[:, 1]) - w
+        bottom = np.maximum(p1[:, 1], p2[:, 1]) + w
+        ra = np.maximum(np.ceil(top - 0.5), y0).astype(int)
+        rb = np.minimum(np.floor(bottom - 0.5) + 1, y1).astype(int)
+        counts = np.maximum(rb - ra, 0)
+        shape = np.repeat(np.arange(len(p1)), counts)
+        rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - ra, counts)
+        yc = rows + 0.5
+        a = p1[shape]
+        b = p2[shape]
+
+        # Horizontal extent of each shape on each row: the end caps...
+        lo = np.empty(len(rows))
+        lo[:] = np.inf
+        hi = -lo
+        for c in (a, b):
+            h2 = w*w - (yc - c[:, 1])**2
+            inside = h2 >= 0
+            half = np.sqrt(np.where(inside, h2, 0))
+            lo = np.where(inside, np.minimum(lo, c[:, 0] - half), lo)
+            hi = np.where(inside, np.maximum(hi, c[:, 0] + half), hi)
+
+        # ...and the rectangle between them
+        d = b - a
+        length = np.hypot(d[:, 0], d[:, 1])
+        n = np.zeros_like(d)
+        long_enough = length > 0
+        n[long_enough, 0] = -d[long_enough, 1] / length[long_enough] * w
+        n[long_enough, 1] = d[long_enough, 0] / length[long_enough] * w
+        corners = [a + n, b + n, b - n, a - n]
+        for k in range(4):
+            P, Q = corners[k], corners[(k+1) % 4]
+            dy = Q[:, 1] - P[:, 1]
+            cross = ((P[:, 1] - yc)*(Q[:, 1] - yc) <= 0) & (dy != 0)
+            x = P[:, 0] + (yc - P[:, 1])*(Q[:, 0] - P[:, 0]) / np.where(dy != 0, dy, 1)
+            lo = np.where(cross, np.minimum(lo, x), lo)
+            hi = np.where(cross, np.maximum(hi, x), hi)
+
+        width = self.width
+        xa = np.clip(np.ceil(lo - 0.5), 0, width).astype(int)
+        xb = np.clip(np.floor(hi - 0.5) + 1, 0, width).astype(int)
+        ok = xa < xb
+        runs = np.zeros((y1 - y0, width + 1), dtype=np.int32)
+        np.add.at(runs, (rows[ok] - y0, xa[ok]), 1)
+        np.add.at(runs, (rows[ok] - y0, xb[ok]), -1)
+        return np.cumsum(runs, axis=1)[:, :width] > 0
+
+    # Node ids, centered on the nodes. Labels that cross the edge of the strip are drawn in
+    # both strips, each clipping its own part.
+    def DrawLabels(self, strip, y0, visible, style):
+        img = Image.fromarray(strip)
+        draw = ImageDraw.Draw(img)
+        for i in visible:
+            font = self.fonts[0] if i < 100 else self.fonts[1]
+            text = str(i)
+            w, h = draw.textsize(text, font=font)
+            x, y = self.nodes[i]
+            draw.text((x - w/2.0, y - y0 - h/2.0), text, fill=style.text_color, font=font)
+        return np.asarray(img)
+
+_fonts = {}
+
+# A bold font of about 'size' pixels; PIL's built-in font if no TrueType font can be found
+def LoadFont(size):
+    size = max(size, 1)
+    if size not in _fonts:
+        font = None
+        for name in FONT_FILES:
+            try:
+                font = ImageFont.truetype(name, size)
+                break
+            except IOError:
+                pass
+        _fonts[size] = font or ImageFont.load_default()
+    return _fonts[size]
+
+#---------------------------------------------------------------------------------------------#
+#    Writes an 8-bit RGB PNG file row by row. Rows are compressed as they are written, so     #
+#    the image never has to be held in memory as a whole.                                     #
+#---------------------------------------------------------------------------------------------#
+class PNGWriter(object):
+    def __init__(self, f, width, height):
+        self.f = f
+        self.width = width
+        self.z = zlib.compressobj(PNG_COMPRESSION)
+        f.write('\x89PNG\r\n\x1a\n')
+        self.Chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    # rows: (n, width, 3) uint8 array
+    def Write(self, rows):
+        n = rows.shape[0]
+        data = np.empty((n, self.width*3 + 1), dtype=np.uint8)
+        data[:, 0] = 0                  # filter type: none
+        data[:, 1:] = rows.reshape(n, -1)
+        compressed = self.z.compress(data.tostring())
+        if compressed:
+            self.Chunk('IDAT', compressed)
+
+    def Close(self):
+        self.Chunk('IDAT', self.z.flush())
+        self.Chunk('IEND', '')
+
+    def Chunk(self, tag, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(tag)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
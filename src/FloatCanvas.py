@@ -9,14 +9,18 @@ try:
 except ImportError:
     raise ImportError("I could not import numpy")
 
-from time import clock
+from time import clock, time
 import wx
 import threading
+import Instrument
 
 from wx.lib.floatcanvas.Utilities import BBox
 import GUIMode
 
 
+## Number of objects drawn between two checks of the time, when drawing a slice of a frame
+SLICE_CHECK = 32
+
 ## A global variable to hold the Pixels per inch that wxWindows thinks is in use
 ## This is used for scaling fonts.
 ## This can't be computed on module __init__, because a wx.App might not have initialized yet.
@@ -164,8 +168,14 @@ class DrawObject:
 
       Is this still necessary?
 
+      \note A Composite object stands for other objects: the Canvas does
+      not draw it, but the objects returned by its DrawObjects(ViewPortBB)
+      method, and counts NumObjects() objects for it (see GraphLayer.py).
+
     """
 
+    Composite = False
+
     def __init__(self, InForeground  = False, IsVisible = True):
         """! \param InForeground (bool)
              \param IsVisible (Bool)
@@ -850,6 +860,119 @@ class ArrowLine(PointsObjectMixin, LineOnlyMixin, DrawObject):
                 HTdc.DrawLines(arrow)
 
 
+class ArrowLineSet(PointsObjectMixin, LineOnlyMixin, DrawObject):
+    """
+
+    ArrowLineSet(Segments, # NX2X2: start and end point of each arrow
+                 Colors, # one color per arrow, or a single color
+                 LineStyle = "Solid",
+                 LineWidth    = 1, # pixels
+                 ArrowHeadSize = 8, # pixels
+                 ArrowHeadAngle = 30, # degrees
+                 InForeground = False):
+
+    It will draw a set of separate arrows, each one from its start point
+    to its end point, with one DrawLineList call for the lines and one for
+    the heads.
+
+    Every arrow has its own color, which can be changed with SetColors
+    without re-creating the object, and arrows can be left out with
+    SetShown. The points are stored in self.Points as a 2NX2 array (start
+    and end of each arrow in turn).
+
+    """
+
+    def __init__(self,
+                 Segments,
+                 Colors,
+                 LineStyle = "Solid",
+                 LineWidth    = 1, # pixels
+                 ArrowHeadSize = 8, # pixels
+                 ArrowHeadAngle = 30, # degrees
+                 InForeground = False):
+
+        DrawObject.__init__(self, InForeground)
+
+        self.Points = N.array(Segments,N.float)
+        self.Points.shape = (-1,2)
+        self.ArrowHeadSize = ArrowHeadSize
+        self.ArrowHeadAngle = float(ArrowHeadAngle)
+
+        self.LineColor = "Black"
+        self.LineStyle = LineStyle
+        self.LineWidth = LineWidth
+        self.SetPen(self.LineColor,LineStyle,LineWidth)
+
+        n = self.Points.shape[0] / 2
+        self.Pens = [self.Pen] * n
+        self.Shown = N.ones(n, N.bool)
+        self.SetColors(Colors)
+
+        self.CalcArrowPoints()
+        self.CalcBoundingBox()
+
+        self.HitLineWidth = max(LineWidth,self.MinHitLineWidth)
+
+    def GetPen(self, Color):
+        if not isinstance(Color, basestring):
+            Color = tuple(int(c) for c in Color)
+        key = (Color, self.LineStyle, self.LineWidth)
+        Pen = self.PenList.get(key)
+        if Pen is None:
+            Pen = wx.Pen(Color, self.LineWidth, self.LineStyleList[self.LineStyle])
+            self.PenList[key] = Pen
+        return Pen
+
+    def SetColors(self, Colors, Indices = None):
+        """
+        Sets the color of the arrows given by Indices (all of them by
+        default). Colors is a single color or one color per arrow.
+        """
+        if Indices is None:
+            Indices = range(len(self.Pens))
+        if isinstance(Colors, basestring) or N.ndim(Colors) == 1:
+            Colors = [Colors] * len(Indices)
+        for i, Color in zip(Indices, Colors):
+            self.Pens[i] = self.GetPen(Color)
+
+    def SetShown(self, Shown):
+        """
+        Shown is a boolean array with one value per arrow: arrows set to
+        False are not drawn.
+        """
+        self.Shown = N.asarray(Shown, N.bool)
+
+    def CalcArrowPoints(self):
+        S = self.ArrowHeadSize
+        phi = self.ArrowHeadAngle * N.pi / 360
+        Segments = self.Points.reshape(-1,2,2)
+        d = Segments[:,0,:] - Segments[:,1,:]
+        theta = N.arctan2(d[:,1], d[:,0])
+        self.ArrowPoints = N.empty((len(theta), 2, 2), N.float)
+        self.ArrowPoints[:,0,0] = N.cos(theta - phi)
+        self.ArrowPoints[:,0,1] = -N.sin(theta - phi)
+        self.ArrowPoints[:,1,0] = N.cos(theta + phi)
+        self.ArrowPoints[:,1,1] = -N.sin(theta + phi)
+        self.ArrowPoints *= S
+
+    def _Draw(self, dc , WorldToPixel, ScaleWorldToPixel, HTdc=None):
+        Shown = N.flatnonzero(self.Shown)
+        if len(Shown) == 0:
+            return
+        Segments = WorldToPixel(self.Points).reshape(-1,2,2)[Shown]
+        Ends = Segments[:,1,:]
+        Heads = Ends[:,N.newaxis,:] + self.ArrowPoints[Shown]
+        Lines = Segments.reshape(-1,4)
+        HeadLines = N.concatenate((N.hstack((Heads[:,0,:], Ends)),
+                                   N.hstack((Ends, Heads[:,1,:]))))
+        Pens = [self.Pens[i] for i in Shown]
+        dc.DrawLineList(Lines, Pens)
+        dc.DrawLineList(HeadLines, Pens + Pens)
+        if HTdc and self.HitAble:
+            HTdc.DrawLineList(Lines, self.HitPen)
+            HTdc.DrawLineList(HeadLines, self.HitPen)
+
+
 class PointSet(PointsObjectMixin, ColorOnlyMixin, DrawObject):
     """
 
@@ -2125,10 +2248,14 @@ class DotGrid:
 
         return Points
 
-    def _Draw(self, dc, Canvas):
+    def _Draw(self, dc, Canvas, WorldToPixel=None):
+        # GridUnder is drawn in the buffer; GridOver is drawn on the screen, and
+        # is given Canvas.WorldToPixel
+        if WorldToPixel is None:
+            WorldToPixel = Canvas.WorldToBuffer
         Points = self.CalcPoints(Canvas)
 
-        Points = Canvas.WorldToPixel(Points)
+        Points = WorldToPixel(Points)
 
         dc.SetPen(wx.Pen(self.Color,self.CrossThickness))
 
@@ -2321,6 +2448,18 @@ class FloatCanvas(wx.Panel):
     methods implimented, and then I'd also have a full set of Object sets
     that could take advantage of them. I hope to get to it some day.
 
+    Panning:
+    The buffers are larger than the window by Overscan pixels on each side. Only
+    the part in the window is drawn by Draw(); the margins are filled in when the
+    application is idle. Moving the image by less than the margin then only
+    copies a different part of the buffers to the screen (see BlitView), and
+    everything is re-drawn only when the window leaves the buffers.
+
+    Zooming:
+    ZoomProgressive() is meant for continuous zooming (e.g. with the mouse
+    wheel): it shows a resampled copy of the last frame right away, and the
+    canvas is re-drawn once no zoom has come for ZoomDelay milliseconds.
+
     Mouse Events:
 
     At this point, there are a full set of custom mouse events. They are
@@ -2345,10 +2484,12 @@ class FloatCanvas(wx.Panel):
                  ProjectionFun = None,
                  BackgroundColor = "WHITE",
                  Debug = False,
+                 Overscan = 256,
                  **kwargs):
 
         wx.Panel.__init__( self, parent, id, wx.DefaultPosition, size, **kwargs)
 
+        self.Overscan = int(Overscan) # pixels drawn around the window on each side
         self.ComputeFontScale()
         self.InitAll()
 
@@ -2359,6 +2500,7 @@ class FloatCanvas(wx.Panel):
 
         wx.EVT_PAINT(self, self.OnPaint)
         wx.EVT_SIZE(self, self.OnSize)
+        wx.EVT_IDLE(self, self.OnIdle)
 
         wx.EVT_LEFT_DOWN(self, self.LeftDownEvent)
         wx.EVT_LEFT_UP(self, self.LeftUpEvent)
@@ -2387,6 +2529,10 @@ class FloatCanvas(wx.Panel):
         # timer to give a delay when re-sizing so that buffers aren't re-built too many times.
         self.SizeTimer = wx.PyTimer(self.OnSizeTimer)
 
+        # timer to re-draw the canvas when a progressive zoom is over
+        self.ZoomDelay = 150
+        self.ZoomTimer = wx.PyTimer(self.OnZoomTimer)
+
 #        self.InitializePanel()
 #        self.MakeNewBuffers()
 
@@ -2413,6 +2559,8 @@ class FloatCanvas(wx.Panel):
         self.UseHitTest = False
 
         self.NumBetweenBlits = 500
+        self.SliceObjects = 5000    # frames with more objects are drawn in slices, when idle
+        self.SliceTime = 0.03       # seconds of drawing per slice
 
         ## create the Hit Test Dicts:
         self.HitDict = None
@@ -2420,6 +2568,7 @@ class FloatCanvas(wx.Panel):
 
         self._DrawList = []
         self._ForeDrawList = []
+        self._Composites = []
         self.InitializePanel()
         self.MakeNewBuffers()
         self.BoundingBox = BBox.NullBBox()
@@ -2440,6 +2589,14 @@ class FloatCanvas(wx.Panel):
         self.GridOver = None
 
         self._BackgroundDirty = True
+        self._BufferCenter = None       # ViewPortCenter when the buffers were last re-drawn
+        self._BufferTransform = None
+        self._VisibleOffset = None      # BufferOffset() of the window when it was last drawn
+        self._BackgroundMarginsDirty = False
+        self._ForegroundMarginsDirty = False
+        self._ZoomFrame = None          # last frame, shown during a progressive zoom
+        self._FrameLayers = None        # layers of the frame being drawn (see _DrawSlice)
+        self._FrameObjects = None
 
     def SetProjectionFun(self, ProjectionFun):
         if ProjectionFun == 'FlatEarth':
@@ -2504,12 +2661,17 @@ class FloatCanvas(wx.Panel):
         HitTestBitmapDepth = 32
         #print "Using hit test code for 2.8"
         def GetHitTestColor(self, xy):
+            xy = self._BufferPoint(xy)
+            if xy is None:
+                return None
             if self._ForegroundHTBitmap:
                 pdata = wx.AlphaPixelData(self._ForegroundHTBitmap)
             else:
                 pdata = wx.AlphaPixelData(self._HTBitmap)
             if not pdata:
                 raise RuntimeError("Trouble Accessing Hit Test bitmap")
+            if Instrument.ENABLED:
+                Instrument.Count('hit_test_reads')
             pacc = pdata.GetPixels()
             pacc.MoveTo(pdata, xy[0], xy[1])
             return pacc.Get()[:3]
@@ -2517,6 +2679,11 @@ class FloatCanvas(wx.Panel):
         HitTestBitmapDepth = 24
         #print "using pre-2.8 hit test code"
         def GetHitTestColor(self,  xy ):
+            xy = self._BufferPoint(xy)
+            if xy is None:
+                return None
+            if Instrument.ENABLED:
+                Instrument.Count('hit_test_reads')
             dc = wx.MemoryDC()
             if self._ForegroundHTBitmap:
                 dc.SelectObject(self._ForegroundHTBitmap)
@@ -2524,6 +2691,13 @@ class FloatCanvas(wx.Panel):
                 dc.SelectObject(self._HTBitmap)
             hitcolor = dc.GetPixelPoint( xy )
             return hitcolor.Get()
+
+    def _BufferPoint(self, xy):
+        # The point of the buffers under the window pixel xy, or None if it is outside
+        x, y = N.asarray(xy) + self.BufferOffset()
+        if 0 <= x < self.BufferSize[0] and 0 <= y < self.BufferSize[1]:
+            return (int(x), int(y))
+        return None
     def UnBindAll(self):
         """
         Removes all bindings to Objects
@@ -2676,10 +2850,11 @@ class FloatCanvas(wx.Panel):
     def MakeNewBuffers(self):
         ##fixme: this looks like tortured logic!
         self._BackgroundDirty = True
+        self._FrameLayers = None # a frame being drawn in the old buffers is dropped
         # Make new offscreen bitmap:
-        self._Buffer = wx.EmptyBitmap(*self.PanelSize)
+        self._Buffer = wx.EmptyBitmap(*self.BufferSize)
         if self._ForeDrawList:
-            self._ForegroundBuffer = wx.EmptyBitmap(*self.PanelSize)
+            self._ForegroundBuffer = wx.EmptyBitmap(*self.BufferSize)
             if self.UseHitTest:
                 self.MakeNewForegroundHTBitmap()
             else:
@@ -2699,8 +2874,8 @@ class FloatCanvas(wx.Panel):
         Off screen Bitmap used for Hit tests on background objects
         
         """
-        self._HTBitmap = wx.EmptyBitmap(self.PanelSize[0],
-                                        self.PanelSize[1],
+        self._HTBitmap = wx.EmptyBitmap(self.BufferSize[0],
+                                        self.BufferSize[1],
                                         depth=self.HitTestBitmapDepth)
 
     def MakeNewForegroundHTBitmap(self):
@@ -2711,8 +2886,8 @@ class FloatCanvas(wx.Panel):
         Off screen Bitmap used for Hit tests on foreground objects
         
         """
-        self._ForegroundHTBitmap = wx.EmptyBitmap(self.PanelSize[0],
-                                                  self.PanelSize[1],
+        self._ForegroundHTBitmap = wx.EmptyBitmap(self.BufferSize[0],
+                                                  self.BufferSize[1],
                                                   depth=self.HitTestBitmapDepth)
 
     def OnSize(self, event=None):
@@ -2728,13 +2903,20 @@ class FloatCanvas(wx.Panel):
         self.PanelSize  = N.maximum(PanelSize, (2,2)) ## OS-X sometimes gives a Size event when the panel is size (0,0)
         self.HalfPanelSize = self.PanelSize / 2 # lrk: added for speed in WorldToPixel
         self.AspectRatio = float(self.PanelSize[0]) / self.PanelSize[1]
+        self.BufferSize = self.PanelSize + 2*self.Overscan
+        self.HalfBufferSize = self.BufferSize / 2
+
+    def SetOverscan(self, Overscan):
+        self.Overscan = int(Overscan)
+        self.InitializePanel()
+        self.MakeNewBuffers()
+        self.Draw()
 
     def OnPaint(self, event):
-        dc = wx.PaintDC(self)
-        if self._ForegroundBuffer:
-            dc.DrawBitmap(self._ForegroundBuffer,0,0)
+        if self._ZoomFrame is not None:
+            self._ShowZoomFrame(wx.PaintDC(self))
         else:
-            dc.DrawBitmap(self._Buffer,0,0)
+            self.BlitView(wx.PaintDC(self))
         ## this was so that rubber band boxes and the like could get drawn here
         ##  but it looks like a wx.ClientDC is a better bet still.
         #try:
@@ -2768,69 +2950,118 @@ class FloatCanvas(wx.Panel):
         background to get re-drawn. This can be used to support simple
         animation, for instance.
 
+        Only the part of the buffers in the window is drawn here; the
+        margins around it are drawn later, when the application is idle
+        (see _DrawMargins). The buffers are re-centered on the window when
+        the background is re-drawn.
+
+        Frames with SliceObjects objects or more are drawn in slices of
+        SliceTime seconds, from idle events (see OnIdle), and the partial
+        frame is shown after each slice. If the view changes before the
+        frame is complete, it is dropped and a new one is started.
+
         """        
         
         if N.sometrue(self.PanelSize <= 2 ):
             # it's possible for this to get called before being properly initialized.
             return
-        if self.Debug: start = clock()
+        if self._ZoomFrame is not None:
+            # This is the exact frame that a progressive zoom was waiting for
+            self._ZoomFrame = None
+            self.ZoomTimer.Stop()
         ScreenDC =  wx.ClientDC(self)
-        ViewPortWorld = N.array(( self.PixelToWorld((0,0)),
-                                  self.PixelToWorld(self.PanelSize) )
-                                     )
-        self.ViewPortBB = N.array( ( N.minimum.reduce(ViewPortWorld),
-                              N.maximum.reduce(ViewPortWorld) ) )
-        dc = wx.MemoryDC()
-        dc.SelectObject(self._Buffer)
-        if self._BackgroundDirty or Force:
-            dc.SetBackground(self.BackgroundBrush)
-            dc.Clear()
-            if self._HTBitmap is not None:
-                HTdc = wx.MemoryDC()
-                HTdc.SelectObject(self._HTBitmap)
-                HTdc.Clear()
+        if self._FrameLayers:
+            if (Force or self._BackgroundDirty or not self._BufferMatchesView() or
+                self._VisibleOffset != self.BufferOffset()):
+                # The view has changed: the frame being drawn is dropped
+                self._DropFrame()
             else:
-                HTdc = None
-            if self.GridUnder is not None:
-                self.GridUnder._Draw(dc, self)
-            self._DrawObjects(dc, self._DrawList, ScreenDC, self.ViewPortBB, HTdc)
+                # Same view: the frame being drawn only has to (re-)draw the foreground
+                if self._ForeDrawList and True not in self._FrameLayers[1:] and not (
+                        self._FrameLayers[0] is True and self._FrameObjects is None):
+                    self._FrameLayers.append(True)
+                return
+
+        Redraw = Force or not self.ViewInBuffer()
+        if Redraw:
+            self._BufferCenter = self.ViewPortCenter.copy()
+            self._BufferTransform = self.TransformVector.copy()
+            BufferWorld = self.BufferToWorld(N.array(((0,0), self.BufferSize)))
+            self.ViewPortBB = N.array( ( N.minimum.reduce(BufferWorld),
+                                         N.maximum.reduce(BufferWorld) ) )
+        elif self._VisibleOffset != self.BufferOffset():
+            # The window has moved since the last draw: its old margins are needed
+            self._DrawMargins()
+
+        Offset = self.BufferOffset()
+        ViewPortWorld = N.array(( self.PixelToWorld((0,0)),
+                                  self.PixelToWorld(self.PanelSize) ))
+        self._FrameRects = [wx.Rect(Offset[0], Offset[1], self.PanelSize[0], self.PanelSize[1])]
+        self._FrameBB = N.array( ( N.minimum.reduce(ViewPortWorld),
+                                   N.maximum.reduce(ViewPortWorld) ) )
+        self._FrameLayers = []
+        self._FrameObjects = None
+        self._FrameStart = time()
+        if Redraw:
+            self._FrameLayers.append(False)
             self._BackgroundDirty = False
-            del HTdc
-
+            self._BackgroundMarginsDirty = True
         if self._ForeDrawList:
-            ## If an object was just added to the Foreground, there might not yet be a buffer
-            if self._ForegroundBuffer is None:
-                self._ForegroundBuffer = wx.EmptyBitmap(self.PanelSize[0],
-                                                        self.PanelSize[1])
-            dc = wx.MemoryDC() ## I got some strange errors (linewidths wrong) if I didn't make a new DC here
-            dc.SelectObject(self._ForegroundBuffer)
-            dc.DrawBitmap(self._Buffer,0,0)
-            if self._ForegroundHTBitmap is not None:
-                ForegroundHTdc = wx.MemoryDC()
-                ForegroundHTdc.SelectObject( self._ForegroundHTBitmap)
-                ForegroundHTdc.Clear()
-                if self._HTBitmap is not None:
-                    #Draw the background HT buffer to the foreground HT buffer
-                    ForegroundHTdc.DrawBitmap(self._HTBitmap, 0, 0)
-            else:
-                ForegroundHTdc = None
-            self._DrawObjects(dc,
-                              self._ForeDrawList,
-                              ScreenDC,
-                              self.ViewPortBB,
-                              ForegroundHTdc)
-        if self.GridOver is not None:
-            self.GridOver._Draw(dc, self)
-        ScreenDC.Blit(0, 0, self.PanelSize[0],self.PanelSize[1], dc, 0, 0)
+            self._FrameLayers.append(True)
+            self._ForegroundMarginsDirty = True
+        self._VisibleOffset = Offset
+
+        # Small frames are drawn at once, large ones a slice at a time (see OnIdle)
+        NumObjects = len(self._DrawList) + len(self._ForeDrawList)
+        for Object in self._Composites:
+            NumObjects += Object.NumObjects() - 1
+        if NumObjects < self.SliceObjects:
+            Deadline = None
+        else:
+            Deadline = time() + self.SliceTime
+        if self._DrawSlice(Deadline, ScreenDC):
+            self._EndFrame(ScreenDC)
+        else:
+            self.BlitView(ScreenDC)
+
+    def _DrawSlice(self, Deadline=None, ScreenDC=None):
+        """
+        Draws the frame started by Draw() until Deadline (a time()), layer by
+        layer: the background, then the foreground. Returns True when the
+        frame is complete.
+        """
+        while self._FrameLayers:
+            Foreground = self._FrameLayers[0]
+            if self._FrameObjects is None:
+                self._ClearLayer(Foreground, self._FrameRects)
+                if Foreground:
+                    DrawList = self._ForeDrawList
+                else:
+                    DrawList = self._DrawList
+                self._FrameObjects = self._ShouldRedraw(DrawList, self._FrameBB)
+                self._FramePosition = 0
+            self._FramePosition = self._DrawLayerObjects(Foreground, self._FrameRects,
+                                                         self._FrameObjects, None, ScreenDC,
+                                                         self._FramePosition, Deadline)
+            if self._FramePosition < len(self._FrameObjects):
+                return False
+            self._FrameLayers.pop(0)
+            self._FrameObjects = None
+        return True
+
+    def _EndFrame(self, ScreenDC):
+        self._FrameLayers = None
+        self._FrameObjects = None
+        self.BlitView(ScreenDC)
+        if Instrument.ENABLED:
+            Instrument.RecordFrame(time()-self._FrameStart)
         # If the canvas is in the middle of a zoom or move,
         # the Rubber Band box needs to be re-drawn
         ##fixme: maybe GUIModes should never be None, and rather have a Do-nothing GUI-Mode.
         if self.GUIMode is not None:
             self.GUIMode.UpdateScreen()
         if self.Debug:
-            print "Drawing took %f seconds of CPU time"%(clock()-start)
-#             if self._HTBitmap is not None:
-#                 self._HTBitmap.SaveFile('junk.png', wx.BITMAP_TYPE_PNG)
+            print "Drawing took %f seconds"%(time()-self._FrameStart)
         
         ## Clear the font cache. If you don't do this, the X font server
         ## starts to take up Massive amounts of memory This is mostly a
@@ -2840,6 +3071,210 @@ class FloatCanvas(wx.Panel):
 #         print "FC %s" % threading.current_thread()
 #         wx.CallAfter(self.Parent.Parent.DrawTest)
 
+    def _DrawLayer(self, Foreground, Rects, DrawList, ViewPortBB, ScreenDC=None):
+        """
+        Re-draws the parts of the background or foreground buffer (and of its
+        hit test bitmap) given by Rects, in buffer coordinates, with the objects
+        of DrawList that overlap ViewPortBB.
+        """
+        self._ClearLayer(Foreground, Rects)
+        self._DrawLayerObjects(Foreground, Rects, DrawList, ViewPortBB, ScreenDC)
+
+    def _ClearLayer(self, Foreground, Rects):
+        # Background: fills Rects with the background color. Foreground: copies
+        # the background into Rects.
+        dc = wx.MemoryDC()
+        if Foreground:
+            ## If an object was just added to the Foreground, there might not yet be a buffer
+            if self._ForegroundBuffer is None:
+                self._ForegroundBuffer = wx.EmptyBitmap(*self.BufferSize)
+            dc.SelectObject(self._ForegroundBuffer)
+            self._CopyRects(dc, self._Buffer, Rects)
+            HTBitmap, UnderHTBitmap = self._ForegroundHTBitmap, self._HTBitmap
+        else:
+            dc.SelectObject(self._Buffer)
+            self._FillRects(dc, Rects, self.BackgroundBrush)
+            HTBitmap, UnderHTBitmap = self._HTBitmap, None
+        if HTBitmap is not None:
+            HTdc = wx.MemoryDC()
+            HTdc.SelectObject(HTBitmap)
+            if UnderHTBitmap is not None:
+                # Draw the background HT buffer to the foreground HT buffer
+                self._CopyRects(HTdc, UnderHTBitmap, Rects)
+            else:
+                self._FillRects(HTdc, Rects, HTdc.GetBackground())
+        if not Foreground and self.GridUnder is not None:
+            dc.SetClippingRegionAsRegion(self._Region(Rects))
+            self.GridUnder._Draw(dc, self)
+
+    def _DrawLayerObjects(self, Foreground, Rects, DrawList, ViewPortBB, ScreenDC=None,
+                          Start=0, Deadline=None):
+        # Draws objects of a layer (see _DrawObjects), clipped to Rects
+        Region = self._Region(Rects)
+        dc = wx.MemoryDC()
+        if Foreground:
+            dc.SelectObject(self._ForegroundBuffer)
+            HTBitmap = self._ForegroundHTBitmap
+        else:
+            dc.SelectObject(self._Buffer)
+            HTBitmap = self._HTBitmap
+        dc.SetClippingRegionAsRegion(Region)
+        if HTBitmap is not None:
+            HTdc = wx.MemoryDC()
+            HTdc.SelectObject(HTBitmap)
+            HTdc.SetClippingRegionAsRegion(Region)
+        else:
+            HTdc = None
+        return self._DrawObjects(dc, DrawList, ScreenDC, ViewPortBB, HTdc, Start, Deadline)
+
+    def _Region(self, Rects):
+        Region = wx.Region()
+        for Rect in Rects:
+            Region.UnionRect(Rect)
+        return Region
+
+    def _CopyRects(self, dc, Bitmap, Rects):
+        Source = wx.MemoryDC()
+        Source.SelectObject(Bitmap)
+        for Rect in Rects:
+            dc.Blit(Rect.x, Rect.y, Rect.width, Rect.height, Source, Rect.x, Rect.y)
+
+    def _FillRects(self, dc, Rects, Brush):
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(Brush)
+        for Rect in Rects:
+            dc.DrawRectangleRect(Rect)
+
+    def _MarginRects(self, Offset):
+        """
+        The parts of the buffers outside of the window at Offset
+        """
+        x, y = Offset
+        w, h = self.PanelSize
+        bw, bh = self.BufferSize
+        Rects = [wx.Rect(0, 0, bw, y), wx.Rect(0, y+h, bw, bh-y-h),
+                 wx.Rect(0, y, x, h), wx.Rect(x+w, y, bw-x-w, h)]
+        return [Rect for Rect in Rects if Rect.width > 0 and Rect.height > 0]
+
+    def _DrawMargins(self):
+        """
+        Draws the margins of the buffers around the part drawn by the last
+        Draw(). Objects that were entirely in the window then are skipped.
+        """
+        if self._VisibleOffset is None or self._FrameLayers:
+            return
+        Rects = self._MarginRects(self._VisibleOffset)
+        Visible = self.BufferToWorld(N.array((self._VisibleOffset,
+                                              self.PanelSize + self._VisibleOffset)))
+        VisibleBB = BBox.fromPoints(Visible)
+        if Rects and self._BackgroundMarginsDirty:
+            DrawList = [Object for Object in self._ShouldRedraw(self._DrawList, self.ViewPortBB)
+                        if not VisibleBB.Inside(Object.BoundingBox)]
+            self._DrawLayer(False, Rects, DrawList, None)
+            self._ForegroundMarginsDirty = True
+        if Rects and self._ForegroundMarginsDirty and self._ForeDrawList:
+            DrawList = [Object for Object in self._ShouldRedraw(self._ForeDrawList,
+                                                                self.ViewPortBB)
+                        if not VisibleBB.Inside(Object.BoundingBox)]
+            self._DrawLayer(True, Rects, DrawList, None)
+        self._BackgroundMarginsDirty = False
+        self._ForegroundMarginsDirty = False
+        if Instrument.ENABLED:
+            Instrument.Count('margin_draws')
+
+    def _DropFrame(self):
+        """
+        Drops the frame being drawn by _DrawSlice(). If it had not finished
+        the background, the background buffer has to be re-drawn.
+        """
+        if False in self._FrameLayers:
+            self._BackgroundDirty = True
+        self._FrameLayers = None
+        self._FrameObjects = None
+        if Instrument.ENABLED:
+            Instrument.Count('frames_aborted')
+
+    def OnIdle(self, event):
+        if self._ZoomFrame is not None:
+            # A progressive zoom is showing a scaled frame: nothing is drawn
+            # until OnZoomTimer() re-draws the canvas
+            pass
+        elif self._FrameLayers:
+            ScreenDC = wx.ClientDC(self)
+            if self._DrawSlice(time() + self.SliceTime):
+                self._EndFrame(ScreenDC)
+            else:
+                # Show the partial frame, and come back for the next slice
+                self.BlitView(ScreenDC)
+                event.RequestMore()
+        elif self._BackgroundMarginsDirty or self._ForegroundMarginsDirty:
+            self._DrawMargins()
+        event.Skip()
+
+    def BufferOffset(self):
+        """
+        The position of the top left corner of the window in the buffers
+        """
+        if self._BufferCenter is None:
+            return (self.Overscan, self.Overscan)
+        x, y = N.round((self.ViewPortCenter - self._BufferCenter) * self._BufferTransform)
+        return (int(x) + self.Overscan, int(y) + self.Overscan)
+
+    def ViewInBuffer(self):
+        """
+        True if the window can be shown by copying the buffers: nothing has
+        changed in the background, and the window is still inside the buffers.
+        """
+        if self._BackgroundDirty or self._FrameLayers:
+            return False
+        return self._BufferMatchesView()
+
+    def _BufferMatchesView(self):
+        # True if the buffers are at the current scale, and the window is inside them
+        if self._BufferCenter is None:
+            return False
+        if not N.allclose(self.TransformVector, self._BufferTransform):
+            return False
+        x, y = self.BufferOffset()
+        return (0 <= x <= self.BufferSize[0] - self.PanelSize[0] and
+                0 <= y <= self.BufferSize[1] - self.PanelSize[1])
+
+    def BlitView(self, dc=None):
+        """
+        Shows the window from the buffers, without re-drawing any object. Parts
+        of the window outside of the buffers are filled with the background color.
+        """
+        if ((self._BackgroundMarginsDirty or self._ForegroundMarginsDirty) and
+            self._VisibleOffset != self.BufferOffset()):
+            self._DrawMargins()
+        if dc is None:
+            dc = wx.ClientDC(self)
+        ox, oy = self.BufferOffset()
+        w, h = self.PanelSize
+        bw, bh = self.BufferSize
+        # The part of the window covered by the buffers
+        x0, y0 = min(max(-ox, 0), w), min(max(-oy, 0), h)
+        x1, y1 = max(min(bw-ox, w), x0), max(min(bh-oy, h), y0)
+        if x1 > x0 and y1 > y0:
+            Source = wx.MemoryDC()
+            # While the background of a frame is drawn, the foreground buffer is out of date
+            if self._ForegroundBuffer and not (self._FrameLayers and
+                                               self._FrameLayers[0] is False):
+                Source.SelectObject(self._ForegroundBuffer)
+            else:
+                Source.SelectObject(self._Buffer)
+            dc.Blit(x0, y0, x1-x0, y1-y0, Source, x0+ox, y0+oy)
+        self._FillRects(dc, self._Uncovered(x0, y0, x1, y1), self.BackgroundBrush)
+        if self.GridOver is not None:
+            self.GridOver._Draw(dc, self, self.WorldToPixel)
+
+    def _Uncovered(self, x0, y0, x1, y1):
+        # The parts of the window outside of the rectangle (x0, y0)-(x1, y1)
+        w, h = self.PanelSize
+        Rects = [wx.Rect(0, 0, w, y0), wx.Rect(0, y1, w, h-y1),
+                 wx.Rect(0, y0, x0, y1-y0), wx.Rect(x1, y0, w-x1, y1-y0)]
+        return [Rect for Rect in Rects if Rect.width > 0 and Rect.height > 0]
+
     def _ShouldRedraw(DrawList, ViewPortBB): 
         # lrk: Returns the objects that should be redrawn
         ## fixme: should this check be moved into the object?
@@ -2847,7 +3282,10 @@ class FloatCanvas(wx.Panel):
         redrawlist = []
         for Object in DrawList:
             if Object.BoundingBox.Overlaps(BB2):
-                redrawlist.append(Object)
+                if Object.Composite:
+                    redrawlist.extend(Object.DrawObjects(BB2))
+                else:
+                    redrawlist.append(Object)
         return redrawlist
     _ShouldRedraw = staticmethod(_ShouldRedraw)
 
@@ -2882,9 +3320,12 @@ class FloatCanvas(wx.Panel):
         self.ViewPortCenter = self.ViewPortCenter + shift
         self.MapProjectionVector = self.ProjectionFun(self.ViewPortCenter)
         self.TransformVector = N.array((self.Scale,-self.Scale),N.float) * self.MapProjectionVector
-        self._BackgroundDirty = True
         if ReDraw:
-            self.Draw()
+            # Within the overscan margins, there is nothing to re-draw
+            if self.ViewInBuffer():
+                self.BlitView()
+            else:
+                self.Draw()
 
     def Zoom(self, factor, center = None, centerCoords="world"):
 
@@ -2909,6 +3350,87 @@ class FloatCanvas(wx.Panel):
             self.ViewPortCenter = center
         self.SetToNewScale()
 
+    def ZoomProgressive(self, factor, center = None, centerCoords="world"):
+        """
+        Same as Zoom(), but the canvas is not re-drawn right away: the last
+        frame is scaled to the new zoom and shown instead. The canvas is
+        re-drawn when no other zoom has come for ZoomDelay ms; each zoom
+        puts off (cancels) the pending re-draw.
+        """
+        if self._ZoomFrame is None:
+            self._ZoomFrame = self._GrabFrame()
+        if self._FrameLayers:
+            # The frame being drawn is for the old view
+            self._DropFrame()
+        self.Scale = self.Scale*factor
+        if not center is None:
+            if centerCoords == "pixel":
+                center = self.PixelToWorld( center )
+            else:
+                center = N.array(center,N.float)
+            self.ViewPortCenter = center
+        self.SetToNewScale(DrawFlag=False)
+        if self._ZoomFrame is not None:
+            self._ShowZoomFrame()
+        self.ZoomTimer.Start(self.ZoomDelay, oneShot=True)
+
+    def OnZoomTimer(self, event=None):
+        self._ZoomFrame = None
+        self.Draw()
+
+    def _GrabFrame(self):
+        """
+        Copies what the buffers hold (only the window if the margins aren't
+        drawn yet) as a wx.Image, with the world coordinates of its corners.
+        """
+        if self._BufferCenter is None or self._VisibleOffset is None:
+            return None
+        if self._BackgroundMarginsDirty or self._ForegroundMarginsDirty:
+            x, y = self._VisibleOffset
+            Rect = wx.Rect(x, y, self.PanelSize[0], self.PanelSize[1])
+        else:
+            Rect = wx.Rect(0, 0, self.BufferSize[0], self.BufferSize[1])
+        if self._ForegroundBuffer:
+            Bitmap = self._ForegroundBuffer
+        else:
+            Bitmap = self._Buffer
+        Image = Bitmap.GetSubBitmap(Rect).ConvertToImage()
+        Corners = self.BufferToWorld(N.array(((Rect.x, Rect.y),
+                                              (Rect.x+Rect.width, Rect.y+Rect.height))))
+        return Image, Corners
+
+    def _ShowZoomFrame(self, dc=None):
+        """
+        Shows the frame from _GrabFrame() at the current zoom. Only the part
+        of it in the window is scaled.
+        """
+        Image, Corners = self._ZoomFrame
+        if dc is None:
+            dc = wx.ClientDC(self)
+        # Position and scale of the frame in the window
+        (px0, py0), (px1, py1) = ((Corners - self.ViewPortCenter)*self.TransformVector +
+                                  self.HalfPanelSize)
+        Scale = (px1 - px0) / Image.GetWidth()
+        w, h = self.PanelSize
+        # The pixels of the frame that are in the window
+        sx0 = int(N.clip(N.floor(-px0/Scale), 0, Image.GetWidth()))
+        sy0 = int(N.clip(N.floor(-py0/Scale), 0, Image.GetHeight()))
+        sx1 = int(N.clip(N.ceil((w-px0)/Scale), sx0, Image.GetWidth()))
+        sy1 = int(N.clip(N.ceil((h-py0)/Scale), sy0, Image.GetHeight()))
+        x0, y0 = int(round(px0 + sx0*Scale)), int(round(py0 + sy0*Scale))
+        x1, y1 = int(round(px0 + sx1*Scale)), int(round(py0 + sy1*Scale))
+        if x1 > x0 and y1 > y0:
+            Part = Image.GetSubImage(wx.Rect(sx0, sy0, sx1-sx0, sy1-sy0))
+            dc.DrawBitmap(wx.BitmapFromImage(Part.Scale(x1-x0, y1-y0)), x0, y0)
+        else:
+            x0, y0, x1, y1 = 0, 0, 0, 0
+        self._FillRects(dc, self._Uncovered(max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)),
+                        self.BackgroundBrush)
+        if self.GridOver is not None:
+            self.GridOver._Draw(dc, self, self.WorldToPixel)
+        if Instrument.ENABLED:
+            Instrument.Count('zoom_previews')
+
     def ZoomToBB(self, NewBB=None, DrawFlag=True):
 
         """
@@ -2977,6 +3499,8 @@ class FloatCanvas(wx.Panel):
         else:
             self._DrawList.remove(Object)
             self._BackgroundDirty = True
+        if Object.Composite:
+            self._Composites.remove(Object)
         if ResetBB:
             self.BoundingBoxDirty = True
 
@@ -2991,6 +3515,7 @@ class FloatCanvas(wx.Panel):
         """
         self._DrawList = []
         self._ForeDrawList = []
+        self._Composites = []
         self._BackgroundDirty = True
         self.HitColorGenerator = None
         self.UseHitTest = False
@@ -3046,6 +3571,20 @@ class FloatCanvas(wx.Panel):
                    self.ViewPortCenter)*self.TransformVector)+
                  (self.HalfPanelSize)).astype('i')
 
+    def WorldToBuffer(self, Coordinates):
+        """
+        Same as WorldToPixel, for the buffers: it is passed to the drawing
+        functions of the objects instead of WorldToPixel.
+        """
+        return  (((N.asarray(Coordinates,N.float) -
+                   self._BufferCenter)*self._BufferTransform)+
+                 (self.HalfBufferSize)).astype('i')
+
+    def BufferToWorld(self, Points):
+        return  (((N.asarray(Points, N.float) -
+                   self.HalfBufferSize)/self._BufferTransform) +
+                 self._BufferCenter)
+
     def ScaleWorldToPixel(self,Lengths):
         """
         This function will get passed to the drawing functions of the objects,
@@ -3075,6 +3614,8 @@ class FloatCanvas(wx.Panel):
         else:
             self._DrawList.append(obj)
             self._BackgroundDirty = True
+        if obj.Composite:
+            self._Composites.append(obj)
         self.BoundingBoxDirty = True
         return obj
 
@@ -3082,26 +3623,43 @@ class FloatCanvas(wx.Panel):
         for Object in Objects:
             self.AddObject(Object)
 
-    def _DrawObjects(self, dc, DrawList, ScreenDC, ViewPortBB, HTdc = None):
+    def _DrawObjects(self, dc, DrawList, ScreenDC, ViewPortBB, HTdc = None,
+                     Start = 0, Deadline = None):
         """
         This is a convenience function;
         This function takes the list of objects and draws them to specified
         device context.
+
+        If ViewPortBB is None, DrawList has already been culled. Drawing
+        starts at DrawList[Start], and stops early if the time() passes
+        Deadline. Returns the index of the next object to draw.
         """
         dc.SetBackground(self.BackgroundBrush)
         dc.BeginDrawing()
-        #i = 0
         PanelSize0, PanelSize1 = self.PanelSize # for speed
-        WorldToPixel = self.WorldToPixel # for speed
+        OffsetX, OffsetY = self.BufferOffset()
+        WorldToPixel = self.WorldToBuffer # for speed
         ScaleWorldToPixel = self.ScaleWorldToPixel # for speed
-        Blit = ScreenDC.Blit # for speed
         NumBetweenBlits = self.NumBetweenBlits # for speed
-        for i, Object in enumerate(self._ShouldRedraw(DrawList, ViewPortBB)):
+        if ScreenDC is None or Deadline is not None: # nothing is shown until the end
+            NumBetweenBlits = 0
+        if ViewPortBB is not None:
+            DrawList = self._ShouldRedraw(DrawList, ViewPortBB)
+        i = Start
+        n = len(DrawList)
+        while i < n:
+            Object = DrawList[i]
+            i += 1
             if Object.Visible:
                 Object._Draw(dc, WorldToPixel, ScaleWorldToPixel, HTdc)
-                if (i+1) % NumBetweenBlits == 0:
-                    Blit(0, 0, PanelSize0, PanelSize1, dc, 0, 0)
+                if NumBetweenBlits and i % NumBetweenBlits == 0:
+                    ScreenDC.Blit(0, 0, PanelSize0, PanelSize1, dc, OffsetX, OffsetY)
+            if Deadline is not None and i % SLICE_CHECK == 0 and time() > Deadline:
+                break
         dc.EndDrawing()
+        if Instrument.ENABLED:
+            Instrument.Count('objects_drawn', i-Start)
+        return i
 
     def SaveAsImage(self, filename, ImageType=wx.BITMAP_TYPE_PNG):
         """
@@ -3118,12 +3676,15 @@ class FloatCanvas(wx.Panel):
 
         """
 
-        self._Buffer.SaveFile(filename, ImageType)
+        x, y = self.BufferOffset()
+        Rect = wx.Rect(x, y, self.PanelSize[0], self.PanelSize[1])
+        self._Buffer.GetSubBitmap(Rect).SaveFile(filename, ImageType)
 
 
 def _makeFloatCanvasAddMethods(): ## lrk's code for doing this in module __init__
     classnames = ["Circle", "Ellipse", "Arc", "Rectangle", "ScaledText", "Polygon",
-                  "Line", "Text", "PointSet","Point", "Arrow", "ArrowLine", "ScaledTextBox",
+                  "Line", "Text", "PointSet","Point", "Arrow", "ArrowLine", "ArrowLineSet",
+                  "ScaledTextBox",
                   "SquarePoint","Bitmap", "ScaledBitmap", "Spline", "Group"]
     for classname in classnames:
         klass = globals()[classname]
@@ -673,7 +673,6 @@ class GUIPan(GUIBase):
         self.GrabCursor = self.Cursors.PanCursor
         self.StartMove = None
         self.MidMove = None
-        self.PrevMoveXY = None
         
         ## timer to give a delay when moving so that buffers aren't re-built too many times.
         self.MoveTimer = wx.PyTimer(self.OnMoveTimer)
@@ -683,7 +682,6 @@ class GUIPan(GUIBase):
         self.Canvas.CaptureMouse()
         self.StartMove = N.array( event.GetPosition() )
         self.MidMove = self.StartMove
-        self.PrevMoveXY = (0,0)
 
     def OnLeftUp(self, event):
         self.Canvas.SetCursor(self.Cursor)
@@ -697,87 +695,35 @@ class GUIPan(GUIBase):
         self.Canvas._RaiseMouseEvent(event, FloatCanvas.EVT_FC_MOTION)
         if event.Dragging() and event.LeftIsDown() and not self.StartMove is None:
             self.EndMove = N.array(event.GetPosition())
-            self.MoveImage(event)
             DiffMove = self.MidMove-self.EndMove
             self.Canvas.MoveImage(DiffMove, 'Pixel', ReDraw=False)# reset the canvas without re-drawing
             self.MidMove = self.EndMove
-            self.MoveTimer.Start(30, oneShot=True)
+            self.MoveImage(event)
 
     def OnMoveTimer(self, event=None):
-        self.Canvas.Draw()
+        if not self.Canvas.ViewInBuffer():
+            self.Canvas.Draw()
 
     def UpdateScreen(self):
         ## The screen has been re-drawn, so StartMove needs to be reset.
         self.StartMove = self.MidMove
 
     def MoveImage(self, event ):
-        #xy1 = N.array( event.GetPosition() )
-        xy1 = self.EndMove
-        wh = self.Canvas.PanelSize
-        xy_tl = xy1 - self.StartMove
-        dc = wx.ClientDC(self.Canvas)
-        dc.BeginDrawing()
-        x1,y1 = self.PrevMoveXY
-        x2,y2 = xy_tl
-        w,h = self.Canvas.PanelSize
-        ##fixme: This sure could be cleaner!
-        ##   This is all to fill in the background with the background color
-        ##   without flashing as the image moves.
-        if x2 > x1 and y2 > y1:
-            xa = xb = x1
-            ya = yb = y1
-            wa = w
-            ha = y2 - y1
-            wb = x2-  x1
-            hb = h
-        elif x2 > x1 and y2 <= y1:
-            xa = x1
-            ya = y1
-            wa = x2 - x1
-            ha = h
-            xb = x1
-            yb = y2 + h
-            wb = w
-            hb = y1 - y2
-        elif x2 <= x1 and y2 > y1:
-            xa = x1
-            ya = y1
-            wa = w
-            ha = y2 - y1
-            xb = x2 + w
-            yb = y1
-            wb = x1 - x2
-            hb = h - y2 + y1
-        elif x2 <= x1 and y2 <= y1:
-            xa = x2 + w
-            ya = y1
-            wa = x1 - x2
-            ha = h
-            xb = x1
-            yb = y2 + h
-            wb = w
-            hb = y1 - y2
-
-        dc.SetPen(wx.TRANSPARENT_PEN)
-        dc.SetBrush(self.Canvas.BackgroundBrush)
-        dc.DrawRectangle(xa, ya, wa, ha)
-        dc.DrawRectangle(xb, yb, wb, hb)
-        self.PrevMoveXY = xy_tl
-        if self.Canvas._ForeDrawList:
-            dc.DrawBitmapPoint(self.Canvas._ForegroundBuffer,xy_tl)
-        else:
-            dc.DrawBitmapPoint(self.Canvas._Buffer,xy_tl)
-        dc.EndDrawing()
-        #self.Canvas.Update()
+        ## Within the overscan margins of the canvas buffers, this is only a blit.
+        ## Otherwise, the part of the window that isn't in the buffers is filled
+        ## with the background color until the canvas is re-drawn.
+        self.Canvas.BlitView()
+        if not self.Canvas.ViewInBuffer():
+            self.MoveTimer.Start(30, oneShot=True)
 
     def OnWheel(self, event):
         """
            By default, zoom in/out by a 0.1 factor per Wheel event.
         """
         if event.GetWheelRotation() < 0:
-            self.Canvas.Zoom(0.9)
+            self.Canvas.ZoomProgressive(0.9)
         else:
-            self.Canvas.Zoom(1.1)
+            self.Canvas.ZoomProgressive(1.1)
 
 class GUIZoomIn(GUIBase):
  
@@ -847,9 +793,9 @@ class GUIZoomIn(GUIBase):
 
     def OnWheel(self, event):
         if event.GetWheelRotation() < 0:
-            self.Canvas.Zoom(0.9)
+            self.Canvas.ZoomProgressive(0.9)
         else:
-            self.Canvas.Zoom(1.1)
+            self.Canvas.ZoomProgressive(1.1)
 
 class GUIZoomOut(GUIBase):
 
@@ -865,9 +811,9 @@ class GUIZoomOut(GUIBase):
 
     def OnWheel(self, event):
         if event.GetWheelRotation() < 0:
-            self.Canvas.Zoom(0.9)
+            self.Canvas.ZoomProgressive(0.9)
         else:
-            self.Canvas.Zoom(1.1)
+            self.Canvas.ZoomProgressive(1.1)
 
     def OnMove(self, event):
         # Always raise the Move event.
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+'''
+Roadmap quality and connectivity analysis over MapFrame.nodelist and MapFrame.edgelist.
+
+Analyze() returns a report with:
+    - the connected components of the graph (largest first)
+    - the articulation points (nodes whose removal disconnects the graph) and bridges
+    - the fraction of the free space which is visible from at least one node
+    - the detour ratio: graph distance divided by straight-line distance between nodes
+
+Everything except the visibility test runs in (near) linear time in the size of the
+graph; the visibility test is linear in the number of nodes, and is run on a coarser grid
+(see VisibleFraction) to keep the cost per node small.
+
+@author: jon
+'''
+
+import math
+import heapq
+import numpy as np
+import Sampling
+
+VISIBILITY_RANGE    = 200   # pixels (10 metres at the default 5 cm resolution)
+VISIBILITY_CELL     = 4     # pixels per side of the blocks the visibility rays are cast on
+DETOUR_SOURCES      = 32    # number of nodes used as sources for the detour ratio
+
+#---------------------------------------------------------------------------------------------#
+#    Adjacency list: adj[node] is a list of (neighbor, edge id, edge length in pixels)         #
+#---------------------------------------------------------------------------------------------#
+def BuildAdjacency(nodelist, edgelist):
+    adj = [[] for node in nodelist]
+    for edge in edgelist:
+        a = int(edge.node1)
+        b = int(edge.node2)
+        adj[a].append((b, edge.id, edge.length))
+        adj[b].append((a, edge.id, edge.length))
+    return adj
+
+#---------------------------------------------------------------------------------------------#
+#    Connected components with union-find. Returns lists of node ids, largest first.          #
+#---------------------------------------------------------------------------------------------#
+def ConnectedComponents(num_nodes, edgelist):
+    parent = range(num_nodes)
+
+    def Find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    for edge in edgelist:
+        ra = Find(int(edge.node1))
+        rb = Find(int(edge.node2))
+        if ra != rb:
+            parent[ra] = rb
+
+    components = {}
+    for node in range(num_nodes):
+        components.setdefault(Find(node), []).append(node)
+    return sorted(components.values(), key=len, reverse=True)
+
+#---------------------------------------------------------------------------------------------#
+#    Articulation points and bridges (iterative version of Tarjan's algorithm, so that long   #
+#    corridors of nodes don't hit the recursion limit). Parallel edges are told apart by      #
+#    their edge id.                                                                           #
+#---------------------------------------------------------------------------------------------#
+def ArticulationPoints(adj):
+    n = len(adj)
+    disc = [-1]*n
+    low = [0]*n
+    cut = set()
+    bridges = []
+    t = 0
+
+    for root in range(n):
+        if disc[root] != -1:
+            continue
+        disc[root] = low[root] = t
+        t += 1
+        root_children = 0
+        stack = [(root, -1, iter(adj[root]))]
+
+        while stack:
+            v, parent_edge, neighbors = stack[-1]
+            descended = False
+            for w, edge_id, length in neighbors:
+                if edge_id == parent_edge:
+                    continue
+                if disc[w] == -1:
+                    disc[w] = low[w] = t
+                    t += 1
+                    if v == root:
+                        root_children += 1
+                    stack.append((w, edge_id, iter(adj[w])))
+                    descended = True
+                    break
+                low[v] = min(low[v], disc[w])
+            if descended:
+                continue
+
+            stack.pop()
+            if stack:
+                u = stack[-1][0]
+                low[u] = min(low[u], low[v])
+                if low[v] > disc[u]:
+                    bridges.append(parent_edge)
+                if u != root and low[v] >= disc[u]:
+                    cut.add(u)
+
+        if root_children > 1:
+            cut.add(root)
+
+    return sorted(cut), bridges
+
+#---------------------------------------------------------------------------------------------#
+#    Dijkstra from a single source. Returns a list of distances (inf where unreachable).      #
+#---------------------------------------------------------------------------------------------#
+def ShortestPathLengths(adj, source):
+    dist = [float('inf')]*len(adj)
+    dist[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        d, v = heapq.heappop(heap)
+        if d > dist[v]:
+            continue
+        for w, edge_id, length in adj[v]:
+            nd = d + length
+            if nd < dist[w]:
+                dist[w] = nd
+                heapq.heappush(heap, (nd, w))
+    return dist
+
+#---------------------------------------------------------------------------------------------#
+#    Average and worst ratio of graph distance to straight-line distance, over all pairs      #
+#    (source, target) that are connected, for up to DETOUR_SOURCES evenly spread sources.     #
+#---------------------------------------------------------------------------------------------#
+def DetourRatio(nodelist, adj, num_sources=DETOUR_SOURCES):
+    n = len(nodelist)
+    if n < 2:
+        return None, None
+    pts = np.array([node.coords for node in nodelist], dtype=float)
+    sources = sorted(set(np.linspace(0, n-1, min(num_sources, n)).astype(int)))
+
+    ratios = []
+    for s in sources:
+        dist = np.array(ShortestPathLengths(adj, s))
+        straight = np.hypot(pts[:,0]-pts[s,0], pts[:,1]-pts[s,1])
+        ok = np.isfinite(dist) & (straight > 0)
+        ratios.append(dist[ok] / straight[ok])
+    ratios = np.concatenate(ratios)
+    if len(ratios) == 0:
+        return None, None
+    return float(ratios.mean()), float(ratios.max())
+
+#---------------------------------------------------------------------------------------------#
+#    Fraction of the free cells of the grid that can be seen (straight line through free      #
+#    cells, within max_range pixels) from at least one node. Also returns the boolean mask    #
+#    of the cells that were seen.                                                             #
+#                                                                                             #
+#    The rays are cast on a coarse grid of 'cell' x 'cell' pixel blocks, which is an          #
+#    approximation: a block is transparent only if all of its pixels are free, and a ray      #
+#    sees the free pixels of every block it reaches, up to and including the first opaque     #
+#    one. The ray offsets are computed once, as integers, for all the nodes.                  #
+#---------------------------------------------------------------------------------------------#
+def VisibleFraction(grid, points, max_range=VISIBILITY_RANGE, cell=VISIBILITY_CELL):
+    h, w = grid.shape
+    free = grid == Sampling.FREE
+    total = free.sum()
+    if total == 0 or len(points) == 0:
+        return 0.0, np.zeros(grid.shape, dtype=bool)
+
+    # Coarse grid: transparent blocks
+    H = -(-h // cell)
+    W = -(-w // cell)
+    padded = np.zeros((H*cell, W*cell), dtype=bool)
+    padded[:h,:w] = free
+    clear = padded.reshape(H, cell, W, cell).all(axis=3).all(axis=1)
+    seen = np.zeros((H, W), dtype=bool)
+
+    # Enough rays that neighboring rays are at most one block apart at max_range
+    reach = int(math.ceil(float(max_range) / cell))
+    angles = np.linspace(0, 2*math.pi, max(int(2*math.pi*reach), 8), endpoint=False)
+    steps = np.arange(1, reach+1)
+    ox = np.rint(np.cos(angles)[:,np.newaxis]*steps[np.newaxis,:]).astype(int)
+    oy = np.rint(np.sin(angles)[:,np.newaxis]*steps[np.newaxis,:]).astype(int)
+
+    for x, y in points:
+        cx = int(x) // cell
+        cy = int(y) // cell
+        if not (0 <= cx < W and 0 <= cy < H):
+            continue
+        seen[cy, cx] = True
+        xs = cx + ox
+        ys = cy + oy
+        inside = (xs >= 0) & (xs < W) & (ys >= 0) & (ys < H)
+        xs = np.clip(xs, 0, W-1)
+        ys = np.clip(ys, 0, H-1)
+
+        # A block is reached if every block before it on the ray is transparent
+        reached = np.empty(xs.shape, dtype=bool)
+        reached[:,0] = True
+        reached[:,1:] = np.cumprod(clear[ys[:,:-1], xs[:,:-1]], axis=1)
+        reached &= inside
+        seen[ys[reached], xs[reached]] = True
+
+    seen = np.repeat(np.repeat(seen, cell, axis=0), cell, axis=1)[:h,:w] & free
+    return float(seen.sum()) / total, seen
+
+#---------------------------------------------------------------------------------------------#
+#    Runs every analysis. 'grid' is MapFrame.GetOccupancyGrid(); if it is None the visible    #
+#    fraction is not computed.                                                                #
+#---------------------------------------------------------------------------------------------#
+def Analyze(nodelist, edgelist, grid=None):
+    adj = BuildAdjacency(nodelist, edgelist)
+    components = ConnectedComponents(len(nodelist), edgelist)
+    cut, bridges = ArticulationPoints(adj)
+    detour_mean, detour_max = DetourRatio(nodelist, adj)
+    if grid is not None:
+        coverage = VisibleFraction(grid, [node.coords for node in nodelist])[0]
+    else:
+        coverage = None
+
+    return {
+        'nodes': len(nodelist),
+        'edges': len(edgelist),
+        'components': components,
+        'isolated': [c[0] for c in components if len(c) == 1],
+        'articulation_points': cut,
+        'bridges': bridges,
+        'coverage': coverage,
+        'detour_mean': detour_mean,
+        'detour_max': detour_max,
+    }
+
+def Summary(report):
+    lines = ["%i nodes, %i edges, %i connected component(s) (%i isolated node(s))" %
+             (report['nodes'], report['edges'], len(report['components']),
+              len(report['isolated'])),
+             "%i articulation point(s), %i bridge(s)" %
+             (len(report['articulation_points']), len(report['bridges']))]
+    if report['coverage'] is not None:
+        lines.append("%.1f%% of the free space is visible from the graph" %
+                     (100*report['coverage']))
+    if report['detour_mean'] is not None:
+        lines.append("Detour ratio: %.2f average, %.2f worst" %
+                     (report['detour_mean'], report['detour_max']))
+    return "\n".join(lines)
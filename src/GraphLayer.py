@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+
+'''
+Drawing of the graph with a bounded number of canvas objects.
+
+The nodes, labels and edges of the graph are not FloatCanvas objects: each one is a Graphic,
+a small record of what is drawn (its position, size and colors), held by a GraphLayer. The
+layer is a single object on the canvas. When the canvas draws, the layer looks up the
+graphics in the buffer (the window and its overscan margin) in a grid index, and only those
+get a real FloatCanvas object (Circle, ScaledText or Line). Objects whose graphic leaves the
+buffer go to a pool and are reused for the graphics that enter it, so the number of live
+objects depends on what is shown and not on the size of the graph.
+
+If more than MAX_LIVE graphics are in the buffer (a large graph seen from far away), the
+graphics of kinds with no handlers bound (e.g. the node labels), which are never clicked, are
+not made live: the layer draws them itself. If the other graphics are still more than
+MAX_LIVE, none of them is live either: the layer draws them all, the circles with one
+DrawEllipseList() call and the lines with one DrawLineList() call (texts are drawn one by
+one, when they are big enough to be seen), and they cannot be clicked until the view gets
+closer.
+
+A graphic is used like the object it stands for: SetFillColor(), SetLineColor(), Move(),
+Name, Visible, and any attribute set on it (e.g. Coords). Events of the live objects are
+passed to the handlers bound to the layer, with the graphic and not the live object:
+
+    layer = GraphLayer(InForeground=True)
+    canvas.AddObject(layer)
+    layer.Bind('node', FloatCanvas.EVT_FC_LEFT_DOWN, self.OnClickNode)
+    c = layer.AddCircle('node', xy, diam, LineColor=lc, FillColor=fc)
+    ...
+    layer.RemoveObject(c)
+
+@author: jon
+'''
+
+import wx
+import numpy as np
+import FloatCanvas
+import Instrument
+from wx.lib.floatcanvas.Utilities import BBox
+
+GRID_CELL       = 64        # size of the cells of the grid index, in world units
+MAX_LIVE        = 4000      # maximum number of live canvas objects of a layer
+MAX_POOL        = 1000      # maximum number of released objects kept for reuse
+
+def _Overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def _Pen(Color, Width):
+    if Color is None:
+        return wx.TRANSPARENT_PEN
+    key = (Color, "Solid", Width)
+    if key not in FloatCanvas.DrawObject.PenList:
+        FloatCanvas.DrawObject.PenList[key] = wx.Pen(Color, Width, wx.SOLID)
+    return FloatCanvas.DrawObject.PenList[key]
+
+def _Brush(Color):
+    if Color is None:
+        return wx.TRANSPARENT_BRUSH
+    key = (Color, "Solid")
+    if key not in FloatCanvas.DrawObject.BrushList:
+        FloatCanvas.DrawObject.BrushList[key] = wx.Brush(Color, wx.SOLID)
+    return FloatCanvas.DrawObject.BrushList[key]
+
+#---------------------------------------------------------------------------------------------#
+#    Base class of the graphics. 'Kind' selects the event handlers of the layer (see          #
+#    GraphLayer.Bind). Subclasses define Bounds (x0, y0, x1, y1), which may be larger than    #
+#    what is drawn, and how to make or update a live object.                                  #
+#---------------------------------------------------------------------------------------------#
+class Graphic(object):
+    def __init__(self, Kind):
+        self.Kind = Kind
+        self.Name = None
+        self.Layer = None
+        self.Live = None
+        self.Seq = 0
+        self.Cells = ()
+        self._Visible = True
+
+    def _GetVisible(self):
+        return self._Visible
+
+    def _SetVisible(self, Visible):
+        self._Visible = Visible
+        if self.Live is not None:
+            self.Live.Visible = Visible
+
+    Visible = property(_GetVisible, _SetVisible)
+
+    def Hide(self):
+        self.Visible = False
+
+    def Show(self):
+        self.Visible = True
+
+    def SetLineColor(self, LineColor):
+        self.LineColor = LineColor
+        if self.Live is not None:
+            self.Live.SetLineColor(LineColor)
+
+    def SetFillColor(self, FillColor):
+        pass
+
+    def SetColor(self, Color):
+        pass
+
+    def Move(self, Delta):
+        self.Translate(np.asarray(Delta, float))
+        if self.Live is not None:
+            self.Live.Move(Delta)
+        if self.Layer is not None:
+            self.Layer.Reindex(self)
+
+class CircleGraphic(Graphic):
+    def __init__(self, Kind, XY, Diameter, LineColor="Black", LineWidth=1, FillColor=None):
+        Graphic.__init__(self, Kind)
+        self.XY = np.array(XY, float)
+        self.Diameter = Diameter
+        self.LineColor = LineColor
+        self.LineWidth = LineWidth
+        self.FillColor = FillColor
+
+    @property
+    def Bounds(self):
+        r = self.Diameter/2.0
+        return (self.XY[0]-r, self.XY[1]-r, self.XY[0]+r, self.XY[1]+r)
+
+    def Translate(self, Delta):
+        self.XY = self.XY + Delta
+
+    def SetFillColor(self, FillColor):
+        self.FillColor = FillColor
+        if self.Live is not None:
+            self.Live.SetFillColor(FillColor)
+
+    def PoolKey(self):
+        return ('Circle', self.Kind, self.Diameter, self.LineWidth)
+
+    def Make(self, InForeground):
+        return FloatCanvas.Circle(self.XY, self.Diameter, LineColor=self.LineColor,
+                                  LineWidth=self.LineWidth, FillColor=self.FillColor,
+                                  InForeground=InForeground)
+
+    def Reuse(self, Object):
+        Object.SetPoint(self.XY)
+        Object.SetLineColor(self.LineColor)
+        Object.SetFillColor(self.FillColor)
+
+    # Draws circles without live objects, as Circle._Draw() would (too small ones are skipped)
+    @staticmethod
+    def DrawMany(Graphics, dc, WorldToPixel, ScaleWorldToPixel):
+        XY = WorldToPixel(np.array([g.XY for g in Graphics]))
+        R = np.array([g.Diameter/2.0 for g in Graphics])
+        R = np.abs(ScaleWorldToPixel(np.column_stack((R, R)))[:, 0])
+        keep = np.flatnonzero(R > 1)
+        if len(keep) == 0:
+            return
+        Rects = np.column_stack((XY[keep] - R[keep, None], 2*R[keep], 2*R[keep]))
+        Pens = [_Pen(Graphics[i].LineColor, Graphics[i].LineWidth) for i in keep]
+        Brushes = [_Brush(Graphics[i].FillColor) for i in keep]
+        dc.DrawEllipseList(Rects.tolist(), Pens, Brushes)
+
+class TextGraphic(Graphic):
+    def __init__(self, Kind, String, XY, Size, Color="Black", Weight=wx.NORMAL, Position='tl'):
+        Graphic.__init__(self, Kind)
+        self.String = String
+        self.XY = np.array(XY, float)
+        self.Size = Size
+        self.Color = Color
+        self.Weight = Weight
+        self.Position = Position
+
+    # Measuring the text needs a DC: the bounds are those of any text of up to len(String)
+    # characters, in any Position
+    @property
+    def Bounds(self):
+        w = self.Size*len(self.String)
+        h = self.Size*2
+        return (self.XY[0]-w, self.XY[1]-h, self.XY[0]+w, self.XY[1]+h)
+
+    def Translate(self, Delta):
+        self.XY = self.XY + Delta
+
+    def SetColor(self, Color):
+        self.Color = Color
+        if self.Live is not None:
+            self.Live.SetColor(Color)
+
+    def PoolKey(self):
+        return ('ScaledText', self.Kind, self.Size, self.Weight, self.Position)
+
+    def Make(self, InForeground):
+        return FloatCanvas.ScaledText(self.String, self.XY, self.Size, Color=self.Color,
+                                      Weight=self.Weight, Position=self.Position,
+                                      InForeground=InForeground)
+
+    def Reuse(self, Object):
+        Object.String = self.String
+        Object.SetColor(self.Color)
+        Object.SetPoint(self.XY)
+
+    # Draws the texts with a single ScaledText, moved from one to the next
+    @staticmethod
+    def DrawMany(Graphics, dc, WorldToPixel, ScaleWorldToPixel):
+        Stamp = None
+        for g in Graphics:
+            Size = abs(ScaleWorldToPixel((g.Size, g.Size))[1])
+            if Size <= 1:
+                continue
+            if Stamp is None or Stamp.Size != g.Size or Stamp.Weight != g.Weight:
+                Stamp = FloatCanvas.ScaledText(g.String, g.XY, g.Size, Weight=g.Weight)
+            Stamp.String = g.String
+            Stamp.XY = g.XY
+            Stamp.Color = g.Color
+            Stamp.ShiftFun = Stamp.ShiftFunDict[g.Position]
+            Stamp._Draw(dc, WorldToPixel, ScaleWorldToPixel)
+
+class LineGraphic(Graphic):
+    def __init__(self, Kind, Points, LineColor="Black", LineWidth=1):
+        Graphic.__init__(self, Kind)
+        self.Points = np.array(Points, float).reshape(-1, 2)
+        self.LineColor = LineColor
+        self.LineWidth = LineWidth
+
+    @property
+    def Bounds(self):
+        x0, y0 = self.Points.min(axis=0)
+        x1, y1 = self.Points.max(axis=0)
+        return (x0, y0, x1, y1)
+
+    def Translate(self, Delta):
+        self.Points = self.Points + Delta
+
+    def SetPoints(self, Points):
+        self.Points = np.array(Points, float).reshape(-1, 2)
+        if self.Live is not None:
+            self.Live.SetPoints(self.Points)
+        if self.Layer is not None:
+            self.Layer.Reindex(self)
+
+    def PoolKey(self):
+        return ('Line', self.Kind, self.LineWidth)
+
+    def Make(self, InForeground):
+        return FloatCanvas.Line(self.Points, LineColor=self.LineColor,
+                                LineWidth=self.LineWidth, InForeground=InForeground)
+
+    def Reuse(self, Object):
+        Object.SetPoints(self.Points)
+        Object.SetLineColor(self.LineColor)
+
+    # Draws all the segments of the lines at once
+    @staticmethod
+    def DrawMany(Graphics, dc, WorldToPixel, ScaleWorldToPixel):
+        Segments = []
+        Pens = []
+        for g in Graphics:
+            P = g.Points
+            Segments.append(np.hstack((P[:-1], P[1:])))
+            Pens.extend([_Pen(g.LineColor, g.LineWidth)]*(len(P)-1))
+        Segments = WorldToPixel(np.vstack(Segments).reshape(-1, 2)).reshape(-1, 4)
+        dc.DrawLineList(Segments.tolist(), Pens)
+
+#---------------------------------------------------------------------------------------------#
+#    A canvas object that holds graphics and draws them through live objects (see above).     #
+#    The canvas asks for the objects to draw with DrawObjects() (see FloatCanvas.Composite).  #
+#---------------------------------------------------------------------------------------------#
+class GraphLayer(FloatCanvas.DrawObject):
+    Composite = True
+
+    def __init__(self, InForeground=False, MaxLive=MAX_LIVE, MaxPool=MAX_POOL,
+                 CellSize=GRID_CELL):
+        FloatCanvas.DrawObject.__init__(self, InForeground)
+        self.MaxLive = MaxLive
+        self.MaxPool = MaxPool
+        self.CellSize = float(CellSize)
+        self.Grid = {}                  # (i, j) -> set of graphics
+        self.Live = set()               # graphics with a live object
+        self.Pool = {}                  # PoolKey() -> released objects
+        self.Pooled = 0
+        self.Handlers = {}              # Kind -> {Event: function}
+        self.Callbacks = {}             # Event -> callback bound to the live objects
+        self.Extent = None              # bounds of all the graphics ever added
+        self.BoundingBox = BBox.NullBBox()
+        self._Seq = 0
+        self._LiveBounds = None         # buffer the live objects were made for
+        self._Overview = None           # graphics in the buffer drawn by the layer itself
+
+    def AddCircle(self, Kind, XY, Diameter, **kwargs):
+        return self.AddGraphic(CircleGraphic(Kind, XY, Diameter, **kwargs))
+
+    def AddScaledText(self, Kind, String, XY, Size, **kwargs):
+        return self.AddGraphic(TextGraphic(Kind, String, XY, Size, **kwargs))
+
+    def AddLine(self, Kind, Points, **kwargs):
+        return self.AddGraphic(LineGraphic(Kind, Points, **kwargs))
+
+    # Graphics are drawn in the order they were added
+    def AddGraphic(self, g):
+        g.Layer = self
+        g.Seq = self._Seq
+        self._Seq += 1
+        self.Reindex(g)
+        return g
+
+    def RemoveObject(self, g):
+        self.Unindex(g)
+        if g.Live is not None:
+            self.Release(g)
+        g.Layer = None
+        self._LiveBounds = None
+
+    def Bind(self, Kind, Event, CallBackFun):
+        self.Handlers.setdefault(Kind, {})[Event] = CallBackFun
+        if Event not in self.Callbacks:
+            self.Callbacks[Event] = self.MakeCallback(Event)
+        for g in self.Live:
+            if g.Kind == Kind:
+                g.Live.Bind(Event, self.Callbacks[Event])
+        for Key, Objects in self.Pool.iteritems():
+            if Key[1] == Kind:
+                for Object in Objects:
+                    Object.Bind(Event, self.Callbacks[Event])
+
+    def MakeCallback(self, Event):
+        def Callback(Object):
+            g = Object.Graphic
+            if g is None:
+                return
+            g.HitCoords = Object.HitCoords
+            g.HitCoordsPixel = Object.HitCoordsPixel
+            self.Handlers[g.Kind][Event](g)
+        return Callback
+
+#---------------------------------------------------------------------------------------------#
+#    Grid index                                                                               #
+#---------------------------------------------------------------------------------------------#
+    def CellRange(self, Bounds):
+        c = self.CellSize
+        return (int(np.floor(Bounds[0]/c)), int(np.floor(Bounds[1]/c)),
+                int(np.floor(Bounds[2]/c)), int(np.floor(Bounds[3]/c)))
+
+    def Unindex(self, g):
+        for Cell in g.Cells:
+            Graphics = self.Grid[Cell]
+            Graphics.discard(g)
+            if not Graphics:
+                del self.Grid[Cell]
+        g.Cells = ()
+
+    def Reindex(self, g):
+        self.Unindex(g)
+        Bounds = g.Bounds
+        i0, j0, i1, j1 = self.CellRange(Bounds)
+        g.Cells = [(i, j) for i in xrange(i0, i1+1) for j in xrange(j0, j1+1)]
+        for Cell in g.Cells:
+            self.Grid.setdefault(Cell, set()).add(g)
+
+        if self.Extent is None:
+            self.Extent = list(Bounds)
+        else:
+            e = self.Extent
+            self.Extent = [min(e[0], Bounds[0]), min(e[1], Bounds[1]),
+                           max(e[2], Bounds[2]), max(e[3], Bounds[3])]
+        e = self.Extent
+        self.BoundingBox = BBox.asBBox(((e[0], e[1]), (e[2], e[3])))
+        if self._Canvas:
+            self._Canvas.BoundingBoxDirty = True
+        self._LiveBounds = None
+
+    # The graphics whose bounds overlap Bounds
+    def Query(self, Bounds):
+        i0, j0, i1, j1 = self.CellRange(Bounds)
+        Found = set()
+        if (i1-i0+1)*(j1-j0+1) > len(self.Grid):
+            for (i, j), Graphics in self.Grid.iteritems():
+                if i0 <= i <= i1 and j0 <= j <= j1:
+                    Found.update(Graphics)
+        else:
+            for i in xrange(i0, i1+1):
+                for j in xrange(j0, j1+1):
+                    Graphics = self.Grid.get((i, j))
+                    if Graphics:
+                        Found.update(Graphics)
+        return [g for g in Found if _Overlaps(g.Bounds, Bounds)]
+
+#---------------------------------------------------------------------------------------------#
+#    Live objects                                                                             #
+#---------------------------------------------------------------------------------------------#
+    def Acquire(self, g):
+        Objects = self.Pool.get(g.PoolKey())
+        if Objects:
+            Object = Objects.pop()
+            self.Pooled -= 1
+            g.Reuse(Object)
+            Instrument.Count('graphics_reused')
+        else:
+            Object = g.Make(self.InForeground)
+            Object._Canvas = self._Canvas
+            for Event in self.Handlers.get(g.Kind, ()):
+                Object.Bind(Event, self.Callbacks[Event])
+            Instrument.Count('graphics_made')
+        Object.Visible = g.Visible
+        Object.Graphic = g
+        g.Live = Object
+        self.Live.add(g)
+
+    def Release(self, g):
+        Object = g.Live
+        g.Live = None
+        self.Live.discard(g)
+        Object.Graphic = None
+        if self.Pooled < self.MaxPool:
+            self.Pool.setdefault(g.PoolKey(), []).append(Object)
+            self.Pooled += 1
+        else:
+            Object.UnBindAll()
+
+    # Makes the live objects match the graphics in the buffer
+    def Update(self, BufferBB):
+        Bounds = (BufferBB[0][0], BufferBB[0][1], BufferBB[1][0], BufferBB[1][1])
+        if Bounds == self._LiveBounds:
+            return
+        self._LiveBounds = Bounds
+        Wanted = self.Query(Bounds)
+        self._Overview = None
+        if len(Wanted) > self.MaxLive:
+            # Graphics that can't be clicked are the first to be drawn by the layer
+            Overview = [g for g in Wanted if g.Kind not in self.Handlers]
+            Wanted = [g for g in Wanted if g.Kind in self.Handlers]
+            if len(Wanted) > self.MaxLive:
+                Overview += Wanted
+                Wanted = []
+            Overview.sort(key=lambda g: g.Seq)
+            self._Overview = Overview
+        Keep = set(Wanted)
+        for g in [g for g in self.Live if g not in Keep]:
+            self.Release(g)
+        for g in Wanted:
+            if g.Live is None:
+                self.Acquire(g)
+
+    def DrawObjects(self, ViewPortBB):
+        self.Update(self._Canvas.ViewPortBB)
+        Bounds = (ViewPortBB[0][0], ViewPortBB[0][1], ViewPortBB[1][0], ViewPortBB[1][1])
+        Graphics = [g for g in self.Live if _Overlaps(g.Bounds, Bounds)]
+        Graphics.sort(key=lambda g: g.Seq)
+        Objects = [g.Live for g in Graphics]
+        if self._Overview is not None:
+            # Drawn after the live objects (labels over their nodes)
+            Objects.append(self)
+        return Objects
+
+    def NumObjects(self):
+        if self._Overview is not None:
+            return len(self.Live) + len(self._Overview)
+        return len(self.Live)
+
+    # Overview: the graphics of each class are drawn together, in the order of the classes'
+    # first graphics
+    def _Draw(self, dc, WorldToPixel, ScaleWorldToPixel, HTdc=None):
+        if not self._Overview:
+            return
+        Classes = []
+        Groups = {}
+        for g in self._Overview:
+            if g.Visible:
+                if g.__class__ not in Groups:
+                    Classes.append(g.__class__)
+                    Groups[g.__class__] = []
+                Groups[g.__class__].append(g)
+        for Class in Classes:
+            Class.DrawMany(Groups[Class], dc, WorldToPixel, ScaleWorldToPixel)
+        if Instrument.ENABLED:
+            Instrument.Count('graphics_overview', len(self._Overview))
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+'''
+Incremental, crash-safe saving of graphs.
+
+A graph is stored as a snapshot, the .graph file (a pickled [nodes, edges, metadata] list,
+as read by the other tools), and an append-only log of the changes made since the snapshot
+was written, in a file with the same name plus ".log". The log is a sequence of records:
+
+    ('snapshot', crc)               first record: crc32 of the snapshot the log applies to
+    ('edit', delta, undo)           a Journal delta, applied (undo=False) or reverted
+    ('meta', metadata)              new map metadata
+    ('compacted', crc, count)       the snapshot with this crc includes the first 'count'
+                                    'edit' and 'meta' records (see Compact())
+
+Every record is preceded by its length and crc32, so a record torn by a crash is detected
+and dropped, along with anything after it.
+
+Changes are kept in memory as they happen and appended to the log when the graph is saved,
+so a save costs O(changes since the last save) and unsaved changes never reach the disk.
+Once the log holds COMPACT_RECORDS records, Compact() (run as a background job) replays it
+onto the snapshot and replaces both files. Opening a graph reads the snapshot and replays
+the log.
+
+@author: jon
+'''
+
+import os
+import math
+import zlib
+import pickle
+import struct
+import threading
+import Instrument
+import GraphStructs as gs
+
+LOG_SUFFIX          = '.log'
+COMPACT_RECORDS     = 1000      # log records that make a graph worth compacting
+PICKLE_PROTOCOL     = pickle.HIGHEST_PROTOCOL
+FRAME               = struct.Struct('<II')     # record length, crc32 of the record
+
+def LogFilename(graph_filename):
+    return graph_filename + LOG_SUFFIX
+
+def Checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def Frame(record):
+    data = pickle.dumps(record, PICKLE_PROTOCOL)
+    return FRAME.pack(len(data), Checksum(data)) + data
+
+# Writes a whole file under a temporary name and renames it once it is on disk
+def WriteFile(filename, data):
+    tmp_filename = filename + ".tmp"
+    f = open(tmp_filename, 'wb')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp_filename, filename)
+
+#---------------------------------------------------------------------------------------------#
+#    Reads a log file, or its first 'limit' bytes. Returns (records, end): the records up to  #
+#    the first damaged one, and the offset just past the last good record. A missing log has  #
+#    no records.                                                                              #
+#---------------------------------------------------------------------------------------------#
+def ReadLog(filename, limit=-1):
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return [], 0
+    try:
+        data = f.read(limit)
+    finally:
+        f.close()
+
+    records = []
+    pos = 0
+    while pos + FRAME.size <= len(data):
+        length, crc = FRAME.unpack_from(data, pos)
+        start = pos + FRAME.size
+        body = data[start:start+length]
+        if len(body) < length or Checksum(body) != crc:
+            Instrument.Count('graph_log_torn')
+            break
+        records.append(pickle.loads(body))
+        pos = start + length
+    return records, pos
+
+#---------------------------------------------------------------------------------------------#
+#    Returns the 'edit' and 'meta' records of a log that still have to be applied to the      #
+#    snapshot with the given crc, or None if the log doesn't belong to that snapshot.         #
+#---------------------------------------------------------------------------------------------#
+def Entries(records, crc):
+    if not records or records[0][0] != 'snapshot':
+        return None
+    entries = [r for r in records[1:] if r[0] != 'compacted']
+    if records[0][1] == crc:
+        return entries
+
+    # A compaction wrote this snapshot but was interrupted before it replaced the log
+    for record in reversed(records):
+        if record[0] == 'compacted' and record[1] == crc:
+            return entries[record[2]:]
+    return None
+
+#---------------------------------------------------------------------------------------------#
+#    Opens a graph: reads the snapshot, replays its log and returns (graph, log), where log   #
+#    is an EditLog to record further changes in. Raises IOError if there is no snapshot.      #
+#---------------------------------------------------------------------------------------------#
+def Open(graph_filename):
+    span = Instrument.Span('OpenGraph')
+    f = open(graph_filename, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    graph = pickle.loads(data)
+    crc = Checksum(data)
+
+    log_filename = LogFilename(graph_filename)
+    records, end = ReadLog(log_filename)
+    entries = Entries(records, crc)
+    if entries is None:
+        log = EditLog(graph_filename, crc, graph[2])
+    else:
+        Replay(graph, entries)
+        if records[0][1] != crc:
+            # Finish the interrupted compaction, so that new records can be appended
+            end = WriteLog(log_filename, crc, entries)
+        log = EditLog(graph_filename, crc, graph[2], len(entries), end)
+    span.Stop()
+    return graph, log
+
+#---------------------------------------------------------------------------------------------#
+#    Writes a complete snapshot of a graph and returns a new EditLog for it. Any log left     #
+#    from an older graph with the same name is removed.                                       #
+#---------------------------------------------------------------------------------------------#
+def Create(graph_filename, graph):
+    span = Instrument.Span('WriteGraph')
+    data = pickle.dumps(graph, PICKLE_PROTOCOL)
+    WriteFile(graph_filename, data)
+    log_filename = LogFilename(graph_filename)
+    if os.path.exists(log_filename):
+        os.remove(log_filename)
+    span.Stop()
+    return EditLog(graph_filename, Checksum(data), graph[2])
+
+def WriteLog(filename, crc, entries):
+    data = Frame(('snapshot', crc)) + ''.join(Frame(entry) for entry in entries)
+    WriteFile(filename, data)
+    return len(data)
+
+# Compares metadata [width, resolution, origin, height] by value
+def MetadataKey(metadata):
+    width, res, origin = metadata[:3]
+    height = metadata[3] if len(metadata) > 3 else None
+    return (width, res, origin.x, origin.y, height)
+
+#---------------------------------------------------------------------------------------------#
+#    The log of one graph file. Add() is called for every change, Flush() when the graph is   #
+#    saved; Compact() may run on another thread at the same time.                             #
+#---------------------------------------------------------------------------------------------#
+class EditLog(object):
+    def __init__(self, graph_filename, crc, metadata, count=0, end=0):
+        self.graph_filename = graph_filename
+        self.log_filename = LogFilename(graph_filename)
+        self.crc = crc                  # crc32 of the current snapshot
+        self.count = count              # records in the log file
+        self.end = end                  # size of the log file (0: not written yet)
+        self.metadata = MetadataKey(metadata)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.compacting = threading.Lock()
+
+    def Add(self, delta, undo):
+        self.pending.append(('edit', delta, undo))
+
+    def NeedsCompaction(self):
+        return self.count >= COMPACT_RECORDS
+
+#---------------------------------------------------------------------------------------------#
+#    Appends the pending changes to the log and waits until they are on disk. Returns the     #
+#    number of records written.                                                               #
+#---------------------------------------------------------------------------------------------#
+    def Flush(self, metadata):
+        key = MetadataKey(metadata)
+        if key != self.metadata:
+            # The changes since the last save were made with the new metadata
+            self.pending.insert(0, ('meta', metadata))
+            self.metadata = key
+        if not self.pending:
+            return 0
+
+        span = Instrument.Span('FlushGraphLog')
+        entries, self.pending = self.pending, []
+        with self.lock:
+            if self.end == 0:
+                self.end = WriteLog(self.log_filename, self.crc, entries)
+            else:
+                data = ''.join(Frame(entry) for entry in entries)
+                f = open(self.log_filename, 'r+b')
+                try:
+                    # Anything past 'end' is a torn record
+                    f.seek(self.end)
+                    f.truncate()
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                self.end += len(data)
+            self.count += len(entries)
+        span.Stop()
+        return len(entries)
+
+#---------------------------------------------------------------------------------------------#
+#    Writes a new snapshot with the log replayed onto it, and starts a new log. Flush() can   #
+#    run meanwhile: the records it adds are carried over to the new log. At every point the   #
+#    files on disk open to the same graph:                                                    #
+#                                                                                             #
+#    1. the new snapshot is written under a temporary name                                    #
+#    2. a 'compacted' record is appended to the log, which lets it be used with either        #
+#       snapshot                                                                              #
+#    3. the new snapshot replaces the old one                                                 #
+#    4. the log is replaced by one with only the records made during the compaction           #
+#                                                                                             #
+#    Returns the number of records folded into the snapshot.                                  #
+#---------------------------------------------------------------------------------------------#
+    def Compact(self):
+        with self.compacting:
+            with self.lock:
+                crc, end = self.crc, self.end
+            if end == 0:
+                return 0
+
+            span = Instrument.Span('CompactGraph')
+            f = open(self.graph_filename, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            if Checksum(data) != crc:
+                raise IOError("%s was changed by another program" % self.graph_filename)
+            graph = pickle.loads(data)
+            # Only what was in the log when the compaction started
+            records, stop = ReadLog(self.log_filename, end)
+            entries = Entries(records, crc)
+            if not entries:
+                return 0
+            Replay(graph, entries)
+
+            data = pickle.dumps(graph, PICKLE_PROTOCOL)
+            new_crc = Checksum(data)
+            tmp_filename = self.graph_filename + ".tmp"
+            f = open(tmp_filename, 'wb')
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+            with self.lock:
+                records, self.end = ReadLog(self.log_filename)
+                tail = Entries(records, crc)[len(entries):]
+                f = open(self.log_filename, 'r+b')
+                try:
+                    f.seek(self.end)
+                    f.truncate()
+                    f.write(Frame(('compacted', new_crc, len(entries))))
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                os.rename(tmp_filename, self.graph_filename)
+                self.end = WriteLog(self.log_filename, new_crc, tail)
+                self.crc = new_crc
+                self.count = len(tail)
+            span.Stop()
+            Instrument.Count('graph_compactions')
+            return len(entries)
+
+#---------------------------------------------------------------------------------------------#
+#    Replays log entries onto a graph [nodes, edges, metadata], in place. This mirrors what   #
+#    MapFrame.ApplyEdit() does to the graph, without the graphics.                            #
+#---------------------------------------------------------------------------------------------#
+def Replay(graph, entries):
+    nodes, edges = graph[0], graph[1]
+    for entry in entries:
+        if entry[0] == 'meta':
+            graph[2] = entry[1]
+        else:
+            ApplyDelta(nodes, edges, graph[2], entry[1], entry[2])
+
+def ApplyDelta(nodes, edges, metadata, delta, undo):
+    res, origin = metadata[1], metadata[2]
+    kind = delta[0]
+    if kind == 'node':
+        if undo:
+            nodes.pop()
+        else:
+            nodes.append(MakeNode(len(nodes), delta[2], res, origin))
+    elif kind == 'edge':
+        if undo:
+            edges.pop()
+        else:
+            edges.append(MakeEdge(len(edges), delta[2], delta[3], nodes, res))
+    elif kind == 'delete':
+        if undo:
+            RestoreDeleted(nodes, edges, delta[1], delta[2], res, origin)
+        else:
+            DeleteIds(nodes, edges, [n[0] for n in delta[1]], [e[0] for e in delta[2]])
+    elif kind == 'move':
+        dx, dy = delta[2]
+        if undo:
+            dx, dy = -dx, -dy
+        moved = set(delta[1])
+        for ID in moved:
+            node = nodes[ID]
+            node.coords = node.coords[0]+dx, node.coords[1]+dy
+            node.m_coords = PixelsToMeters(node.coords, res, origin)
+        for edge in edges:
+            if int(edge.node1) in moved or int(edge.node2) in moved:
+                edge.length = Distance(nodes[int(edge.node1)].coords,
+                                       nodes[int(edge.node2)].coords)
+                edge.m_length = edge.length*res
+
+def MakeNode(ID, coords, res, origin):
+    node = gs.Node(ID, list(coords))
+    node.m_coords = PixelsToMeters(node.coords, res, origin)
+    return node
+
+def MakeEdge(ID, node1, node2, nodes, res):
+    length = Distance(nodes[int(node1)].coords, nodes[int(node2)].coords)
+    edge = gs.Edge(ID, str(node1), str(node2), length)
+    edge.m_length = length*res
+    return edge
+
+def PixelsToMeters(xy, res, origin):
+    return (xy[0]*res + origin.x, xy[1]*res + origin.y)
+
+def Distance(p1, p2):
+    return math.sqrt((float(p2[0])-float(p1[0]))**2 + (float(p2[1])-float(p1[1]))**2)
+
+def DeleteIds(nodes, edges, node_ids, edge_ids):
+    dead_nodes = set(node_ids)
+    dead_edges = set(edge_ids)
+    new_ids = {}
+    kept = []
+    for i, node in enumerate(nodes):
+        if i not in dead_nodes:
+            new_ids[i] = len(kept)
+            node.id = len(kept)
+            kept.append(node)
+    nodes[:] = kept
+    edges[:] = [edge for i, edge in enumerate(edges) if i not in dead_edges]
+    for j, edge in enumerate(edges):
+        edge.id = j
+        if new_ids[int(edge.node1)] != int(edge.node1):
+            edge.node1 = new_ids[int(edge.node1)]
+        if new_ids[int(edge.node2)] != int(edge.node2):
+            edge.node2 = new_ids[int(edge.node2)]
+
+# Puts deleted nodes [(id, coords)] and edges [(id, node1, node2)] back at their old ids
+def RestoreDeleted(nodes, edges, dead_nodes, dead_edges, res, origin):
+    if dead_nodes:
+        restored = set(n[0] for n in dead_nodes)
+        new_ids = [i for i in range(len(nodes)+len(dead_nodes)) if i not in restored]
+        for edge in edges:
+            if new_ids[int(edge.node1)] != int(edge.node1):
+                edge.node1 = new_ids[int(edge.node1)]
+            if new_ids[int(edge.node2)] != int(edge.node2):
+                edge.node2 = new_ids[int(edge.node2)]
+        for ID, coords in dead_nodes:
+            nodes.insert(ID, MakeNode(ID, coords, res, origin))
+        for j, node in enumerate(nodes):
+            node.id = j
+    for ID, node1, node2 in dead_edges:
+        edges.insert(ID, MakeEdge(ID, node1, node2, nodes, res))
+    for j, edge in enumerate(edges):
+        edge.id = j
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+'''
+Lightweight performance instrumentation: named timing spans, counters, frame statistics
+and a canvas overlay that shows the redraw rate.
+
+Instrumentation is off by default. Set the MAPVIEW_INSTRUMENT environment variable to a
+log file path (*.csv or *.json) to enable it at startup, or toggle the overlay with Alt+P.
+
+Spans always measure their elapsed time (so that verbose console output keeps working),
+but they are only recorded when instrumentation is enabled. Hot paths should guard their
+counters with "if Instrument.ENABLED:" so that the disabled cost is a single global lookup.
+
+@author: jon
+'''
+
+import os
+import json
+import time
+from collections import deque
+
+# Only the Overlay needs wx; the rest can be used without it (e.g. by GraphLog in tests)
+try:
+    import wx
+except ImportError:
+    wx = None
+
+LOG_MAX_BYTES   = 1024*1024     # size at which the log file is rotated
+LOG_BACKUPS     = 3             # number of rotated log files to keep
+FRAME_HISTORY   = 60            # number of frames used to compute the frame rate
+SNAPSHOT_PERIOD = 1.0           # seconds between counter snapshots in the log
+
+ENABLED = False
+
+spans = {}                      # name -> [calls, total time, last time, max time]
+counters = {}                   # name -> value
+frames = deque(maxlen=FRAME_HISTORY)   # (timestamp, frame cost)
+
+_log = None
+_last_snapshot = 0.0
+
+#---------------------------------------------------------------------------------------------#
+#    Turns instrumentation on or off. If a log file is given, spans, frames and periodic      #
+#    counter snapshots are written to it.                                                     #
+#---------------------------------------------------------------------------------------------#
+def Enable(log_file=None):
+    global ENABLED, _log
+    ENABLED = True
+    if log_file is not None and _log is None:
+        _log = RotatingLog(log_file)
+
+def Disable():
+    global ENABLED, _log
+    if _log is not None:
+        Snapshot()
+        _log.Close()
+        _log = None
+    ENABLED = False
+
+def Reset():
+    spans.clear()
+    counters.clear()
+    frames.clear()
+
+#---------------------------------------------------------------------------------------------#
+#    Times a named operation. Can be used as a context manager or started on creation and     #
+#    stopped explicitly with Stop().                                                          #
+#---------------------------------------------------------------------------------------------#
+class Span(object):
+    __slots__ = ('name', 'st', 'elapsed')
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = 0.0
+        self.st = time.time()
+
+    def __enter__(self):
+        self.st = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Stop()
+        return False
+
+    def Stop(self):
+        self.elapsed = time.time() - self.st
+        if ENABLED:
+            RecordSpan(self.name, self.elapsed)
+        return self.elapsed
+
+def RecordSpan(name, elapsed):
+    try:
+        s = spans[name]
+        s[0] += 1
+        s[1] += elapsed
+        s[2] = elapsed
+        s[3] = max(s[3], elapsed)
+    except KeyError:
+        spans[name] = [1, elapsed, elapsed, elapsed]
+    if _log is not None:
+        _log.Write('span', name, elapsed)
+
+def Count(name, n=1):
+    if not ENABLED:
+        return
+    counters[name] = counters.get(name, 0) + n
+
+#---------------------------------------------------------------------------------------------#
+#    Records the cost of one canvas redraw. Counters are written to the log at most once      #
+#    per SNAPSHOT_PERIOD so that the log does not grow with every hit test.                   #
+#---------------------------------------------------------------------------------------------#
+def RecordFrame(cost):
+    global _last_snapshot
+    now = time.time()
+    frames.append((now, cost))
+    counters['frames'] = counters.get('frames', 0) + 1
+    if _log is not None:
+        _log.Write('frame', 'Canvas.Draw', cost)
+        if now - _last_snapshot > SNAPSHOT_PERIOD:
+            _last_snapshot = now
+            Snapshot()
+
+def FrameStats():
+    '''
+    Returns (frames per second, cost of the last frame in seconds)
+    '''
+    if not frames:
+        return 0.0, 0.0
+    last_cost = frames[-1][1]
+    if len(frames) < 2:
+        return 0.0, last_cost
+    period = frames[-1][0] - frames[0][0]
+    if period <= 0:
+        return 0.0, last_cost
+    return (len(frames)-1) / period, last_cost
+
+def Snapshot():
+    if _log is None:
+        return
+    for name, value in counters.items():
+        _log.Write('counter', name, value)
+    _log.Flush()
+
+#---------------------------------------------------------------------------------------------#
+#    Log file that is rotated once it exceeds LOG_MAX_BYTES. The format (CSV or JSON lines)   #
+#    is chosen from the file extension.                                                       #
+#---------------------------------------------------------------------------------------------#
+class RotatingLog(object):
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.json = filename.endswith('.json')
+        self.f = None
+        self.Open()
+
+    def Open(self):
+        new_file = not os.path.exists(self.filename)
+        self.f = open(self.filename, 'a')
+        if new_file and not self.json:
+            self.f.write("time,kind,name,value\n")
+
+    def Write(self, kind, name, value):
+        if self.json:
+            self.f.write(json.dumps({'time':time.time(), 'kind':kind,
+                                     'name':name, 'value':value}) + "\n")
+        else:
+            self.f.write("%.6f,%s,%s,%s\n" % (time.time(), kind, name, value))
+        if self.f.tell() > self.max_bytes:
+            self.Rotate()
+
+    def Rotate(self):
+        self.f.close()
+        for i in range(self.backups-1, 0, -1):
+            src = "%s.%d" % (self.filename, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.filename, i+1))
+        os.rename(self.filename, "%s.1" % self.filename)
+        self.Open()
+
+    def Flush(self):
+        self.f.flush()
+
+    def Close(self):
+        self.f.close()
+
+#---------------------------------------------------------------------------------------------#
+#    Canvas overlay showing the redraw rate and the cost of the last frame. It is drawn by    #
+#    FloatCanvas in the same way as a grid (assign it to Canvas.GridOver).                    #
+#---------------------------------------------------------------------------------------------#
+class PerfOverlay(object):
+    def __init__(self, pos=(5,5)):
+        self.pos = pos
+        self.font = wx.Font(9, wx.FONTFAMILY_TELETYPE, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_BOLD)
+
+    def _Draw(self, dc, Canvas):
+        fps, cost = FrameStats()
+        lines = ["%5.1f fps   %6.1f ms" % (fps, cost*1000),
+                 "draws %-6d objects %d" % (counters.get('frames', 0),
+                                            counters.get('objects_drawn', 0)),
+                 "hit tests %-6d poses dropped %d" % (counters.get('hit_test_reads', 0),
+                                                     counters.get('poses_dropped', 0))]
+        dc.SetFont(self.font)
+        w, h = 0, 0
+        for line in lines:
+            lw, lh = dc.GetTextExtent(line)
+            w = max(w, lw)
+            h += lh
+        x, y = self.pos
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.Brush((0,0,0)))
+        dc.DrawRectangle(x, y, w+8, h+6)
+        dc.SetTextForeground((255,255,255))
+        for line in lines:
+            dc.DrawText(line, x+4, y+3)
+            y += dc.GetTextExtent(line)[1]
+
+if os.environ.get('MAPVIEW_INSTRUMENT'):
+    Enable(os.environ['MAPVIEW_INSTRUMENT'])
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+'''
+Undo/redo history of graph edits.
+
+Every change to the graph is recorded as a small delta (a node added, an edge added,
+nodes and edges deleted, nodes moved) rather than as a copy of the graph. The deltas
+of one user action (e.g. a node and the edges auto-connected to it) are grouped, so
+that Undo() reverts the whole action at once:
+
+    self.journal.Begin('Create edges')
+    ...                                     # each change calls self.journal.Record(delta)
+    self.journal.End()
+
+Begin/End pairs may be nested; only the outermost one closes the group. The Action()
+decorator wraps a method in such a pair. Undo() and Redo() hand the deltas to a function
+that applies them (see MapFrame.ApplyEdit), in reverse order for Undo().
+
+The history is bounded by the number of actions (UNDO_DEPTH) and by the total size of
+the deltas it holds (UNDO_BUDGET, counted in nodes and edges); the oldest actions are
+dropped first.
+
+If a 'log' function is given, it is called as log(delta, undo) for every change, including
+those made by Undo() and Redo(), so that the changes can be saved (see GraphLog.py).
+
+@author: jon
+'''
+
+import Instrument
+from collections import deque
+
+UNDO_DEPTH      = 100       # maximum number of actions that can be undone
+UNDO_BUDGET     = 200000    # maximum number of nodes and edges held by the history
+
+class Group(object):
+    __slots__ = ('label', 'deltas', 'cost')
+
+    def __init__(self, label):
+        self.label = label
+        self.deltas = []
+        self.cost = 0
+
+class Journal(object):
+    def __init__(self, depth=UNDO_DEPTH, budget=UNDO_BUDGET, log=None):
+        self.depth = depth
+        self.budget = budget
+        self.log = log
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.size = 0               # total cost of the groups on both stacks
+        self.group = None
+        self.level = 0
+        self.paused = 0
+
+    def Begin(self, label=None):
+        if self.level == 0:
+            self.group = Group(label)
+        self.level += 1
+
+    def End(self):
+        self.level -= 1
+        if self.level == 0:
+            group, self.group = self.group, None
+            if group.deltas:
+                self.Push(group)
+
+    # 'cost' is the number of nodes and edges held by the delta
+    def Record(self, delta, cost=1):
+        if self.paused:
+            return
+        if self.log is not None:
+            self.log(delta, False)
+        if self.group is None:
+            group = Group(None)
+            group.deltas.append(delta)
+            group.cost = cost
+            self.Push(group)
+        else:
+            self.group.deltas.append(delta)
+            self.group.cost += cost
+
+    def Push(self, group):
+        for old in self.redo_stack:
+            self.size -= old.cost
+        self.redo_stack = []
+        self.undo_stack.append(group)
+        self.size += group.cost
+        self.Trim()
+
+    def Trim(self):
+        while self.undo_stack and (len(self.undo_stack) > self.depth or
+                                   self.size > self.budget):
+            old = self.undo_stack.popleft()
+            self.size -= old.cost
+            Instrument.Count('undo_dropped')
+
+    def CanUndo(self):
+        return len(self.undo_stack) > 0 and self.level == 0
+
+    def CanRedo(self):
+        return len(self.redo_stack) > 0 and self.level == 0
+
+#---------------------------------------------------------------------------------------------#
+#    Reverts the latest action with apply(delta, undo=True). Returns its group, or None.      #
+#---------------------------------------------------------------------------------------------#
+    def Undo(self, apply):
+        if not self.CanUndo():
+            return None
+        group = self.undo_stack.pop()
+        self.paused += 1
+        try:
+            for delta in reversed(group.deltas):
+                apply(delta, True)
+                if self.log is not None:
+                    self.log(delta, True)
+        finally:
+            self.paused -= 1
+        self.redo_stack.append(group)
+        return group
+
+    def Redo(self, apply):
+        if not self.CanRedo():
+            return None
+        group = self.redo_stack.pop()
+        self.paused += 1
+        try:
+            for delta in group.deltas:
+                apply(delta, False)
+                if self.log is not None:
+                    self.log(delta, False)
+        finally:
+            self.paused -= 1
+        self.undo_stack.append(group)
+        return group
+
+    def Clear(self):
+        self.undo_stack.clear()
+        self.redo_stack = []
+        self.size = 0
+
+#---------------------------------------------------------------------------------------------#
+#    Method decorator: the changes made by the method (and by anything it calls) are undone   #
+#    together. The instance must have a 'journal' attribute.                                  #
+#---------------------------------------------------------------------------------------------#
+def Action(label):
+    def decorate(fn):
+        def wrapper(self, *args, **kwargs):
+            self.journal.Begin(label)
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                self.journal.End()
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return decorate
@@ -7,15 +7,28 @@ Created on May 30, 2013
 '''
 
 import wx 
+import os
 import pickle
 import math
 import time
 import Image
 import numpy as np
-import random as rand
 import threading as t
 import GraphStructs as gs
 import NavCanvas, FloatCanvas
+import GraphLayer
+import Instrument
+import Sampling
+import OccupancyStore
+import MapIO
+import Journal
+import Selection
+import GraphLog
+import ExportRenderer
+import GraphAnalysis
+import QueueThread
+import RoutePlanner
+import TourPlanner
 from wx.lib.floatcanvas.Utilities import BBox
 from TimerThread import TimerThread
 from datetime import datetime
@@ -42,10 +55,41 @@ NODE_BORDER_WIDTH   = 2
 EDGE_WIDTH          = 5
 ROBOT_DIAM          = 9
 ROBOT_BORDER_WIDTH  = 2
+OBSTACLE_DIAM_1     = 5     # obstacle points, in screen pixels
+OBSTACLE_DIAM_2     = 4     # inflated obstacle points, in screen pixels
 FONT_SIZE_1         = 4     # for one/two-digit numbers
 FONT_SIZE_2         = 3     # for three-digit numbers
 FONT_SIZE_3         = 6     # large font
 
+#----- Canvas -----#
+CANVAS_OVERSCAN     = 256   # pixels drawn around the window, so that short pans are blits
+
+#----- Obstacle overlay -----#
+OBSTACLE_PERIOD     = 0.2   # minimum seconds between two updates of an obstacle layer
+
+#----- Graph generation -----#
+SAMPLE_BATCH        = 256   # number of candidate node locations drawn at a time
+KNN_CHUNK           = 256   # number of nodes whose neighbors are searched at a time
+EDGE_CHECK_CHUNK    = 1024  # number of candidate edges checked against the map at a time
+
+#----- Route planning -----#
+TOUR_TIME_BUDGET    = 2.0   # seconds spent improving a tour (see TourPlanner)
+
+#----- Image export -----#
+EXPORT_SCALE        = 2     # default image pixels per map pixel (see ExportRenderer)
+EXPORT_SCALE_MAX    = 8
+
+#----- Edge traversal (see SetEdgeState) -----#
+EDGE_UNVISITED      = 0
+EDGE_CURRENT        = 1     # the robot is heading along the edge
+EDGE_VISITED        = 2
+VISITED_COLOR_MAX   = (10,95,20)    # color of the edges visited VISIT_COUNT_MAX+1 times or more
+VISIT_COUNT_MAX     = 8
+
+#----- Background jobs -----#
+JOB_WORKERS         = 1     # worker threads for analysis, tour planning and map conversion
+JOBS_BUSY           = "Busy with other background jobs; try again in a moment"
+
 class MapFrame(wx.Frame): 
 
     def __init__(self, *args, **kwargs): 
@@ -73,8 +117,10 @@ class MapFrame(wx.Frame):
         
         self.resolution = None
         self.origin = None
+        self.origin_yaw = 0.0
         self.robot = None
         self.image_width = None
+        self.image_height = None
         self.gg_const = self.GetParent().gg_const
         self.current_map = []
         
@@ -86,12 +132,19 @@ class MapFrame(wx.Frame):
         self.graphics_edges = []
         self.graphics_text = []
         self.graphics_route = []        
-        self.sel_nodes = []
-        self.sel_edges = [] 
+        self.sel_nodes = Selection.Selection()     # selected node ids, see Selection.py
+        self.sel_edges = Selection.Selection()
         self.route = []
+        self.route_hop = 0          # hop of the route being traveled (see HighlightDestination)
+        self.route_current = None
+        self.edge_state = np.zeros(0, dtype=np.uint8)       # per edge id, see SetEdgeState
+        self.edge_visits = np.zeros(0, dtype=np.uint32)
         
         self.obstacles_1 = None
         self.obstacles_2 = None
+        self.obs_pending = {}
+        self.obs_last = {}
+        self.obs_scheduled = set()
         self.arrows = None
         self.pe_graphic = None
         self.ng_graphic = None
@@ -99,6 +152,15 @@ class MapFrame(wx.Frame):
         self.curr_edge = None
         self.started_edge = False 
         self.known_px = 0   
+        self.occupancy = None
+        self.free_cells = None
+        self.img_limit_cache = None
+        self.map_version = 0
+        self.graph_version = 0
+        self.planner = None
+        self.jobs = QueueThread.JobQueue(JOB_WORKERS)
+        self.journal = Journal.Journal(log=self.LogEdit)
+        self.edit_log = None        # GraphLog.EditLog of the open .graph file, if any
         
         # Connection matrix data structure
         # See GenerateConnectionMatrix()
@@ -113,8 +175,10 @@ class MapFrame(wx.Frame):
         self.NavCanvas = NavCanvas.NavCanvas(self, 
                                      ProjectionFun = None, 
                                      BackgroundColor = "DARK GREY", 
+                                     Overscan = CANVAS_OVERSCAN,
                                      )
         self.Canvas = self.NavCanvas.Canvas
+        self.AddGraphLayers()
         
         # Bind canvas mouse events
         self.Bind(wx.EVT_CLOSE, self.OnClose)
@@ -140,6 +204,13 @@ class MapFrame(wx.Frame):
         id_obs = wx.NewId()
         id_auto_conn = wx.NewId()
         id_console = wx.NewId()
+        id_perf = wx.NewId()
+        id_analyze = wx.NewId()
+        id_route = wx.NewId()
+        id_tour = wx.NewId()
+        id_export = wx.NewId()
+        id_undo = wx.NewId()
+        id_redo = wx.NewId()
         
         wx.EVT_MENU(self, id_sel_all, self.SelectAll) 
         wx.EVT_MENU(self, id_desel_all, self.DeselectAll) 
@@ -156,12 +227,24 @@ class MapFrame(wx.Frame):
         wx.EVT_MENU(self, id_obs, self.SetObstacles)
         wx.EVT_MENU(self, id_auto_conn, self.SetAutoConnect)
         wx.EVT_MENU(self, id_console, self.SetConsoleOutput)
+        wx.EVT_MENU(self, id_perf, self.SetPerfOverlay)
+        wx.EVT_MENU(self, id_analyze, self.AnalyzeGraph)
+        wx.EVT_MENU(self, id_route, self.OnPreviewRoute)
+        wx.EVT_MENU(self, id_tour, self.PlanTour)
+        wx.EVT_MENU(self, id_export, self.OnExportImage)
+        wx.EVT_MENU(self, id_undo, self.Undo)
+        wx.EVT_MENU(self, id_redo, self.Redo)
         
         # Accelerator table for hotkeys
         self.accel_tbl = wx.AcceleratorTable([
                                               (wx.ACCEL_ALT, ord('B'), id_obs),
                                               (wx.ACCEL_ALT, ord('C'), id_console),
                                               (wx.ACCEL_ALT, ord('K'), id_auto_conn),
+                                              (wx.ACCEL_ALT, ord('P'), id_perf),
+                                              (wx.ACCEL_ALT, ord('A'), id_analyze),
+                                              (wx.ACCEL_ALT, ord('R'), id_route),
+                                              (wx.ACCEL_ALT, ord('T'), id_tour),
+                                              (wx.ACCEL_ALT, ord('E'), id_export),
                                               (wx.ACCEL_CTRL, ord('A'), id_sel_all),
                                               (wx.ACCEL_CTRL, ord('D'), id_desel_all),
                                               (wx.ACCEL_CTRL, ord('E'), id_create_edges),
@@ -171,8 +254,11 @@ class MapFrame(wx.Frame):
                                               (wx.ACCEL_CTRL, ord('R'), id_robot),
                                               (wx.ACCEL_CTRL, ord('S'), id_save),
                                               (wx.ACCEL_CTRL, ord('W'), id_close),
+                                              (wx.ACCEL_CTRL, ord('Y'), id_redo),
+                                              (wx.ACCEL_CTRL, ord('Z'), id_undo),
                                               (wx.ACCEL_CTRL|wx.ACCEL_SHIFT, ord('E'), id_sel_edges),
                                               (wx.ACCEL_CTRL|wx.ACCEL_SHIFT, ord('N'), id_sel_nodes),
+                                              (wx.ACCEL_CTRL|wx.ACCEL_SHIFT, ord('Z'), id_redo),
                                               (wx.ACCEL_NORMAL, wx.WXK_DELETE, id_del),
                                              ])
         self.SetAcceleratorTable(self.accel_tbl)  
@@ -203,6 +289,22 @@ class MapFrame(wx.Frame):
         self.SetModes('*', {'verbose': new_val })
         self.mf.sp.chk_co.SetValue(new_val)
         
+    def SetPerfOverlay(self, event):
+        # The overlay needs the frame statistics, so instrumentation is switched on with it.
+        # If it was already on (MAPVIEW_INSTRUMENT), it is left on when the overlay is hidden.
+        if self.Canvas.GridOver is None:
+            self.perf_enabled_here = not Instrument.ENABLED
+            Instrument.Enable()
+            self.Canvas.GridOver = Instrument.PerfOverlay()
+        else:
+            self.Canvas.GridOver = None
+            if getattr(self, 'perf_enabled_here', False):
+                Instrument.Disable()
+        if self.modes['verbose']:
+            print "Performance overlay {status}.".format(status="disabled" if 
+                                        self.Canvas.GridOver is None else "enabled")
+        self.Canvas.Draw()
+        
 #---------------------------------------------------------------------------------------------#    
 #    Hides the window instead of closing it when the X button is pressed                      #
 #---------------------------------------------------------------------------------------------#    
@@ -300,6 +402,33 @@ class MapFrame(wx.Frame):
         if len(self.sel_nodes)<1 and len(self.sel_edges)<1:
             rc_menu.Enable(23, False)
         
+        rc_menu.Append(24, 'Analyze Roadmap\tAlt+A')        
+        wx.EVT_MENU(self,24,self.AnalyzeGraph)
+        if len(self.nodelist) < 1:
+            rc_menu.Enable(24, False)
+        
+        rc_menu.Append(25, 'Preview Route\tAlt+R')        
+        wx.EVT_MENU(self,25,self.OnPreviewRoute)
+        if len(self.sel_nodes) != 2:
+            rc_menu.Enable(25, False)
+        
+        rc_menu.Append(26, 'Plan Tour\tAlt+T')        
+        wx.EVT_MENU(self,26,self.PlanTour)
+        if len(self.nodelist) < 2:
+            rc_menu.Enable(26, False)
+        
+        rc_menu.AppendSeparator()
+        
+        rc_menu.Append(27, '&Undo\tCtrl+Z')        
+        wx.EVT_MENU(self,27,self.Undo)
+        if not self.journal.CanUndo():
+            rc_menu.Enable(27, False)
+        
+        rc_menu.Append(28, '&Redo\tCtrl+Y')        
+        wx.EVT_MENU(self,28,self.Redo)
+        if not self.journal.CanRedo():
+            rc_menu.Enable(28, False)
+        
         rc_menu.AppendSeparator()
         
         rc_submenu1 = wx.Menu()
@@ -330,69 +459,86 @@ class MapFrame(wx.Frame):
         self.SetModes('KeyPress', {
                         'redraw':False, 
                       })
-        selection = list(set(self.sel_nodes))
-        edges_to_redraw = []
+        ids = self.sel_nodes.Ids().tolist()
         self.DeselectAll(None)
         
         step = 5
-        ew = EDGE_WIDTH
-        for item in selection:
-            ID = item.Name
-            node = self.nodelist[int(ID)]            
-            
-            if event.GetKeyCode() == wx.WXK_UP:
-                xy = node.coords[0], node.coords[1]+step
-                dxy = 0,step
-            elif event.GetKeyCode() == wx.WXK_DOWN:
-                xy = node.coords[0], node.coords[1]-step
-                dxy = 0,-step
-            elif event.GetKeyCode() == wx.WXK_LEFT:
-                xy = node.coords[0]-step, node.coords[1]
-                dxy = -step,0
-            elif event.GetKeyCode() == wx.WXK_RIGHT:
-                xy = node.coords[0]+step, node.coords[1]
-                dxy = step,0
-            else:
-                self.RestoreModes('KeyPress')  
-                self.Canvas.Draw(True)  
-                return    
-                 
+        if event.GetKeyCode() == wx.WXK_UP:
+            dxy = 0,step
+        elif event.GetKeyCode() == wx.WXK_DOWN:
+            dxy = 0,-step
+        elif event.GetKeyCode() == wx.WXK_LEFT:
+            dxy = -step,0
+        elif event.GetKeyCode() == wx.WXK_RIGHT:
+            dxy = step,0
+        else:
+            self.RestoreModes('KeyPress')  
+            self.Canvas.Draw(True)  
+            return    
+        
+        if ids:
+            self.MoveNodes(ids, dxy)
+            self.RecordEdit(('move', ids, dxy), len(ids))
+        self.PaintNodes(self.sel_nodes.Add(ids))
+        
+        self.Canvas.Draw(True)   
+        self.RestoreModes('KeyPress')       
+    
+#---------------------------------------------------------------------------------------------#    
+#    Moves the given nodes by dxy pixels and redraws the edges connected to them              #
+#---------------------------------------------------------------------------------------------#
+    def MoveNodes(self, ids, dxy):
+        edges_to_redraw = set()
+        for ID in ids:
+            node = self.nodelist[ID]
+            xy = node.coords[0]+dxy[0], node.coords[1]+dxy[1]
             node.coords = xy
             node.m_coords = self.PixelsToMeters(xy)
             
             # Flag edges for redrawing if they are connected to a node which will move
-            for idx,edge_id in enumerate(self.conn_matrix[int(ID)]):
+            for idx,edge_id in enumerate(self.conn_matrix[ID]):
                 if idx > len(self.nodelist):
                     break
-                if edge_id != -1 and idx != int(ID):
-                    edges_to_redraw.append( int(edge_id) )   
+                if edge_id != -1 and idx != ID:
+                    edges_to_redraw.add( int(edge_id) )   
                     
-            self.graphics_nodes[int(ID)].Move(dxy)
-            self.graphics_text[ int(ID)].Move(dxy)
+            self.graphics_nodes[ID].Move(dxy)
+            self.graphics_text[ID].Move(dxy)
+            self.graphics_nodes[ID].Coords = xy
             
             if self.modes['verbose']:
                 print "Moved node %s to location %s" % ( str(node.id), str(xy) )
-            self.SelectOneNode(self.graphics_nodes[int(ID)],False)
     
         # Redraw edges to correspond to the new coordinates of their endpoints 
         for edge_id in edges_to_redraw: 
-            n1 = self.nodelist[ int(self.edgelist[edge_id].node1) ]  
-            n2 = self.nodelist[ int(self.edgelist[edge_id].node2) ]
+            edge = self.edgelist[edge_id]
+            n1 = self.nodelist[ int(edge.node1) ]  
+            n2 = self.nodelist[ int(edge.node2) ]
+            edge.length = self.Distance(n1.coords, n2.coords)
+            edge.m_length = edge.length*self.resolution
             
-            self.Canvas.RemoveObject( self.graphics_edges[edge_id] )         
-            e = self.Canvas.AddLine((n1.coords, n2.coords), LineWidth=ew, LineColor=EDGE_COLOR)
-            e.Name = str(edge_id)
-            self.graphics_edges[edge_id] = e 
-            self.BindEvents( e, 'edge')
+            self.edge_layer.RemoveObject( self.graphics_edges[edge_id] )         
+            self.graphics_edges[edge_id] = self.DrawEdge(edge)
         
-        self.Canvas.Draw(True)   
-        self.RestoreModes('KeyPress')       
+        self.GraphChanged()
      
-    def BindEvents(self, obj, obj_type):
-        if obj_type == 'edge':
-            obj.Bind( FloatCanvas.EVT_FC_LEFT_DOWN, self.OnClickEdge) 
-            obj.Bind( FloatCanvas.EVT_FC_ENTER_OBJECT, self.OnMouseEnterEdge) 
-            obj.Bind( FloatCanvas.EVT_FC_LEAVE_OBJECT, self.OnMouseLeaveEdge)
+#---------------------------------------------------------------------------------------------#    
+#    Adds the layers that draw the graph: the edges under the robot and the route, the nodes  #
+#    and their labels over them. Canvas objects are only made for the nodes and edges near    #
+#    the window (see GraphLayer.py); the handlers get the graphics in graphics_nodes/edges.   #
+#---------------------------------------------------------------------------------------------#    
+    def AddGraphLayers(self):
+        self.edge_layer = GraphLayer.GraphLayer()
+        self.Canvas.AddObject(self.edge_layer)
+        self.edge_layer.Bind('edge', FloatCanvas.EVT_FC_LEFT_DOWN, self.OnClickEdge) 
+        self.edge_layer.Bind('edge', FloatCanvas.EVT_FC_ENTER_OBJECT, self.OnMouseEnterEdge) 
+        self.edge_layer.Bind('edge', FloatCanvas.EVT_FC_LEAVE_OBJECT, self.OnMouseLeaveEdge)
+        
+        self.node_layer = GraphLayer.GraphLayer(InForeground = True)
+        self.Canvas.AddObject(self.node_layer)
+        self.node_layer.Bind('node', FloatCanvas.EVT_FC_LEFT_DOWN, self.OnClickNode)
+        self.node_layer.Bind('node', FloatCanvas.EVT_FC_ENTER_OBJECT, self.OnMouseEnterNode)
+        self.node_layer.Bind('node', FloatCanvas.EVT_FC_LEAVE_OBJECT, self.OnMouseLeaveNode)
               
 #---------------------------------------------------------------------------------------------#    
 #    Adds a representation of the robot to the canvas. A grey robot means that its pose info  #
@@ -440,6 +586,10 @@ class MapFrame(wx.Frame):
         if self.robot is None:
             return
          
+        # A new pose arriving before the previous animation has finished replaces it
+        if Instrument.ENABLED and self.Timer.IsRunning():
+            Instrument.Count('poses_dropped')
+            
         try:    
             if metric:
                 self.destination = self.MetersToPixels(dest)
@@ -520,7 +670,9 @@ class MapFrame(wx.Frame):
                 self.arrow = a
             
         
-            self.Canvas.Draw(True)
+            # Only the foreground has changed: a large background frame that is still
+            # being drawn carries on, instead of starting over at every step
+            self.Canvas.Draw()
             wx.GetApp().Yield(True)
             self.TimeStep += 1
         
@@ -547,7 +699,7 @@ class MapFrame(wx.Frame):
             self.robot.SetFillColor(ROBOT_FILL_2)
         
             self.Timer.Stop()
-            self.Canvas.Draw(True) 
+            self.Canvas.Draw() 
             
 #---------------------------------------------------------------------------------------------#    
 #    Sends 2D Pose Estimate data to the ROS node to be published                              #
@@ -597,54 +749,67 @@ class MapFrame(wx.Frame):
         self.ros.Publish2DNavGoal(pose, orient)
         
 #---------------------------------------------------------------------------------------------#    
-#    Draws obstacles received from the robot's sensors. Unstable, currently unused.           #
+#    Draws the obstacles of the robot's local costmap ('obs') or its inflated obstacles       #
+#    ('inf'). Each layer is a single PointSet in the foreground which is reused between       #
+#    updates, so an update only redraws the foreground. Updates of a layer are applied at     #
+#    most once per OBSTACLE_PERIOD; the latest cells received in between are applied when     #
+#    the period is over.                                                                      #
 #---------------------------------------------------------------------------------------------#        
     def DrawObstacles(self, points, mode):
+        if points is None or self.origin is None or self.resolution is None:
+            return
+        self.obs_pending[mode] = points
+        wait = self.obs_last.get(mode, 0) + OBSTACLE_PERIOD - time.time()
+        if wait > 0:
+            if mode not in self.obs_scheduled:
+                self.obs_scheduled.add(mode)
+                wx.CallLater(int(wait*1000)+1, self.FlushObstacles, mode)
+            return
+        self.FlushObstacles(mode)
+        
+    def FlushObstacles(self, mode):
+        self.obs_scheduled.discard(mode)
+        points = self.obs_pending.pop(mode, None)
         if points is None:
             return
+        self.obs_last[mode] = time.time()
+        xy = self.ObstaclesToPixels(points)
         
-        if mode == 'inf': 
-            fc = OBSTACLE_COLOR_2
-            d = 4
-            if self.obstacles_2 is not None: 
-                try: 
-                    self.Canvas.RemoveObject(self.obstacles_2)                 
-                except ValueError:
-                    self.obstacles_2 = None   
+        if mode == 'inf':
+            layer = self.obstacles_2
         else:
-            fc = OBSTACLE_COLOR_1  
-            d = 5
-            if self.obstacles_1 is not None: 
-                try:
-                    self.Canvas.RemoveObject(self.obstacles_1) 
-                except ValueError:
-                    self.obstacles_1 = None   
-                            
-        obs = FloatCanvas.Group()
-        try:
-            for point in points:      
-                    x = int( self.MetersToPixels((point.x,0))[0] )
-                    y = int( self.MetersToPixels((point.y,0))[0] )
-                    p = FloatCanvas.Circle((x,y), d, FillColor=fc, LineColor=fc)
-                    p.Coords = (x,y)
-                    obs.AddObject(p)                    
+            layer = self.obstacles_1
             
-            self.Canvas.AddObject(obs)  
+        if layer is None:
+            if len(xy) == 0:
+                return
             if mode == 'inf':
-                self.obstacles_2 = obs 
+                layer = self.Canvas.AddPointSet(xy, Color=OBSTACLE_COLOR_2, 
+                                                Diameter=OBSTACLE_DIAM_2, InForeground=True)
+                self.obstacles_2 = layer
             else:
-                self.obstacles_1 = obs 
-            self.ShowObstacles( self.modes['obstacles'] )
-        except AttributeError:
-            pass
+                layer = self.Canvas.AddPointSet(xy, Color=OBSTACLE_COLOR_1, 
+                                                Diameter=OBSTACLE_DIAM_1, InForeground=True)
+                self.obstacles_1 = layer
+        elif len(xy) > 0:
+            layer.SetPoints(xy, copy=False)
+            
+        layer.Visible = self.modes['obstacles'] and len(xy) > 0
+        self.Canvas.Draw()
+        
+    # GridCells points (metres) to pixel coordinates, as an Nx2 array
+    def ObstaclesToPixels(self, points):
+        xy = np.array([(p.x, p.y) for p in points], dtype=float).reshape(-1, 2)
+        xy -= (self.origin.x, self.origin.y)
+        xy /= self.resolution
+        return xy
             
     def ShowObstacles(self, boolean):
-        try:
-            self.obstacles_1.Visible = boolean
-#             self.obstacles_2.Visible = boolean
-            self.Canvas.Draw(True)
-        except (ValueError, AttributeError):
-            pass
+        for layer in (self.obstacles_1, self.obstacles_2):
+            if layer is not None:
+                layer.Visible = boolean and len(layer.Points) > 0
+        self.Canvas.Draw(True)
+        
 #---------------------------------------------------------------------------------------------#    
 #    Event handler when the user clicks on the robot graphic.                                 #
 #---------------------------------------------------------------------------------------------#    
@@ -669,22 +834,38 @@ class MapFrame(wx.Frame):
         self.RestoreModes('Robot')
                         
 #---------------------------------------------------------------------------------------------#    
-#    Marks the robot's current goal node                                                      #
+#    Marks the robot's current goal node: the edge to it becomes the current edge, and the    #
+#    hop of the route (if it is part of the route) is highlighted.                            #
 #---------------------------------------------------------------------------------------------#             
     def HighlightDestination(self, dest):    
         if self.curr_dest is not None and dest != self.curr_dest: 
-            self.Canvas.RemoveObject(self.graphics_route[0])
-            self.graphics_route.pop(0) 
-            
             n1 = self.nodelist[self.curr_dest]
             n2 = self.nodelist[dest]
             e = int(self.conn_matrix[n1.id][n2.id])
-            lw = EDGE_WIDTH
-            lc = HIGHLIGHT_COLOR   
-            l = self.Canvas.AddLine( (n1.coords,n2.coords), LineWidth=lw, LineColor=lc)    
-            self.Canvas.Draw(True)
-            self.highlights.append(l)
-            self.curr_edge = e 
+            
+            # A goal that was given up before it was reached
+            prev = self.curr_edge
+            given_up = prev is not None and prev != e and self.GetEdgeState(prev) == EDGE_CURRENT
+            if given_up:
+                self.SetEdgeState(prev, EDGE_VISITED if self.edge_visits[prev] else EDGE_UNVISITED)
+            if e >= 0:
+                self.SetEdgeState(e, EDGE_CURRENT)
+                self.curr_edge = e
+            else:
+                # The nodes are not connected: there is no edge to mark, only a line to draw
+                l = self.Canvas.AddLine( (n1.coords,n2.coords), LineWidth=EDGE_WIDTH, 
+                                         LineColor=HIGHLIGHT_COLOR)
+                self.highlights.append(l)
+                self.curr_edge = None
+            
+            hop = self.FindRouteHop(self.curr_dest, dest)
+            if hop is not None:
+                self.graphics_route[0].SetColors(HIGHLIGHT_COLOR, [hop])
+                self.route_hop = hop
+            self.route_current = hop
+            # The edges are in the background, under the route: if the route is shown and no
+            # other edge has changed, only the foreground has to be redrawn
+            self.Canvas.Draw(hop is None or given_up or e < 0)
             if self.modes['verbose']: 
                 print "Heading from %s to %s (edge %s)" % (self.curr_dest, dest, e)
         else:
@@ -694,6 +875,19 @@ class MapFrame(wx.Frame):
             except (ValueError, AttributeError):
                 pass   
         self.curr_dest = dest     
+        
+    # Index of the first hop from n1 to n2 at or after the current one, or None
+    def FindRouteHop(self, n1, n2):
+        if self.graphics_route == []:
+            return None
+        ids = np.asarray(self.route, dtype=int)
+        hops = np.flatnonzero((ids[:-1] == n1) & (ids[1:] == n2))
+        later = hops[hops >= self.route_hop]
+        if len(later) > 0:
+            return int(later[0])
+        elif len(hops) > 0:
+            return int(hops[0])
+        return None
             
 #---------------------------------------------------------------------------------------------#    
 #    Change the color of the last edge traveled to show that it has been visited.             #
@@ -704,24 +898,77 @@ class MapFrame(wx.Frame):
             self.ng_graphic = None
         except (ValueError, AttributeError):
             pass         
-                    
+        
         if self.curr_edge is not None:
-            edge = self.edgelist[self.curr_edge]
-            coords1 = self.nodelist[int(edge.node1)].coords
-            coords2 = self.nodelist[int(edge.node2)].coords
-            lw = EDGE_WIDTH
-            lc = DESTINATION_COLOR 
-              
-            l = self.Canvas.AddLine( (coords1,coords2), LineWidth=lw, LineColor=lc)
-            self.highlights.append(l)               
-            
-        self.Canvas.Draw(True)
+            self.SetEdgeState(self.curr_edge, EDGE_VISITED, visit=True)
+        if self.route_current is not None:
+            self.graphics_route[0].SetColors(DESTINATION_COLOR, [self.route_current])
+        self.Canvas.Draw(self.route_current is None)
+
+#---------------------------------------------------------------------------------------------#    
+#    Traversal state of the edges during a tour, in two arrays indexed by edge id: the state  #
+#    (EDGE_UNVISITED, EDGE_CURRENT or EDGE_VISITED) and the number of visits. The edges show  #
+#    their state as their color, so a tour of any length adds nothing to the canvas.          #
+#---------------------------------------------------------------------------------------------#
+    def SetEdgeState(self, edge_id, state, visit=False):
+        if edge_id >= len(self.edge_state):
+            size = max(len(self.edgelist), edge_id+1)
+            self.edge_state = np.concatenate((self.edge_state, 
+                                    np.zeros(size-len(self.edge_state), dtype=np.uint8)))
+            self.edge_visits = np.concatenate((self.edge_visits, 
+                                    np.zeros(size-len(self.edge_visits), dtype=np.uint32)))
+        self.edge_state[edge_id] = state
+        if visit:
+            self.edge_visits[edge_id] += 1
+        if edge_id < len(self.graphics_edges):
+            obj = self.graphics_edges[edge_id]
+            if obj is not None and edge_id not in self.sel_edges:
+                obj.SetLineColor(self.EdgeColor(edge_id))
+    
+    def GetEdgeState(self, edge_id):
+        if edge_id < len(self.edge_state):
+            return self.edge_state[edge_id]
+        return EDGE_UNVISITED
+    
+    # Visited edges get darker with the number of visits
+    def EdgeColor(self, edge_id):
+        state = self.GetEdgeState(edge_id)
+        if state == EDGE_CURRENT:
+            return HIGHLIGHT_COLOR
+        elif state == EDGE_VISITED:
+            f = min(self.edge_visits[edge_id]-1, VISIT_COUNT_MAX) / float(VISIT_COUNT_MAX)
+            return tuple(int(round(c1 + f*(c2-c1))) 
+                         for c1, c2 in zip(DESTINATION_COLOR, VISITED_COLOR_MAX))
+        return EDGE_COLOR
+    
+    def ResetEdgeStates(self):
+        for edge_id in np.flatnonzero(self.edge_state):
+            self.edge_state[edge_id] = EDGE_UNVISITED
+            if edge_id < len(self.graphics_edges) and self.graphics_edges[edge_id] is not None:
+                if edge_id not in self.sel_edges:
+                    self.graphics_edges[edge_id].SetLineColor(EDGE_COLOR)
+        self.edge_visits[:] = 0
+        
+    # Follows a renumbering of the edges: 'keep' has one entry per old edge id
+    def CompactEdgeStates(self, keep):
+        n = min(len(keep), len(self.edge_state))
+        keep = np.asarray(keep[:n], dtype=bool)
+        self.edge_state = self.edge_state[:n][keep]
+        self.edge_visits = self.edge_visits[:n][keep]
+        
+    # Makes room for edges put back at the given ids (in increasing order), as unvisited
+    def InsertEdgeStates(self, ids):
+        at = np.asarray(ids, dtype=int) - np.arange(len(ids))
+        at = at[at <= len(self.edge_state)]
+        self.edge_state = np.insert(self.edge_state, at, 0)
+        self.edge_visits = np.insert(self.edge_visits, at, 0)
 
 #---------------------------------------------------------------------------------------------#    
 #    Displays the route created by node_traveller as a set of arrows. The color of each arrow #
 #    depends on how close it is to the start or the end of the route. Red = Start, Blue = End #
+#    A preview (see PreviewRoute) leaves the controls and the robot as they are.              #
 #---------------------------------------------------------------------------------------------#        
-    def DrawRoute(self, route, show):
+    def DrawRoute(self, route, show, preview=False):
         if route[0] == -1:
             print "End of tour."
             try:
@@ -746,98 +993,198 @@ class MapFrame(wx.Frame):
             self.OnClear()
                 
         self.route = route
-        tmp_edges = []  
-        
-        self.Enable(False) 
-        for btn in self.mp.buttons:
-            btn.Enable(False)
-        wx.Yield()
-        self.mp.btn_exit.Enable(True)
-        wx.Yield()
-        
-        sat = 255
-        desat = 0     
-        color = (desat, sat/2, sat)
-        color_flt = (desat, sat/2, sat)
-        
-        steps = len(route)-2
-        incr = min((2.25*sat)/steps, 30)
-        phase = 0        
-        
-        for idx,node in reversed(list(enumerate(route))):            
-            if (idx-1) >= 0:
-                try:
-                    n1_id = int(node)
-                    n2_id = int(route[idx-1])
-                    node1 = self.nodelist[n1_id]
-                    node2 = self.nodelist[n2_id]
-                except IndexError:
-                    print n1_id, n2_id
-            else:
-                break      
-            
-            edge_id = int( self.conn_matrix[n1_id][n2_id] )
-            
-            x1 = node1.coords[0]
-            y1 = node1.coords[1]
-            x2 = node2.coords[0]
-            y2 = node2.coords[1]  
-            
-            dx    = x2-x1
-            dy    = y2-y1
-            theta = math.atan2(dy,dx)
-            kx    = math.cos(theta)
-            ky    = math.sin(theta)
-            
-            xS = self.Round( x1+(( (NODE_DIAM+3)/2.0) *kx) )
-            yS = self.Round( y1+(( (NODE_DIAM+3)/2.0) *ky) )
-            xD = self.Round( x2-(( (NODE_DIAM+3)/2.0) *kx) )
-            yD = self.Round( y2-(( (NODE_DIAM+3)/2.0) *ky) )            
-            pS = (xS,yS)
-            pD = (xD,yD)
-
-            l = self.Canvas.AddArrowLine( (pD,pS), LineWidth = EDGE_WIDTH, LineColor = color,
-                                     ArrowHeadSize=10, InForeground=True)
-            self.graphics_route.insert(0,l)  
-            tmp_edges.append(edge_id)
-                        
-            if phase == 0:
-                color_flt =  ( color_flt[0], color_flt[1]-(2*incr), color_flt[2] )
-                color =  ( color_flt[0], self.Round(color_flt[1]), color_flt[2] )
-                
-                if color[1] <= desat:
-                    color_flt = (color_flt[0], desat, color_flt[2])
-                    color = (color[0], desat, color[2])
-                    phase = phase+1
-                      
-            if phase == 1:
-                color_flt =  ( (color_flt[0]+incr), color_flt[1], color_flt[2] )
-                color = ( self.Round(color_flt[0]), color_flt[1], color_flt[2] )
-                
-                if color[0] >= sat:
-                    color_flt = (sat, color_flt[1], color_flt[2])
-                    color = (sat, color[1], color[2])
-                    phase = phase+1
-            
-            if phase == 2:        
-                color_flt =  ( color_flt[0], color_flt[1], (color_flt[2]-incr) )
-                color =  ( color_flt[0], color_flt[1], self.Round(color_flt[2]) )
-                
-                if color[2] <= desat:
-                    color_flt = (color_flt[0], color_flt[1], desat)
-                    color = (color[0], color[1], desat)
-                    phase = phase+1
-                    
-
-        if not show:
-            for gr in self.graphics_route:
-                gr.Visible = True
+        self.route_hop = 0
+        self.route_current = None
+        
+        if not preview:
+            self.Enable(False) 
+            for btn in self.mp.buttons:
+                btn.Enable(False)
+            self.mp.btn_exit.Enable(True)
+        
+        # One arrow per hop, from node to node, stopping short of the node circles
+        coords = np.array([self.nodelist[int(n)].coords for n in route], dtype=float)
+        d = coords[1:] - coords[:-1]
+        length = np.hypot(d[:,0], d[:,1])
+        length[length == 0] = 1
+        offset = d / length[:,np.newaxis] * ((NODE_DIAM+3)/2.0)
+        segments = np.floor(np.hstack((coords[:-1] + offset, coords[1:] - offset)) + 0.5)
+        
+        layer = self.Canvas.AddArrowLineSet(segments.reshape(-1,2,2), 
+                                            self.RouteColors(len(segments)), 
+                                            LineWidth=EDGE_WIDTH, ArrowHeadSize=10, 
+                                            InForeground=True)
+        self.graphics_route = [layer]
+        
+        if preview:
+            self.Canvas.Draw(True)
+            return
         
         self.robot.Visible = False
         self.arrow.Visible = False
         self.Canvas.Draw(True)
-        self.RefreshNodes()
         self.SetModes('Route', {'running':True})
+        
+#---------------------------------------------------------------------------------------------#    
+#    Colors of the hops of a route, from red at the start to blue at the end: going back from #
+#    the end, green fades out (twice as fast), then red fades in, then blue fades out.        #
+#---------------------------------------------------------------------------------------------#  
+    def RouteColors(self, num_hops):
+        sat = 255.0
+        incr = min((2.25*sat)/max(num_hops-1, 1), 30)
+        s = (num_hops-1 - np.arange(num_hops)) * incr
+        r = np.clip(s - sat/4, 0, sat)
+        g = np.clip(sat/2 - 2*s, 0, sat)
+        b = np.clip(2.25*sat - s, 0, sat)
+        return np.floor(np.column_stack((r, g, b)) + 0.5).astype(np.uint8)
+
+#---------------------------------------------------------------------------------------------#    
+#    Plans the shortest route between two nodes in-process (no ROS needed) and shows it with  #
+#    DrawRoute(). The planner is kept until the graph changes, so repeated queries from the   #
+#    same start node reuse its search tree.                                                   #
+#---------------------------------------------------------------------------------------------#
+    def GraphChanged(self):
+        self.graph_version += 1
+        self.planner = None
+        
+    def GetRoutePlanner(self):
+        if self.planner is None:
+            self.planner = RoutePlanner.RoutePlanner(self.nodelist, self.edgelist)
+        return self.planner
+    
+    def OnPreviewRoute(self, event):
+        if len(self.sel_nodes) != 2:
+            self.SetStatusText("Select a start node and a goal node to preview a route")
+            return
+        start, goal = self.sel_nodes.Ids().tolist()
+        self.DeselectAll(None)
+        self.PreviewRoute(start, goal)
+        
+    def PreviewRoute(self, start, goal):
+        span = Instrument.Span('PreviewRoute')
+        route, cost = self.GetRoutePlanner().ShortestPath(start, goal)
+        span.Stop()
+        if route is None:
+            self.SetStatusText("No route from node %i to node %i" % (start, goal))
+            return None
+        
+        units = "m" if self.planner.metric else "px"
+        self.SetStatusText("Route from node %i to node %i: %i edges, %.2f %s" % 
+                           (start, goal, len(route)-1, cost, units))
+        if self.modes['verbose']:
+            print "Route: %s" % " -> ".join(str(n) for n in route)
+            print "Planned route. Time taken: %.4fs" % span.elapsed
+        if len(route) > 1:
+            self.DrawRoute(route, False, preview=True)
+            self.mp.ep.btn_rte.SetLabel('Hide Route')
+            self.mp.ep.btn_rte.Enable(True)
+        return route
+
+#---------------------------------------------------------------------------------------------#    
+#    Plans a tour of all the nodes (see TourPlanner), shows it and publishes it for the robot.#
+#    The tour starts at the selected node if there is exactly one, otherwise at the node      #
+#    closest to the robot. Planning runs on the worker queue; the result is dropped if the    #
+#    graph is edited in the meantime.                                                         #
+#---------------------------------------------------------------------------------------------#
+    def PlanTour(self, event):
+        if len(self.nodelist) < 2:
+            return
+        if len(self.sel_nodes) == 1:
+            start = self.sel_nodes[0]
+        elif self.robot is not None:
+            start = self.ClosestNode(self.robot.Coords)
+        else:
+            start = 0
+        self.DeselectAll(None)
+        
+        self.SetStatusText("Planning tour from node %i..." % start)
+        version = self.graph_version
+        job = QueueThread.Job(TourPlanner.PlanTour, 
+                              (self.GetRoutePlanner(), start, TOUR_TIME_BUDGET),
+                              kind='tour', coalesce=True, cancellable=True,
+                              on_done=lambda tour: self.OnTourPlanned(tour, version))
+        if not self.jobs.Submit(job):
+            self.SetStatusText(JOBS_BUSY)
+        
+    def OnTourPlanned(self, tour, version):
+        if version != self.graph_version:
+            self.SetStatusText("The graph changed while the tour was planned; plan it again")
+            return
+        summary = TourPlanner.Summary(tour)
+        self.SetStatusText(summary.split("\n")[0])
+        if self.modes['verbose']:
+            print summary
+            print "Tour: %s" % " -> ".join(str(n) for n in tour['route'])
+        
+        if len(tour['route']) > 1:
+            self.DrawRoute(tour['route'], False, preview=True)
+            self.mp.ep.btn_rte.SetLabel('Hide Route')
+            self.mp.ep.btn_rte.Enable(True)
+            if self.ros is not None:
+                self.ros.PublishTour(tour['route'])
+        return tour
+    
+    def ClosestNode(self, coords):
+        pts = np.array([node.coords for node in self.nodelist], dtype=float)
+        d = np.hypot(pts[:,0]-coords[0], pts[:,1]-coords[1])
+        return int(d.argmin())
+
+#---------------------------------------------------------------------------------------------#    
+#    Checks the connectivity and coverage of the graph (see GraphAnalysis) and highlights the #
+#    problems: nodes outside the largest connected component, articulation points and         #
+#    bridges. The highlights are removed with the Clear button. The analysis itself runs on   #
+#    the worker queue.                                                                        #
+#---------------------------------------------------------------------------------------------#
+    def AnalyzeGraph(self, event):
+        if len(self.nodelist) == 0:
+            return
+        self.SetStatusText("Analyzing roadmap...")
+        version = self.graph_version
+        st = time.time()
+        job = QueueThread.Job(GraphAnalysis.Analyze, 
+                              (list(self.nodelist), list(self.edgelist), self.GetOccupancyGrid()),
+                              kind='analysis', coalesce=True,
+                              on_done=lambda report: self.OnAnalysisDone(report, version, st))
+        if not self.jobs.Submit(job):
+            self.SetStatusText(JOBS_BUSY)
+        
+    def OnAnalysisDone(self, report, version, st):
+        if version != self.graph_version:
+            self.SetStatusText("The graph changed during the analysis; run it again")
+            return
+        self.ShowAnalysis(report)
+        
+        summary = GraphAnalysis.Summary(report)
+        self.SetStatusText(summary.split("\n")[0])
+        if self.modes['verbose']:
+            print summary
+            print "Analyzed graph. Time taken: %.3fs" % (time.time()-st)
+        
+    def ShowAnalysis(self, report):
+        for obj in self.highlights:
+            self.Canvas.RemoveObject(obj)
+        self.highlights = []
+        
+        for edge_id in report['bridges']:
+            edge = self.edgelist[edge_id]
+            l = self.Canvas.AddLine((self.nodelist[int(edge.node1)].coords, 
+                                     self.nodelist[int(edge.node2)].coords), 
+                                    LineWidth=EDGE_WIDTH, LineColor=HIGHLIGHT_COLOR)
+            self.highlights.append(l)
+            
+        for component in report['components'][1:]:
+            for node_id in component:
+                c = self.Canvas.AddCircle(self.nodelist[node_id].coords, NODE_DIAM*2, 
+                                          LineWidth=NODE_BORDER_WIDTH, LineColor=ERROR_COLOR, 
+                                          InForeground=True)
+                self.highlights.append(c)
+                
+        for node_id in report['articulation_points']:
+            c = self.Canvas.AddCircle(self.nodelist[node_id].coords, NODE_DIAM*2, 
+                                      LineWidth=NODE_BORDER_WIDTH, LineColor=HIGHLIGHT_COLOR, 
+                                      InForeground=True)
+            self.highlights.append(c)
+        self.Canvas.Draw(True)
 
 #---------------------------------------------------------------------------------------------#    
 #    Functions to display or hide the route created in DrawRoute()                            #
@@ -859,6 +1206,7 @@ class MapFrame(wx.Frame):
 #--------------------------------------------------------------------------------------------#    
 #     Creates a single node at the given coordinates                                         #
 #--------------------------------------------------------------------------------------------#    
+    @Journal.Action('Create node')
     def CreateNode(self, coords): 
         # coords are in float, but we need int values for pixels
         node_coords = [int(coords[0]), int(coords[1])]   
@@ -866,33 +1214,17 @@ class MapFrame(wx.Frame):
         node.m_coords = self.PixelsToMeters(node.coords)
         
         ID = str(len(self.nodelist))
-        xy = node_coords[0], node_coords[1]
-        diam = NODE_DIAM
-        lw = NODE_BORDER_WIDTH
-        lc = NODE_BORDER    
-        fc = NODE_FILL
-        if int(ID) < 100:  
-            fs = FONT_SIZE_1
-        else:
-            fs = FONT_SIZE_2   
         
         collision = self.DetectCollision(node)
         if collision < 0 or self.modes['load']:
                    
             # Draw the node on the canvas
-            c = self.Canvas.AddCircle(xy, diam, LineWidth=lw, LineColor=lc, FillColor=fc,
-                                      InForeground = True)
-            c.Bind(FloatCanvas.EVT_FC_LEFT_DOWN, self.OnClickNode)    # Make the node 'clickable'
-            c.Bind(FloatCanvas.EVT_FC_ENTER_OBJECT, self.OnMouseEnterNode)
-            c.Bind(FloatCanvas.EVT_FC_LEAVE_OBJECT, self.OnMouseLeaveNode)
+            c, t = self.DrawNode(node)
             self.graphics_nodes.append(c)
-            c.Name = ID
-            c.Coords = node_coords    
-        
-            t = self.Canvas.AddScaledText(ID, xy, Size=fs, Position="cc", 
-                                    Color=TEXT_COLOR, Weight=wx.BOLD, InForeground = True)
             self.graphics_text.append(t)               
             self.nodelist.append(node)
+            self.GraphChanged()
+            self.RecordEdit(('node', node.id, tuple(node_coords)))
             
             try:
                 # Tell the connection matrix that this node now exists
@@ -959,42 +1291,30 @@ class MapFrame(wx.Frame):
 
 #--------------------------------------------------------------------------------------------#    
 #    Creates edges between all selected nodes. Edges are be created in the order that the    #
-#    nodes were selected.                                                                    #
+#    nodes were selected. The order is read once: an edge that is refused is selected and    #
+#    deleted on its own, which clears the selection.                                         #
 #--------------------------------------------------------------------------------------------#         
+    @Journal.Action('Create edges')
     def CreateEdges(self, event):
         if len(self.sel_nodes) >= 2:
             
-            # Add the coordinates of the nodes to be connected to a list of points
-            points = []
-            for i in range(len(self.sel_nodes)): 
-                points.append( self.nodelist[ int(self.sel_nodes[i].Name) ].coords)  
+            # The ids of the nodes to be connected, in the order they were selected
+            ids = self.sel_nodes.Ids().tolist()
                 
             # Create the edges 
             lw = EDGE_WIDTH          
-            cl = EDGE_COLOR 
             if self.conn_matrix[0][0] == -1:
                 self.GenerateConnectionMatrix() 
                         
-            for j in range(len(points)-1): 
+            for j in range(len(ids)-1): 
                 
                 try:
-                    node1 = self.sel_nodes[j]
-                    node2 = self.sel_nodes[j+1]
+                    node1 = str(ids[j])
+                    node2 = str(ids[j+1])
                     
                     # Only create the edge if no edge exists between the selected points
-                    if int(self.conn_matrix[int(node1.Name)][int(node2.Name)]) < 0:
-                        edge = gs.Edge(len(self.edgelist), node1.Name, node2.Name, 
-                                      self.Distance(node1.Coords, node2.Coords))
-                        edge.m_length = edge.length*self.resolution
-                        self.edgelist.append(edge)
-                              
-                        e = self.Canvas.AddLine([points[j], points[j+1]], 
-                                                LineWidth = lw, LineColor = cl)
-                        e.Bind(FloatCanvas.EVT_FC_LEFT_DOWN, self.OnClickEdge)
-                        e.Bind(FloatCanvas.EVT_FC_ENTER_OBJECT, self.OnMouseEnterEdge)
-                        e.Bind(FloatCanvas.EVT_FC_LEAVE_OBJECT, self.OnMouseLeaveEdge)
-                        self.graphics_edges.append(e)                        
-                        e.Name = str(edge.id)
+                    if int(self.conn_matrix[ids[j]][ids[j+1]]) < 0:
+                        edge = self.AddEdge(node1, node2)
                         
                         if self.modes['auto_erase']:
                             md = self.MinDistanceToNode(edge) 
@@ -1005,10 +1325,11 @@ class MapFrame(wx.Frame):
                             if self.modes['verbose']:
                                 st = ("Did not create edge between nodes "
                                       "%s and %s (too close to node %s)")
-                                print st % (node1.Name, node2.Name, md[0])
+                                print st % (node1, node2, md[0])
                             
                             if self.modes['redraw']:
-                                l = self.Canvas.AddLine((node1.Coords, node2.Coords),
+                                l = self.Canvas.AddLine((self.nodelist[ids[j]].coords, 
+                                                         self.nodelist[ids[j+1]].coords),
                                     LineWidth=lw, LineColor=ERROR_COLOR, InForeground=True)
                                 self.Canvas.Draw(True)
                                 wx.Yield()
@@ -1024,7 +1345,6 @@ class MapFrame(wx.Frame):
                             self.SelectOneEdge(self.graphics_edges[edge.id], True)
                             self.DeleteSelection(None)
                         else:
-                            self.AddConnectionEntry(edge)                          
                             if self.modes['auto_intersections']:
                                 self.ConvertIntersections(edge)                                                        
                             if self.modes['verbose']:
@@ -1034,7 +1354,7 @@ class MapFrame(wx.Frame):
                     else:
                         if self.modes['verbose']:
                             print "Did not create edge between nodes %s and %s (already exists)" \
-                            % (node1.Name,node2.Name)
+                            % (node1,node2)
                             
                 except IndexError:
                     pass
@@ -1044,6 +1364,51 @@ class MapFrame(wx.Frame):
             self.DeselectAll(event)
             self.mp.SetSaveStatus(False)
 
+#--------------------------------------------------------------------------------------------#    
+#    Adds an edge between two nodes to the graph and the canvas, without going through the   #
+#    selection or any of the automatic checks (see CreateEdges for those). Returns the edge.  #
+#--------------------------------------------------------------------------------------------#
+    def AddEdge(self, node1, node2):
+        n1 = self.nodelist[int(node1)]
+        n2 = self.nodelist[int(node2)]
+        edge = gs.Edge(len(self.edgelist), str(node1), str(node2), 
+                       self.Distance(n1.coords, n2.coords))
+        edge.m_length = edge.length*self.resolution
+        self.edgelist.append(edge)
+        self.GraphChanged()
+        
+        self.graphics_edges.append(self.DrawEdge(edge))
+        self.AddConnectionEntry(edge)
+        self.RecordEdit(('edge', edge.id, int(node1), int(node2)))
+        return edge
+
+#--------------------------------------------------------------------------------------------#    
+#    Draws a node and its label on the canvas. Returns the circle and the text objects.      #
+#--------------------------------------------------------------------------------------------#
+    def DrawNode(self, node):
+        xy = node.coords[0], node.coords[1]
+        c = self.node_layer.AddCircle('node', xy, NODE_DIAM, LineWidth=NODE_BORDER_WIDTH, 
+                                      LineColor=NODE_BORDER, FillColor=NODE_FILL)
+        c.Name = str(node.id)
+        c.Coords = node.coords
+        return c, self.DrawLabel(node.id, xy)
+    
+    def DrawLabel(self, ID, xy):
+        if int(ID) < 100:  
+            fs = FONT_SIZE_1
+        else:
+            fs = FONT_SIZE_2   
+        return self.node_layer.AddScaledText('label', str(ID), xy, fs, Position="cc", 
+                                             Color=TEXT_COLOR, Weight=wx.BOLD)
+    
+    def DrawEdge(self, edge):
+        n1 = self.nodelist[int(edge.node1)]
+        n2 = self.nodelist[int(edge.node2)]
+        e = self.edge_layer.AddLine('edge', [n1.coords, n2.coords], LineWidth=EDGE_WIDTH, 
+                                    LineColor=self.EdgeColor(edge.id))
+        e.Name = str(edge.id)
+        return e
+
 #--------------------------------------------------------------------------------------------#    
 #    -deprecated-                                                                            #
 #--------------------------------------------------------------------------------------------#             
@@ -1090,34 +1455,27 @@ class MapFrame(wx.Frame):
 #     Returns True if a point is suitable for creation of a new node, False otherwise.       #
 #                                                                                            #
 #     coords: The point in question                                                          #
-#     w: minimum allowable distance between nodes and obstacles                              #
+#     w: minimum allowable distance between nodes and obstacles (and the map border)         #
 #     d: minimum allowable distance between any two nodes                                    #
 #--------------------------------------------------------------------------------------------#            
     def CheckNodeLocation(self, image_data, coords, w, d):
-        iw = self.image_width
         x = int(coords[0])
         y = int(coords[1])        
         
+        # Only the square around the node is read from the map (image_data is kept for
+        # compatibility; it is the data behind the occupancy store)
+        store = self.GetOccupancyStore()
+        if not store.Contains(x-w, y-w, x+w+1, y+w+1):
+            return False
+        win = store.Window(x-w, y-w, x+w+1, y+w+1, raw=True)
         if self.image_data_format is 'int':
-            for i in range(-w, w, 1):
-                if image_data[ (iw*(y-w)) + (x+i) ] != 0:
-                    return False
-                if image_data[ (iw*(y+w)) + (x+i) ] != 0:
-                    return False
-                if image_data[ (iw*(y+i)) + (x-w) ] != 0:
-                    return False
-                if image_data[ (iw*(y+i)) + (x+w) ] != 0:
-                    return False
-        elif self.image_data_format is 'byte':
-            for i in range(-w, w, 1):
-                if image_data[ (iw*(y-w)) + (x+i) ] != chr(230):
-                    return False
-                if image_data[ (iw*(y+w)) + (x+i) ] != chr(230):
-                    return False
-                if image_data[ (iw*(y+i)) + (x-w) ] != chr(230):
-                    return False
-                if image_data[ (iw*(y+i)) + (x+w) ] != chr(230):
-                    return False
+            free = 0
+        else:
+            free = OccupancyStore.FREE_BYTE
+        k = 2*w
+        if ((win[0,:k] != free).any() or (win[k,:k] != free).any() or 
+            (win[:k,0] != free).any() or (win[:k,k] != free).any()):
+            return False
         for node2 in self.nodelist:
             if self.Distance(coords, node2.coords) < d:
                 return False      
@@ -1271,6 +1629,7 @@ class MapFrame(wx.Frame):
 #--------------------------------------------------------------------------------------------#    
 #      Converts edge intersections into new nodes, if possible                               #
 #--------------------------------------------------------------------------------------------#     
+    @Journal.Action('Convert intersections')
     def ConvertIntersections(self, e1):
         self.SetModes('ConvertIntersections', {
                         'redraw':False, 
@@ -1433,8 +1792,10 @@ class MapFrame(wx.Frame):
 #     w: minimum distance from nodes to obstacles                                            #
 #     e: maximum edge length                                                                 #
 #--------------------------------------------------------------------------------------------#                    
+    @Journal.Action('Generate graph')
     def GenerateGraph(self, n, k, d, w, e):
         wx.BeginBusyCursor()
+        span = Instrument.Span('GenerateGraph')
         start = int(round(time.time()))
         self.ttime = datetime(100,1,1,0,0,0) 
         self.SetModes('GenerateGraph', {
@@ -1448,11 +1809,17 @@ class MapFrame(wx.Frame):
             self.DeleteSelection(None)        
         
         data = self.image_data
-        lim = self.FindImageLimit(data,4)        
-        b = lim[0]
-        t = lim[1]
-        l = lim[2]
-        r = lim[3]
+        lim = self.FindImageLimit()        
+        grid = self.GetOccupancyGrid()
+        sampler_name = self.gg_const.get('sampler', 'uniform')
+        if sampler_name == 'free':
+            free_cells = self.GetFreeCells(w)
+        else:
+            free_cells = None
+        sampler = Sampling.CreateSampler(sampler_name, grid, lim, self.gg_const.get('seed'), 
+                                         sigma=max(2*w, 5), free_cells=free_cells)
+        candidates = []
+        first_new = len(self.nodelist)
                 
         while len(self.nodelist) < n:
             now = int(round(time.time()))
@@ -1463,46 +1830,46 @@ class MapFrame(wx.Frame):
                 dlg.ShowModal() 
                 dlg.Destroy()
                 break
-                    
-            x = int( l + ((r-l)*rand.random()) )
-            y = int( b + ((t-b)*rand.random()) )
             
+            if not candidates:
+                # Candidates whose centre is not free are rejected in bulk before the
+                # (slower) perimeter and distance checks 
+                xs, ys = sampler.Sample(SAMPLE_BATCH)
+                free = grid[ys, xs] == Sampling.FREE
+                candidates = zip(xs[free].tolist(), ys[free].tolist())
+                candidates.reverse()
+                continue
+                    
+            x, y = candidates.pop()
             result = self.CheckNodeLocation(data, (x,y), w, d)
             if result is True:
-                if int(self.CreateNode( (x,y) )) == 1: # Node successfully created                  
-                    self.ConnectNeighbors(len(self.nodelist)-1, k, e, False)
-                       
+                self.CreateNode( (x,y) )
+        
+        # Connect all the new nodes at once 
+        self.ConnectNodes(range(first_new, len(self.nodelist)), k, e, False)
         self.Canvas.Draw(True) 
         
         # Restore saved states
         wx.EndBusyCursor()
-        end = time.time()
+        span.Stop()
         self.RestoreModes('GenerateGraph')
         if self.modes['verbose']:
-            print "Total time to generate graph: %s" % str((end-start))
-
-#--------------------------------------------------------------------------------------------#
-#     Find the distances from a given node 'node1' to all other nodes in the graph.          # 
-#                                                                                            #
-#     k: Number of nodes to return (function returns the 'k' closest nodes)                  #
-#     e: Maximum search radius                                                               #                                                               #
-#--------------------------------------------------------------------------------------------#     
-    def GetNodeDistances(self, node1, k, e):
-        distances = []
-        for node2 in self.nodelist:
-            d = self.Distance(node1.coords, node2.coords)
-            if d < e:
-                distances.append((d, node2.id))
-        
-        distances.sort(key=lambda tup: tup[0])
-        return distances[0:k+1]
+            print "Total time to generate graph: %.3fs" % span.elapsed
+            print "%i connected component(s)" % len(GraphAnalysis.ConnectedComponents(
+                                                        len(self.nodelist), self.edgelist))
+            print "Sampled %i candidate locations (%s sampler)" % (sampler.drawn, 
+                                                                  self.gg_const.get('sampler', 'uniform'))
 
 #--------------------------------------------------------------------------------------------#
 #     Event handler for Connect Nodes command. Passes arguments to ConnectNeighbors(..)      #
 #--------------------------------------------------------------------------------------------#    
+    @Journal.Action('Connect neighbors')
     def OnConnectNeighbors(self, event):
-        for node in self.sel_nodes:
-            self.ConnectNeighbors( int(node.Name), self.gg_const['k'], self.gg_const['e'], True)
+        node_ids = self.sel_nodes.Ids()
+        if len(node_ids) > 0:
+            if self.modes['verbose']:
+                print "Connecting neighbors for %i node(s)" % len(node_ids)
+            self.ConnectNodes(node_ids, self.gg_const['k'], self.gg_const['e'], True)
         self.DeselectAll(event)
     
 #--------------------------------------------------------------------------------------------#
@@ -1514,36 +1881,163 @@ class MapFrame(wx.Frame):
     def ConnectNeighbors(self, input_node, k, e, refresh): 
         if self.modes['verbose']:
             print "Connecting neighbors for node %s" % input_node
-        self.SetModes('ConnectNeighbors', {
+        self.ConnectNodes([input_node], k, e, refresh)
+
+#--------------------------------------------------------------------------------------------#
+#     Connection stage: connects every node in 'node_ids' to its k nearest neighbors that    #
+#     are closer than e. The neighbors of all the nodes are found at once, the candidate     #
+#     edges are checked against the map (and against nearby nodes if auto_erase is on) in   #
+#     bulk, and the accepted edges are added with AddEdge(), shortest first.                 #
+#--------------------------------------------------------------------------------------------#
+    def ConnectNodes(self, node_ids, k, e, refresh):
+        span = Instrument.Span('ConnectNodes')
+        self.SetModes('ConnectNodes', {
                         'redraw':False,
                         'auto_edges':False
                         })
         
-        data = self.image_data
-        node1 = self.nodelist[ input_node ]
-        distances = self.GetNodeDistances(node1, k, e)
-        
-        for entry in distances:                      
+        pairs = self.FindNeighborPairs(node_ids, k, e)
+        if len(pairs) > 0:
+            # Skip the pairs which are already connected
+            pairs = pairs[ self.conn_matrix[pairs[:,0], pairs[:,1]] < 0 ]
+        ok = self.CheckEdgeLocations(pairs)
+        if self.modes['auto_erase']:
+            ok &= ~self.EdgesNearNodes(pairs, max(self.gg_const['d']/2.0, 5))
+        
+        created = 0
+        for n1, n2 in pairs[ok].tolist():
+            # Converting an intersection can create the same edge again 
+            if self.conn_matrix[n1][n2] >= 0:
+                continue
+            edge = self.AddEdge(n1, n2)
+            created += 1
+            if self.modes['verbose']:
+                print "Created edge %s between nodes %s and %s" % (edge.id, n1, n2)
+            if self.modes['auto_intersections'] and self.FindIntersections(edge):
+                self.ConvertIntersections(edge)
+                
+        self.RestoreModes('ConnectNodes')
+        span.Stop()
+        if self.modes['verbose'] and len(node_ids) > 1:
+            print "Connected %i nodes: %i candidate edges, %i created. Time taken: %.3fs" % \
+                  (len(node_ids), len(pairs), created, span.elapsed)
+        if created > 0:
+            self.mp.SetSaveStatus(False)
+        if refresh and self.modes['redraw']:
+            self.Canvas.Draw(True)
+
+#--------------------------------------------------------------------------------------------#
+#     Returns an (M,2) array of node id pairs (lowest id first), each connecting a node in   #
+#     'node_ids' to one of its k nearest neighbors closer than e, sorted by length.          #
+#     Distances are computed KNN_CHUNK rows at a time to limit the size of the matrix.       #
+#--------------------------------------------------------------------------------------------#
+    def FindNeighborPairs(self, node_ids, k, e):
+        N = len(self.nodelist)
+        ids = np.asarray(node_ids, dtype=int)
+        k = min(k, N-1)
+        if len(ids) == 0 or k <= 0:
+            return np.zeros((0,2), dtype=int)
+        
+        pts = np.array([node.coords for node in self.nodelist], dtype=float)
+        keys = []
+        lengths = []
+        for start in range(0, len(ids), KNN_CHUNK):
+            chunk = ids[start:start+KNN_CHUNK]
+            rows = np.arange(len(chunk))
+            diff = pts[chunk][:,np.newaxis,:] - pts[np.newaxis,:,:]
+            dist = np.sqrt((diff**2).sum(axis=2))
+            dist[rows, chunk] = np.inf
+            dist[dist >= e] = np.inf
             
-            if entry[1] == input_node:
-                continue    # Skip the node if it's the same one we're at
+            nearest = np.argsort(dist, axis=1)[:,:k]
+            nd = dist[rows[:,np.newaxis], nearest].ravel()
+            a = np.repeat(chunk, k)
+            b = nearest.ravel()
+            found = np.isfinite(nd)
+            a, b, nd = a[found], b[found], nd[found]
+            keys.append(np.minimum(a,b)*N + np.maximum(a,b))
+            lengths.append(nd)
             
-            if entry[0] > e:
-                break       # Stop if the remaining edges are too far away
+        keys = np.concatenate(keys)
+        lengths = np.concatenate(lengths)
+        keys, first = np.unique(keys, return_index=True)
+        order = np.argsort(lengths[first], kind='mergesort')
+        keys = keys[order]
+        return np.column_stack((keys // N, keys % N))
+
+#--------------------------------------------------------------------------------------------#
+#     Vectorized version of CheckEdgeLocation() for an (M,2) array of node id pairs.         #
+#     Returns a boolean array, True where the edge can be created. Every edge is sampled at  #
+#     least once per pixel along its length (along both sides if spaced_edges is on).        #
+#--------------------------------------------------------------------------------------------#
+    def CheckEdgeLocations(self, pairs):
+        ok = np.ones(len(pairs), dtype=bool)
+        if len(pairs) == 0:
+            return ok
+        
+        grid = self.GetOccupancyGrid()
+        h, w = grid.shape
+        pts = np.array([node.coords for node in self.nodelist], dtype=float)
+        
+        for start in range(0, len(pairs), EDGE_CHECK_CHUNK):
+            p = pairs[start:start+EDGE_CHECK_CHUNK]
+            p1 = pts[p[:,0]]
+            p2 = pts[p[:,1]]
+            theta = np.arctan2(p2[:,1]-p1[:,1], p2[:,0]-p1[:,0])
+            ln = np.hypot(p2[:,1]-p1[:,1], p2[:,0]-p1[:,0])
+            kx = np.cos(theta)
+            ky = np.sin(theta)
             
-            node2 = self.nodelist[ entry[1] ]
-            if self.CheckEdgeLocation(data,node1.coords, 
-                                      node2.coords,1):    
-                self.DeselectAll(None)                     
-                self.SelectOneNode(self.graphics_nodes[node1.id], False)
-                self.SelectOneNode(self.graphics_nodes[node2.id], False)
-                self.CreateEdges(None)
+            if self.modes['spaced_edges']:
+                r = NODE_DIAM/2.0
+                starts = [p1 + r*np.column_stack((np.cos(theta+math.pi/2), np.sin(theta+math.pi/2))),
+                          p1 + r*np.column_stack((np.cos(theta-math.pi/2), np.sin(theta-math.pi/2)))]
+            else:
+                starts = [p1]
                 
-        self.RestoreModes('ConnectNeighbors')
+            steps = np.linspace(0, 1, int(math.ceil(ln.max()))+2)
+            pos = ln[:,np.newaxis]*steps[np.newaxis,:]
+            for s in starts:
+                x = (s[:,0][:,np.newaxis] + pos*kx[:,np.newaxis]).astype(int)
+                y = (s[:,1][:,np.newaxis] + pos*ky[:,np.newaxis]).astype(int)
+                cells = grid[np.clip(y, 0, h-1), np.clip(x, 0, w-1)]
+                if self.modes['unknown_edges']:
+                    blocked = cells == Sampling.OCCUPIED
+                else:
+                    blocked = cells != Sampling.FREE
+                ok[start:start+len(p)] &= ~blocked.any(axis=1)
+        return ok
+
+#--------------------------------------------------------------------------------------------#
+#     Vectorized version of MinDistanceToNode() for an (M,2) array of node id pairs.         #
+#     Returns a boolean array, True where a node other than the endpoints is closer than     #
+#     'thresh' to the edge.                                                                  #
+#--------------------------------------------------------------------------------------------#
+    def EdgesNearNodes(self, pairs, thresh):
+        near = np.zeros(len(pairs), dtype=bool)
+        if len(pairs) == 0:
+            return near
+        
+        pts = np.array([node.coords for node in self.nodelist], dtype=float)
+        chunk_size = max(1, (1<<20) // len(pts))
+        for start in range(0, len(pairs), chunk_size):
+            p = pairs[start:start+chunk_size]
+            a = pts[p[:,0]][:,np.newaxis,:]
+            ab = pts[p[:,1]][:,np.newaxis,:] - a
+            ap = pts[np.newaxis,:,:] - a
+            t = np.clip((ap*ab).sum(axis=2) / (ab**2).sum(axis=2), 0, 1)
+            closest = a + t[:,:,np.newaxis]*ab
+            dist = np.sqrt(((pts[np.newaxis,:,:] - closest)**2).sum(axis=2))
+            rows = np.arange(len(p))
+            dist[rows, p[:,0]] = np.inf
+            dist[rows, p[:,1]] = np.inf
+            near[start:start+len(p)] = (dist < thresh).any(axis=1)
+        return near
 
 #--------------------------------------------------------------------------------------------#    
 #      Deletes all selected nodes and edges                                                  #
 #--------------------------------------------------------------------------------------------#           
+    @Journal.Action('Delete selection')
     def DeleteSelection(self, event):
         self.SetModes('DeleteSelection', {
                         'redraw':False, 
@@ -1559,17 +2053,23 @@ class MapFrame(wx.Frame):
                 self.Canvas.GUIMode.start_coords = None
                 self.Canvas.GUIMode.EraseCurrentEdge()
                 self.Canvas.Draw(True)
-              
-        for node in self.sel_nodes:
-            self.RemoveNode(node)
-        for edge in self.sel_edges:
-            self.RemoveEdge(edge)
         
-        self.RenumberNodes()  
-        self.RenumberEdges()
-        self.GenerateConnectionMatrix()        
-        
-        self.DeselectAll(event=None)
+        # Record what is about to go (including the edges of the deleted nodes), with the
+        # ids it has now, so that it can be put back
+        node_mask = self.sel_nodes.Mask(len(self.nodelist))
+        edge_mask = self.sel_edges.Mask(len(self.edgelist))
+        ends = self.EdgeEnds()
+        dead_edges = edge_mask | node_mask[ends[:,0]] | node_mask[ends[:,1]]
+        node_ids = np.flatnonzero(node_mask).tolist()
+        nodes = [(ID, tuple(self.nodelist[ID].coords)) for ID in node_ids]
+        edges = [(ID, int(ends[ID,0]), int(ends[ID,1])) for ID in np.flatnonzero(dead_edges)]
+        if nodes or edges:
+            self.RecordEdit(('delete', nodes, edges), len(nodes)+len(edges))
+        
+        # The deleted nodes and edges need no recoloring
+        self.sel_nodes.Clear()
+        self.sel_edges.Clear()
+        self.DeleteIds(node_ids, np.flatnonzero(edge_mask).tolist())
         self.mp.SetSaveStatus(False)
         self.RestoreModes('DeleteSelection')
         
@@ -1583,9 +2083,9 @@ class MapFrame(wx.Frame):
     def RemoveNode(self, node):
         ID = int(node.Name)
         
-        self.Canvas.RemoveObject(self.graphics_nodes[ ID ])
+        self.node_layer.RemoveObject(self.graphics_nodes[ ID ])
         self.graphics_text [ ID ].Visible = False
-        self.Canvas.RemoveObject( self.graphics_text[ ID ] )
+        self.node_layer.RemoveObject( self.graphics_text[ ID ] )
         
         for i in range(len(self.conn_matrix[ID])):
             e = int(self.conn_matrix[ID][i])
@@ -1608,7 +2108,7 @@ class MapFrame(wx.Frame):
     def RemoveEdge(self, edge):  
         try:     
             ID = int(edge.Name)
-            self.Canvas.RemoveObject(self.graphics_edges[ID])                   
+            self.edge_layer.RemoveObject(self.graphics_edges[ID])                   
             self.edgelist[ID] = None
             self.graphics_edges[ID] = None  
             if self.modes['redraw']:
@@ -1630,6 +2130,7 @@ class MapFrame(wx.Frame):
         graphics = []
         text = []
         
+        self.sel_nodes.Compact([node is not None for node in self.nodelist])
         for i in range(len(self.nodelist)):             
             if self.nodelist[i] is not None:
                 self.nodelist[i].prev_id = i        # Save the old id for later use
@@ -1642,17 +2143,11 @@ class MapFrame(wx.Frame):
                  
                 nodes[j].id = j
                 graphics[j].Name = str(j)
-                if j < 100:  
-                    fs = FONT_SIZE_1
-                else:
-                    fs = FONT_SIZE_2
                 
                 # Make the old text invisible and replace it in the data structure
                 xy = (nodes[j].coords[0], nodes[j].coords[1])            
-                self.Canvas.RemoveObject(text[j])                
-                t = self.Canvas.AddScaledText(str(j), xy, Size=fs, Position="cc", 
-                        Color=TEXT_COLOR, Weight=wx.BOLD, InForeground = True)
-                text[j] = t
+                self.node_layer.RemoveObject(text[j])                
+                text[j] = self.DrawLabel(j, xy)
                 
                 for edge in self.edgelist:
                     if edge is not None:
@@ -1673,6 +2168,9 @@ class MapFrame(wx.Frame):
         edges = [] # temporary variables
         graphics = []
         
+        keep = [edge is not None for edge in self.edgelist]
+        self.sel_edges.Compact(keep)
+        self.CompactEdgeStates(keep)
         for i in range(len(self.edgelist)):             
             if self.edgelist[i] is not None:
                 edges.append(self.edgelist[i])
@@ -1726,6 +2224,178 @@ class MapFrame(wx.Frame):
         self.conn_matrix[ int(edge.node1) ][ int(edge.node2) ] = edge.id
         self.conn_matrix[ int(edge.node2) ][ int(edge.node1) ] = edge.id
         
+    # Makes room for n nodes in the connection matrix, keeping its entries in place
+    def GrowConnectionMatrix(self, n):
+        size = len(self.conn_matrix)
+        if n > size:
+            conn_mtx = np.empty(shape=(n+50, n+50))
+            conn_mtx[:] = -1
+            conn_mtx[:size, :size] = self.conn_matrix
+            self.conn_matrix = conn_mtx
+        
+#---------------------------------------------------------------------------------------------#    
+#    Undo/redo (see Journal.py). Graph changes are recorded by RecordEdit() as deltas:        #
+#                                                                                             #
+#    ('node', id, coords)        a node was added at the end of the node list                 #
+#    ('edge', id, node1, node2)  an edge was added at the end of the edge list                #
+#    ('delete', nodes, edges)    nodes [(id, coords)] and edges [(id, node1, node2)] were     #
+#                                deleted; ids are those from before the deletion              #
+#    ('move', ids, dxy)          nodes were moved by dxy                                      #
+#                                                                                             #
+#    Nothing is recorded while a graph is being loaded.                                       #
+#---------------------------------------------------------------------------------------------#
+    def RecordEdit(self, delta, cost=1):
+        if not self.modes['load']:
+            self.journal.Record(delta, cost)
+    
+    def Undo(self, event):
+        self.ReplayEdits(self.journal.Undo, "Undid")
+        
+    def Redo(self, event):
+        self.ReplayEdits(self.journal.Redo, "Redid")
+        
+    def ReplayEdits(self, step, verb):
+        self.DeselectAll(None)
+        self.SetModes('ReplayEdits', {
+                        'redraw':False, 
+                        })
+        group = step(self.ApplyEdit)
+        self.RestoreModes('ReplayEdits')
+        if group is None:
+            if self.modes['verbose']:
+                print "Nothing to %s" % ("undo" if step == self.journal.Undo else "redo")
+            return
+        
+        self.mp.SetSaveStatus(False)
+        self.Canvas.Draw(True)
+        if self.modes['verbose']:
+            print "%s '%s' (%i change(s))" % (verb, group.label or 'Edit', len(group.deltas))
+    
+    # Applies one delta, or reverts it if undo is True
+    def ApplyEdit(self, delta, undo):
+        kind = delta[0]
+        if kind == 'node':
+            if undo:
+                self.PopNode()
+            else:
+                self.AppendNode(delta[2])
+        elif kind == 'edge':
+            if undo:
+                self.PopEdge()
+            else:
+                self.AddEdge(delta[2], delta[3])
+        elif kind == 'delete':
+            if undo:
+                self.RestoreDeleted(delta[1], delta[2])
+            else:
+                self.DeleteIds([n[0] for n in delta[1]], [e[0] for e in delta[2]])
+        elif kind == 'move':
+            dx, dy = delta[2]
+            if undo:
+                dx, dy = -dx, -dy
+            self.MoveNodes(delta[1], (dx, dy))
+            
+    def AppendNode(self, coords):
+        node = gs.Node(len(self.nodelist), list(coords))
+        node.m_coords = self.PixelsToMeters(node.coords)
+        c, t = self.DrawNode(node)
+        self.nodelist.append(node)
+        self.graphics_nodes.append(c)
+        self.graphics_text.append(t)
+        self.GrowConnectionMatrix(len(self.nodelist))
+        self.conn_matrix[node.id][node.id] = 0
+        self.GraphChanged()
+        
+    # Removes the last node, which must not have any edges left
+    def PopNode(self):
+        ID = len(self.nodelist)-1
+        self.node_layer.RemoveObject(self.graphics_nodes.pop())
+        self.node_layer.RemoveObject(self.graphics_text.pop())
+        self.nodelist.pop()
+        self.conn_matrix[ID][ID] = -1
+        self.GraphChanged()
+        
+    def PopEdge(self):
+        edge = self.edgelist.pop()
+        self.edge_layer.RemoveObject(self.graphics_edges.pop())
+        self.CompactEdgeStates([True]*len(self.edgelist))
+        self.conn_matrix[ int(edge.node1) ][ int(edge.node2) ] = -1
+        self.conn_matrix[ int(edge.node2) ][ int(edge.node1) ] = -1
+        self.GraphChanged()
+        
+    # Deletes nodes and edges by id, as DeleteSelection() does
+    def DeleteIds(self, node_ids, edge_ids):
+        for ID in node_ids:
+            self.RemoveNode(self.graphics_nodes[ID])
+        for ID in edge_ids:
+            # Edges of deleted nodes are already gone (None)
+            self.RemoveEdge(self.graphics_edges[ID])
+        self.RenumberNodes()  
+        self.RenumberEdges()
+        self.GenerateConnectionMatrix()        
+        self.GraphChanged()
+        
+#---------------------------------------------------------------------------------------------#    
+#    Puts back deleted nodes and edges at their old ids. Only the nodes and edges after the   #
+#    first restored one are renumbered, and the connection matrix is only rebuilt if some     #
+#    ids have shifted; otherwise the restored entries are set directly.                       #
+#---------------------------------------------------------------------------------------------#
+    def RestoreDeleted(self, nodes, edges):
+        num_nodes = len(self.nodelist)
+        num_edges = len(self.edgelist)
+        first_node = nodes[0][0] if nodes else num_nodes
+        first_edge = edges[0][0] if edges else num_edges
+        shifted = first_node < num_nodes or first_edge < num_edges
+        
+        if first_node < num_nodes:
+            # New id of every existing node, for the edges which refer to them
+            keep = np.ones(num_nodes+len(nodes), dtype=bool)
+            keep[[n[0] for n in nodes]] = False
+            new_ids = np.flatnonzero(keep)
+            for edge in self.edgelist:
+                if int(edge.node1) >= first_node:
+                    edge.node1 = int(new_ids[int(edge.node1)])
+                if int(edge.node2) >= first_node:
+                    edge.node2 = int(new_ids[int(edge.node2)])
+        
+        for ID, coords in nodes:
+            node = gs.Node(ID, list(coords))
+            node.m_coords = self.PixelsToMeters(node.coords)
+            c, t = self.DrawNode(node)
+            self.nodelist.insert(ID, node)
+            self.graphics_nodes.insert(ID, c)
+            self.graphics_text.insert(ID, t)
+        for j in range(first_node, len(self.nodelist)):
+            node = self.nodelist[j]
+            if node.id != j:
+                node.id = j
+                self.graphics_nodes[j].Name = str(j)
+                self.node_layer.RemoveObject(self.graphics_text[j])
+                self.graphics_text[j] = self.DrawLabel(j, node.coords)
+        
+        self.InsertEdgeStates([e[0] for e in edges])
+        for ID, node1, node2 in edges:
+            n1 = self.nodelist[node1]
+            n2 = self.nodelist[node2]
+            edge = gs.Edge(ID, str(node1), str(node2), self.Distance(n1.coords, n2.coords))
+            edge.m_length = edge.length*self.resolution
+            self.edgelist.insert(ID, edge)
+            self.graphics_edges.insert(ID, self.DrawEdge(edge))
+        for j in range(first_edge, len(self.edgelist)):
+            if self.edgelist[j].id != j:
+                self.edgelist[j].id = j
+                self.graphics_edges[j].Name = str(j)
+        
+        self.GrowConnectionMatrix(len(self.nodelist))
+        if shifted:
+            self.GenerateConnectionMatrix()
+        else:
+            for ID, coords in nodes:
+                self.conn_matrix[ID][ID] = 0
+            for ID, node1, node2 in edges:
+                self.AddConnectionEntry(self.edgelist[ID])
+        self.GraphChanged()
+        
 #--------------------------------------------------------------------------------------------#    
 #     For debugging purposes. Writes the connection matrix to a text file.                   #
 #--------------------------------------------------------------------------------------------#    
@@ -1887,7 +2557,7 @@ class MapFrame(wx.Frame):
     def SelectOneNode(self, obj, desel):
         if desel:      
             self.DeselectAll(event=None)      
-        self.sel_nodes.append(obj) 
+        self.sel_nodes.Add([int(obj.Name)]) 
         obj.SetFillColor(SELECT_COLOR)
         if self.modes['redraw']:
             self.Canvas.Draw(True)
@@ -1898,21 +2568,101 @@ class MapFrame(wx.Frame):
     def SelectOneEdge(self, obj, desel):
         if desel:     
             self.DeselectAll(event=None)    
-        self.sel_edges.append(obj)
+        self.sel_edges.Add([int(obj.Name)])
         obj.SetLineColor(SELECT_COLOR)
         if self.modes['redraw']:
             self.Canvas.Draw(True) 
             
+#---------------------------------------------------------------------------------------------#    
+#    Recolors the given nodes/edges after a change of the selection, in one pass: selected    #
+#    ones in SELECT_COLOR, the others in their normal color. The canvas is not redrawn.       #
+#---------------------------------------------------------------------------------------------#
+    def PaintNodes(self, ids):
+        selected = self.sel_nodes.Mask(len(self.graphics_nodes))
+        for ID in ids:
+            if ID < len(self.graphics_nodes) and self.graphics_nodes[ID] is not None:
+                if selected[ID]:
+                    self.graphics_nodes[ID].SetFillColor(SELECT_COLOR)
+                else:
+                    self.graphics_nodes[ID].SetFillColor(NODE_FILL)
+                    
+    def PaintEdges(self, ids):
+        selected = self.sel_edges.Mask(len(self.graphics_edges))
+        for ID in ids:
+            if ID < len(self.graphics_edges) and self.graphics_edges[ID] is not None:
+                if selected[ID]:
+                    self.graphics_edges[ID].SetLineColor(SELECT_COLOR)
+                else:
+                    self.graphics_edges[ID].SetLineColor(self.EdgeColor(ID))
+    
+#---------------------------------------------------------------------------------------------#    
+#    Selects the nodes and edges whose entries are True in node_mask and edge_mask (boolean   #
+#    arrays indexed by id; None selects nothing). Unless 'add' is True, everything else is    #
+#    deselected. Only the nodes and edges that change are recolored.                          #
+#---------------------------------------------------------------------------------------------#
+    def SelectMasks(self, node_mask=None, edge_mask=None, add=False):
+        if add:
+            old_nodes = old_edges = np.zeros(0, dtype=int)
+        else:
+            old_nodes = self.sel_nodes.Clear()
+            old_edges = self.sel_edges.Clear()
+        new_nodes = new_edges = np.zeros(0, dtype=int)
+        if node_mask is not None:
+            new_nodes = self.sel_nodes.Add(np.flatnonzero(node_mask))
+        if edge_mask is not None:
+            new_edges = self.sel_edges.Add(np.flatnonzero(edge_mask))
+        
+        # Nodes and edges that stay selected are left as they are
+        self.PaintNodes(np.setxor1d(old_nodes, new_nodes))
+        self.PaintEdges(np.setxor1d(old_edges, new_edges))
+    
+    # End node ids of every edge, as an (m, 2) array indexed by edge id
+    def EdgeEnds(self):
+        ends = [(int(edge.node1), int(edge.node2)) for edge in self.edgelist]
+        return np.array(ends, dtype=int).reshape(-1, 2)
+
+#---------------------------------------------------------------------------------------------#    
+#    Attributes of the nodes and edges as arrays indexed by id, for selections by condition   #
+#    (see SelectWhere). Nodes: 'coords' (n, 2) and 'degree'. Edges: 'ends' (m, 2),            #
+#    'midpoints' (m, 2), 'length' (pixels), 'state' (see SetEdgeState) and 'visits'.          #
+#---------------------------------------------------------------------------------------------#
+    def GraphArrays(self):
+        coords = np.array([node.coords for node in self.nodelist], dtype=float).reshape(-1, 2)
+        ends = self.EdgeEnds()
+        m = len(ends)
+        state = np.zeros(m, dtype=np.uint8)
+        visits = np.zeros(m, dtype=np.uint32)
+        n = min(m, len(self.edge_state))
+        state[:n] = self.edge_state[:n]
+        visits[:n] = self.edge_visits[:n]
+        # numpy < 1.14 rejects minlength=0
+        degree = np.bincount(ends.ravel(), minlength=max(len(coords), 1))[:len(coords)]
+        return {'coords': coords,
+                'degree': degree,
+                'ends': ends,
+                'midpoints': (coords[ends[:,0]] + coords[ends[:,1]]) / 2.0,
+                'length': np.array([edge.length for edge in self.edgelist], dtype=float),
+                'state': state,
+                'visits': visits}
+    
+#---------------------------------------------------------------------------------------------#    
+#    Selects by condition: 'nodes' and 'edges' are functions of GraphArrays() which return a  #
+#    boolean array, e.g. to select the dead ends and the edges longer than 50 pixels:         #
+#        self.SelectWhere(lambda a: a['degree'] == 1, lambda a: a['length'] > 50)             #
+#---------------------------------------------------------------------------------------------#
+    def SelectWhere(self, nodes=None, edges=None, add=False):
+        arrays = self.GraphArrays()
+        node_mask = nodes(arrays) if nodes is not None else None
+        edge_mask = edges(arrays) if edges is not None else None
+        self.SelectMasks(node_mask, edge_mask, add)
+        if self.modes['redraw']:
+            self.Canvas.Draw(True)
+        
 #--------------------------------------------------------------------------------------------#    
 #     Selects all nodes and deselects everything else.                                       #
 #--------------------------------------------------------------------------------------------#        
     def SelectNodes(self, event):
-        self.DeselectAll(event)
-        
-        # Set highlighted colour
-        for node in self.nodelist:
-            self.graphics_nodes[ node.id ].SetFillColor(SELECT_COLOR)
-            self.sel_nodes.append(self.graphics_nodes[node.id])                
+        self.SelectMasks(np.ones(len(self.nodelist), dtype=bool), None)
         if self.modes['redraw']:    
             self.Canvas.Draw(True) 
                 
@@ -1923,12 +2673,7 @@ class MapFrame(wx.Frame):
 #     Selects all edges and deselects everything else.                                       #
 #--------------------------------------------------------------------------------------------#    
     def SelectEdges(self, event):
-        self.DeselectAll(event)
-            
-        # Set highlighted colour
-        for edge in self.edgelist:
-            self.graphics_edges[ edge.id ].SetLineColor(SELECT_COLOR)
-            self.sel_edges.append(self.graphics_edges[edge.id])
+        self.SelectMasks(None, np.ones(len(self.edgelist), dtype=bool))
         if self.modes['redraw']:    
             self.Canvas.Draw(True)
                 
@@ -1938,47 +2683,40 @@ class MapFrame(wx.Frame):
 
 #--------------------------------------------------------------------------------------------#
 #     Selects all nodes/edges located within a given X and Y range. This is used with the    #
-#     'box selection' tool on the NavCanvas.                                                   #
+#     'box selection' tool on the NavCanvas. Edges are selected by their midpoint.           #
 #--------------------------------------------------------------------------------------------#           
     def SelectBox(self, x_range, y_range):
-        self.SetModes('SelectBox', {
-                        'redraw':False
-                        })
-        self.DeselectAll(None)
-        
-        for node in self.nodelist:
-            if( (x_range[0] <= node.coords[0] <= x_range[1] or
-                 x_range[1] <= node.coords[0] <= x_range[0]) and
-                (y_range[0] <= node.coords[1] <= y_range[1] or
-                 y_range[1] <= node.coords[1] <= y_range[0]) ):
-                self.SelectOneNode(self.graphics_nodes[node.id], False)
-        for edge in self.edgelist:
-            n1 = self.nodelist[ int(edge.node1) ]
-            n2 = self.nodelist[ int(edge.node2) ]
-            mp = self.Midpoint(n1.coords, n2.coords)
-            if( (x_range[0] <= mp[0] <= x_range[1] or
-                 x_range[1] <= mp[0] <= x_range[0]) and
-                (y_range[0] <= mp[1] <= y_range[1] or
-                 y_range[1] <= mp[1] <= y_range[0]) ):
-                self.SelectOneEdge(self.graphics_edges[edge.id], False)
-        
-        self.RestoreModes('SelectBox')
+        lo = np.array((min(x_range), min(y_range)), dtype=float)
+        hi = np.array((max(x_range), max(y_range)), dtype=float)
+        arrays = self.GraphArrays()
+        nodes = ((arrays['coords'] >= lo) & (arrays['coords'] <= hi)).all(axis=1)
+        edges = ((arrays['midpoints'] >= lo) & (arrays['midpoints'] <= hi)).all(axis=1)
+        self.SelectMasks(nodes, edges)
         self.Canvas.Draw(True)
         
+#--------------------------------------------------------------------------------------------#
+#     Selects all nodes/edges inside a polygon (a list of points, closed automatically).     #
+#     Edges are selected by their midpoint.                                                  #
+#--------------------------------------------------------------------------------------------#           
+    def SelectLasso(self, points, add=False):
+        arrays = self.GraphArrays()
+        nodes = Selection.PointsInPolygon(arrays['coords'], points)
+        edges = Selection.PointsInPolygon(arrays['midpoints'], points)
+        self.SelectMasks(nodes, edges, add)
+        if self.modes['redraw']:
+            self.Canvas.Draw(True)
+        
 #--------------------------------------------------------------------------------------------#    
 #     Select/deselect all nodes and edges                                                    #
 #--------------------------------------------------------------------------------------------#             
     def SelectAll(self, event):                    
         self.DeselectAll(event)   
-          
-        for node in self.nodelist:                
-            if event is not None:   
-                self.graphics_nodes[ node.id ].SetFillColor(SELECT_COLOR)
-            self.sel_nodes.append(self.graphics_nodes[node.id])
-        for edge in self.edgelist:
-            if event is not None:   
-                self.graphics_edges[ edge.id ].SetLineColor(SELECT_COLOR)
-            self.sel_edges.append(self.graphics_edges[edge.id])            
+        
+        nodes = self.sel_nodes.Add(np.arange(len(self.nodelist)))
+        edges = self.sel_edges.Add(np.arange(len(self.edgelist)))
+        if event is not None:   
+            self.PaintNodes(nodes)
+            self.PaintEdges(edges)
         if self.modes['redraw']:    
             self.Canvas.Draw(True) 
         
@@ -1986,25 +2724,21 @@ class MapFrame(wx.Frame):
             print "Selected all nodes and edges"
             
     def DeselectAll(self, event):
-        for obj in self.sel_nodes:
-            obj.SetFillColor(NODE_FILL)
-        for obj in self.sel_edges:
-            obj.SetLineColor(EDGE_COLOR) 
+        self.PaintNodes(self.sel_nodes.Clear())
+        self.PaintEdges(self.sel_edges.Clear())
         if self.modes['redraw']:            
             self.Canvas.Draw(True)                
-        self.sel_nodes = []
-        self.sel_edges = []  
 
 #--------------------------------------------------------------------------------------------#    
 #     Event when a node is left-clicked.                                                     #
 #     Adds the node to the selection list and highlights it on the canvas                    #
 #--------------------------------------------------------------------------------------------# 
     def OnClickNode(self, obj):
-        if obj in self.sel_nodes:
+        if int(obj.Name) in self.sel_nodes:
             coords = self.nodelist[int(obj.Name)].coords  
             if self.modes['verbose']:        
                 print "Deselected Node %s  (%s, %s)" % (obj.Name, coords[0], coords[1])
-            self.sel_nodes.remove(obj)
+            self.sel_nodes.Remove([int(obj.Name)])
             obj.SetFillColor(NODE_FILL)
             self.Canvas.Draw(True)
         else:  
@@ -2014,7 +2748,7 @@ class MapFrame(wx.Frame):
                 print "Selected Node %s" % (obj.Name)   
                 print "\tPixel Location:   (%s, %s)" % (coords[0]  , coords[1]  )
                 print "\tMetric Location:  (%s, %s)" % (m_coords[0], m_coords[1])
-            self.sel_nodes.append(obj)   
+            self.sel_nodes.Add([int(obj.Name)])   
             obj.SetFillColor(SELECT_COLOR) 
             self.Canvas.Draw(True)
         
@@ -2083,16 +2817,16 @@ class MapFrame(wx.Frame):
 #     Adds the node to the selection list and highlights it on the canvas                    #
 #--------------------------------------------------------------------------------------------#            
     def OnClickEdge(self, obj): 
-        if obj in self.sel_edges:  
+        if int(obj.Name) in self.sel_edges:  
             if self.modes['verbose']:        
                 print "Deselected Edge " + obj.Name
-            self.sel_edges.remove(obj)
-            obj.SetLineColor(EDGE_COLOR)
+            self.sel_edges.Remove([int(obj.Name)])
+            obj.SetLineColor(self.EdgeColor(int(obj.Name)))
             self.Canvas.Draw(True) 
         else: 
             if self.modes['verbose']:       
                 print "Selected Edge " + obj.Name     
-            self.sel_edges.append(obj)   
+            self.sel_edges.Add([int(obj.Name)])   
             obj.SetLineColor(SELECT_COLOR) 
             self.Canvas.Draw(True) 
 
@@ -2104,23 +2838,86 @@ class MapFrame(wx.Frame):
     def SetNodeList(self, new_list):
         self.nodelist = []
         self.nodelist = new_list    
+        self.GraphChanged()
     def SetEdgeList(self, new_list):
         self.edgelist=[]
         self.edgelist = new_list
+        self.edge_state = np.zeros(0, dtype=np.uint8)
+        self.edge_visits = np.zeros(0, dtype=np.uint32)
+        self.GraphChanged()
 
 #--------------------------------------------------------------------------------------------#    
 #     Pickles the NodeList and EdgeList data structures and saves them on the file system    #
 #--------------------------------------------------------------------------------------------#        
     def ExportGraph(self, f):
-        metadata = [self.image_width, self.resolution, self.origin]
-        g = [self.nodelist, self.edgelist, metadata]
-        pickle.dump(g,f)
+        pickle.dump(self.GetGraph(),f)
+        
+    def GetGraph(self):
+        metadata = [self.image_width, self.resolution, self.origin, self.image_height]
+        return [self.nodelist, self.edgelist, metadata]
+
+#--------------------------------------------------------------------------------------------#    
+#     Saves the graph as 'filename' (see GraphLog.py). If that is the graph file that was    #
+#     opened or last saved, only the changes made since then are written, and the file is   #
+#     compacted in the background once enough of them have piled up; otherwise a complete   #
+#     snapshot is written.                                                                   #
+#--------------------------------------------------------------------------------------------#        
+    def SaveGraph(self, filename):
+        log = self.edit_log
+        if log is None or log.graph_filename != filename:
+            self.edit_log = GraphLog.Create(filename, self.GetGraph())
+            return
+        
+        count = log.Flush(self.GetGraph()[2])
+        if self.modes['verbose']:
+            print "Saved %i change(s) to %s" % (count, log.log_filename)
+        if log.NeedsCompaction():
+            job = QueueThread.Job(log.Compact, kind='compact_graph', coalesce=True,
+                                  on_done=self.OnGraphCompacted, on_error=self.OnGraphError)
+            self.jobs.Submit(job, block=False)
+    
+    # Brings the .graph file up to date, for programs that read it directly
+    def CompactGraph(self):
+        if self.edit_log is not None:
+            self.edit_log.Compact()
+        
+    def OnGraphCompacted(self, count):
+        if self.modes['verbose']:
+            print "Compacted %i change(s) into the graph file" % count
+            
+    def OnGraphError(self, e):
+        print "Could not compact the graph file: %s" % e
+        
+    def LogEdit(self, delta, undo):
+        if self.edit_log is not None:
+            self.edit_log.Add(delta, undo)
+
+#--------------------------------------------------------------------------------------------#    
+#     Writes the current map in the map_server format (a .yaml file and a .pgm image with    #
+#     the same name), from the OccupancyGrid values of the map. Returns the .yaml filename.  #
+#--------------------------------------------------------------------------------------------#        
+    def ExportMap(self, filename):
+        store = self.GetOccupancyStore()
+        if self.image_data_format is 'int':
+            grid = store.raw
+        else:
+            grid = store.Grid()
+        return MapIO.SaveMap(filename, grid, self.resolution, self.origin, self.origin_yaw)
+    
+    # Display colors of the map (top row first), for maps made of OccupancyGrid values
+    def GetMapRGB(self):
+        cells = self.GetOccupancyStore().raw
+        return MapIO.MAP_COLORS[cells.view(np.uint8)][::-1]
 
 #--------------------------------------------------------------------------------------------#    
 #     Unpickles an existing graph file from the file system.                                 #
 #     NodeList is in slot 0, EdgeList is in slot 1, Metadata is in slot 2.                   #
+#     With f None, the graph is closed. Either way the undo history starts afresh (a map     #
+#     refresh through SetImage() keeps it, since the graph stays the same).                  #
 #--------------------------------------------------------------------------------------------#       
     def ImportGraph(self, f):
+        self.edit_log = None
+        self.journal.Clear()
         if f is not None:
             g = pickle.load(f)
             self.SetNodeList( g[0] )   
@@ -2129,6 +2926,19 @@ class MapFrame(wx.Frame):
         else:
             ori = gs.Origin((0,0))
             self.SetMapMetadata(None, 0.05, ori)
+            
+#--------------------------------------------------------------------------------------------#    
+#     Reads a graph file and the changes saved since it was written (see GraphLog.py).       #
+#     Further changes are recorded for the next SaveGraph(). Raises IOError if the file      #
+#     doesn't exist.                                                                         #
+#--------------------------------------------------------------------------------------------#       
+    def OpenGraph(self, filename):
+        g, log = GraphLog.Open(filename)
+        self.SetNodeList( g[0] )   
+        self.SetEdgeList( g[1] ) 
+        self.SetMapMetadata( *g[2] )
+        self.edit_log = log
+        self.journal.Clear()
 
 #--------------------------------------------------------------------------------------------#    
 #     Iterates through an imported node list and creates the nodes.                          #
@@ -2159,109 +2969,113 @@ class MapFrame(wx.Frame):
         self.graphics_edges = []       
         
         for edge in tmp_edgelist:
-            try:
-                self.sel_nodes.append( self.graphics_nodes[ int(edge.node1) ] )
-                self.sel_nodes.append( self.graphics_nodes[ int(edge.node2) ] )
+            if max(int(edge.node1), int(edge.node2)) < len(self.graphics_nodes):
+                self.sel_nodes.Add([ int(edge.node1), int(edge.node2) ])
                 self.CreateEdges(event=None)   
-            except IndexError:
+            else:
                 print edge.node1, edge.node2, len(self.graphics_nodes)           
         
         self.RestoreModes('LoadNodes')
               
 #--------------------------------------------------------------------------------------------#    
 #     Sets global variables for metadata obtained from the ROS listener                      #
+#     (graph files written before maps could be rectangular have no height)                  #
 #--------------------------------------------------------------------------------------------#     
-    def SetMapMetadata(self, width, res, origin):
+    def SetMapMetadata(self, width, res, origin, height=None):
         self.image_width = width
+        self.image_height = height if height is not None else width
         self.resolution = float(res)
         self.origin = origin
                 
 #--------------------------------------------------------------------------------------------#    
-#    Finds and returns the extremities of the graph (the topmost point, the leftmost point,  #
-#    etc).                                                                                   #
-#    The 'granularity' argument defines how extensively the search is performed: Higher      #
-#    values for this argument will execute the function faster, but with less accuracy       #                                                        #
+#    Returns the OccupancyStore of the current map (see OccupancyStore.py), which gives      #
+#    windowed access to the map data without copying it. Rebuilt when the image changes.     #
 #--------------------------------------------------------------------------------------------#
-    def FindImageLimit(self, image_data, granularity):
-        st = datetime.now()       
-        w      = self.image_width
-        d      = granularity     #interval between scans
-        top   = w
-        bot   = 0
-        left  = 0
-        right = w
-        
-        foundB = False
-        foundT = False
-        foundL = False
-        foundR = False         
-               
-        if self.image_data_format is 'int':
-            for i in range(w/d):
-                for j in range(w/d):
-                    try:
-                        if image_data[ (w*i*d)+(j*d) ] >= 0 and not foundB:
-                            bot = i*d
-                            foundB = True
-                            
-                        if image_data[ w-((w*i*d)+(j*d)) ] >= 0 and not foundT:
-                            top = w-(i*d)
-                            foundT = True
-                            
-                        if image_data[ (w*j*d)+(i*d) ] >= 0 and not foundL:
-                            left = i*d
-                            foundL = True
-                            
-                        if image_data[ w-((w*j*d)+(i*d)) ] >= 0 and not foundR:
-                            right = w-(i*d)
-                            foundR = True
-                            
-                        if (foundB and foundT and
-                            foundL and foundR):
-                            break                
-                    except IndexError:
-                        break
-                if (foundB and foundT and
-                    foundL and foundR):
-                    break     
-                      
-        elif self.image_data_format is 'byte':
-            for i in range(w/d):
-                for j in range(w/d):
-                    try:
-                        if image_data[ (w*i*d)+(j*d) ] != chr(100) and not foundB:
-                            bot = i*d
-                            foundB = True
-                            
-                        if image_data[ w**2-((w*i*d)+(j*d)) ] != chr(100) and not foundT:
-                            top = w-(i*d)
-                            foundT = True
-                            
-                        if image_data[ (w*j*d)+(i*d) ] != chr(100) and not foundL:
-                            left = i*d
-                            foundL = True
-                            
-                        if image_data[ w**2-((w*j*d)+(i*d)) ] != chr(100) and not foundR:
-                            right = w-(i*d)
-                            foundR = True
-                            
-                        if (foundB and foundT and
-                            foundL and foundR):
-                            break                
-                    except IndexError:
-                        break
-                if (foundB and foundT and
-                    foundL and foundR):
-                    break       
-        et = datetime.now()        
+    def GetOccupancyStore(self):
+        if self.occupancy is None:
+            self.occupancy = OccupancyStore.OccupancyStore(self.image_data, 
+                                                           self.image_data_format,
+                                                           self.image_width, self.image_height)
+        return self.occupancy
+                
+#--------------------------------------------------------------------------------------------#    
+#    Returns the map as a 2D numpy array indexed as grid[y,x], in the same layout as          #
+#    image_data. Cell values are converted to Sampling.FREE, UNKNOWN and OCCUPIED regardless  #
+#    of the image data format, using the same thresholds as CheckEdgeLocation().              #
+#    The array is cached until the map image changes (see SetImage); large maps are kept in  #
+#    a memory-mapped file.                                                                   #
+#--------------------------------------------------------------------------------------------#
+    def GetOccupancyGrid(self):
+        return self.GetOccupancyStore().Grid()
+
+#--------------------------------------------------------------------------------------------#    
+#    Returns the flat indices (y*image_width + x) of every cell where a node with clearance   #
+#    'w' passes the obstacle test of CheckNodeLocation() (see Sampling.ClearBorder).          #
+#    The array is cached per map and per value of w.                                          #
+#--------------------------------------------------------------------------------------------#
+    def GetFreeCells(self, w):
+        key = (self.map_version, w)
+        if self.free_cells is not None and self.free_cells[0] == key:
+            return self.free_cells[1]
+        
+        span = Instrument.Span('GetFreeCells')
+        store = self.GetOccupancyStore()
+        grid = store.Grid()
+        if self.image_data_format is 'byte':
+            # CheckNodeLocation only accepts the exact free color
+            free = store.raw == OccupancyStore.FREE_BYTE
+        else:
+            free = grid == Sampling.FREE
+        cells = Sampling.FreeCells(free, clearance=w)
+        self.free_cells = (key, cells)
+        span.Stop()
+        
+        if self.modes['verbose']:
+            print "Found %i free cells with %ipx clearance. Time taken: %.3fs" % (len(cells), w, 
+                                                                                  span.elapsed)
+        return cells
+                
+#--------------------------------------------------------------------------------------------#    
+#    Finds and returns the extremities of the known part of the map as (bottom, top, left,   #
+#    right), where bottom/left are the first known row/column and top/right are one past     #
+#    the last. Also returns the number of known cells in each row and in each column.        #
+#    The result is exact and cached per map. The map is read from the occupancy store.       #
+#--------------------------------------------------------------------------------------------#
+    def FindImageLimit(self):
+        if self.img_limit_cache is not None and self.img_limit_cache[0] == self.map_version:
+            return self.img_limit_cache[1]
+        
+        span = Instrument.Span('FindImageLimit')
+        store = self.GetOccupancyStore()
+        row_hist = np.zeros(store.height, dtype=np.int64)
+        col_hist = np.zeros(store.width, dtype=np.int64)
+        for y0, band in store.Chunks():
+            known = band != Sampling.UNKNOWN
+            row_hist[y0:y0+len(band)] = known.sum(axis=1)
+            col_hist += known.sum(axis=0)
+        rows = np.flatnonzero(row_hist)
+        cols = np.flatnonzero(col_hist)
+        
+        if len(rows) == 0:
+            bot, top = 0, store.height
+            left, right = 0, store.width
+        else:
+            bot, top = int(rows[0]), int(rows[-1])+1
+            left, right = int(cols[0]), int(cols[-1])+1
+        self.known_px = int(row_hist.sum())
+        
+        result = (bot, top, left, right, row_hist, col_hist)
+        self.img_limit_cache = (self.map_version, result)
+        span.Stop()
+        
         if self.modes['verbose']:
             print "Top edge of map at row %s" % (str(top))
             print "Bottom edge of map at row %s" % (str(bot)) 
             print "Left edge of map at column %s" % (str(left))   
             print "Right edge of map at column %s" % (str(right))              
-            print "Scanned map data. Time taken: %s" % str(et-st)     
+            print "Scanned map data. Time taken: %.3fs" % span.elapsed
                        
-        return bot,top,left,right
+        return result
     
 #--------------------------------------------------------------------------------------------#    
 #     Zooms to a given location with a given floating-point magnification.                   #
@@ -2284,7 +3098,7 @@ class MapFrame(wx.Frame):
             data_ready = False
             while not data_ready: 
                 try:
-                    self.img_limits = self.FindImageLimit(self.image_data, 10) 
+                    self.img_limits = self.FindImageLimit() 
                     self.update_imglimits = False
                     data_ready = True
                 except AttributeError:
@@ -2311,7 +3125,7 @@ class MapFrame(wx.Frame):
         wx_img = wx.EmptyImage( pil_img.size[0], pil_img.size[1] )
         wx_img.SetData( pil_img.convert( 'RGB' ).tostring() )
         return wx_img   
-          
+    
 #---------------------------------------------------------------------------------------------#    
 #    Saves the current modes and changes them.                                                #
 #                                                                                             #
@@ -2330,7 +3144,8 @@ class MapFrame(wx.Frame):
         self.modes = self.saved_modes[key].copy()
     
 #--------------------------------------------------------------------------------------------#    
-#     Clears the entire canvas (including the map)                                           #
+#     Clears the entire canvas (including the map). The graph and its edit log are kept:     #
+#     SetImage() calls this after OpenGraph().                                               #
 #--------------------------------------------------------------------------------------------#   
     def Clear(self):
         self.Canvas.InitAll()  
@@ -2339,10 +3154,11 @@ class MapFrame(wx.Frame):
 #    Erases route graphics if they exist. If not, erases all nodes and edges from the map.    #
 #---------------------------------------------------------------------------------------------#        
     def OnClear(self):
-        if self.highlights != [] or self.graphics_route != []:
+        if self.highlights != [] or self.graphics_route != [] or self.edge_state.any():
             for obj in self.highlights:
                 self.Canvas.RemoveObject(obj)
             self.highlights = []
+            self.ResetEdgeStates()
             
             for obj in self.graphics_route:
                 self.Canvas.RemoveObject(obj)
@@ -2361,6 +3177,7 @@ class MapFrame(wx.Frame):
 #---------------------------------------------------------------------------------------------#    
 #    Erases all nodes and edges from the map                                                  #
 #---------------------------------------------------------------------------------------------#                   
+    @Journal.Action('Clear graph')
     def ClearGraph(self):
         self.SetModes('ClearGraph', {                        
                         'verbose':False, 
@@ -2368,41 +3185,60 @@ class MapFrame(wx.Frame):
         self.SelectAll(None)
         self.DeleteSelection(None)  
         self.RestoreModes('ClearGraph')    
+        self.edge_state = np.zeros(0, dtype=np.uint8)
+        self.edge_visits = np.zeros(0, dtype=np.uint32)
 
 #---------------------------------------------------------------------------------------------#    
-#    Saves the content of the canvas as a .png image                                          #
+#    Saves the map and the graph as a .png image, 'scale' image pixels per map pixel. The     #
+#    image is rendered offscreen by a background job (see ExportRenderer), so the canvas is   #
+#    not touched and any scale can be used.                                                   #
 #---------------------------------------------------------------------------------------------#    
-    def SaveCanvasImage(self, filename):
-        # For some reason FloatCanvas doesn't save foreground objects
-        # So, we need to draw some temporary nodes on the background
-        st = datetime.now()
-        temp_obj = []
-        
-        for node in self.nodelist:
-            xy = node.coords[0], node.coords[1]
-            diam = NODE_DIAM
-            lw = NODE_BORDER_WIDTH
-            lc = NODE_BORDER    
-            fc = NODE_FILL
-            if node.id < 100:  
-                fs = FONT_SIZE_1
-            else:
-                fs = FONT_SIZE_2     
-                    
-            c = self.Canvas.AddCircle(xy, diam, LineWidth=lw, LineColor=lc, FillColor=fc,
-                                      InForeground = False)        
-            t = self.Canvas.AddScaledText(str(node.id), xy, Size=fs, Position="cc", 
-                                    Color=TEXT_COLOR, Weight=wx.BOLD, InForeground = False)
-            temp_obj.append(c)    
-            temp_obj.append(t)
-        
-        self.Canvas.Draw(True)
-        self.Canvas.SaveAsImage(filename)
-        self.Canvas.RemoveObjects(temp_obj) # Get rid of the temporary nodes
-        self.Canvas.Draw(True)
-        
-        et = datetime.now()
-        print "Saved canvas image. Time taken: %s" % (et-st)
+    def SaveCanvasImage(self, filename, scale=EXPORT_SCALE):
+        if not self.current_map:
+            return
+        # A newer export to the same file supersedes this one; exports to other files all run
+        job = QueueThread.Job(ExportRenderer.Export, (filename, self.GetExportScene(), scale),
+                              kind='export:%s' % filename, on_done=self.OnImageExported, 
+                              on_error=self.OnExportError, coalesce=True, cancellable=True)
+        if not self.jobs.Submit(job):
+            self.SetStatusText(JOBS_BUSY)
+        
+    def OnImageExported(self, size):
+        print "Saved map image (%ix%i)" % size
+        
+    def OnExportError(self, e):
+        print "Could not save the map image: %s" % e
+    
+    # Copies what the export renderer needs, so that the graph can change while it runs
+    def GetExportScene(self):
+        store = self.GetOccupancyStore()
+        if self.image_data_format is 'int':
+            colors = MapIO.MAP_COLORS
+        else:
+            grey = np.arange(256, dtype=np.uint8)
+            colors = np.repeat(grey[:, np.newaxis], 3, axis=1)
+        nodes = [node.coords for node in self.nodelist]
+        edges = [(int(edge.node1), int(edge.node2)) for edge in self.edgelist]
+        style = ExportRenderer.Style(NODE_FILL, NODE_BORDER, EDGE_COLOR, TEXT_COLOR, NODE_DIAM,
+                                     NODE_BORDER_WIDTH, EDGE_WIDTH, (FONT_SIZE_1, FONT_SIZE_2))
+        return ExportRenderer.Scene(store.raw, colors, nodes, edges, style)
+        
+    def OnExportImage(self, event):
+        if not self.current_map:
+            return
+        dlg = wx.FileDialog(self, message="Export Map Image", defaultDir=os.getcwd(), 
+                            defaultFile="", wildcard='PNG images (*.png)|*.png', 
+                            style=wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT)
+        if dlg.ShowModal() == wx.ID_OK:
+            filename = dlg.GetPath()
+            if not filename.lower().endswith('.png'):
+                filename += '.png'
+            scale = wx.GetNumberFromUser("Image pixels per map pixel", "Scale", 
+                                         "Export Map Image", EXPORT_SCALE, 1, 
+                                         EXPORT_SCALE_MAX, self)
+            if scale > 0:
+                self.SaveCanvasImage(filename, scale)
+        dlg.Destroy()
 
 #---------------------------------------------------------------------------------------------#    
 #    (-Debug-)                                                                                #
@@ -2442,44 +3278,72 @@ class MapFrame(wx.Frame):
 #     Sets the image to display on the canvas. If the map has an associated graph file,      #
 #     the corresponding nodes and edges are loaded and drawn onto the canvas.                #
 #--------------------------------------------------------------------------------------------#
-    def SetImage(self, image_obj):
+    def SetImage(self, image_obj, image_data=None):
         self.SetModes('SetImage', {                        
                         'verbose':False, 
                         'redraw':False, 
                         'auto_edges':False
                         }) 
         self.Clear()
-        st = datetime.now()  
+        self.obstacles_1 = None
+        self.obstacles_2 = None
+        span = Instrument.Span('SetImage')
+        self.occupancy = None
+        self.free_cells = None
+        self.map_version += 1
                   
-        try:
-            # Creates the image from a file (used when loading a .png map file)
-            self.image_data = []
+        self.origin_yaw = 0.0
+        if MapIO.IsMapServerFile(image_obj):
+            # Creates the image from a map_server map (.yaml/.pgm file). The cells are 
+            # OccupancyGrid values; the resolution and origin from the .yaml file replace
+            # those stored with the graph. The pixels are decoded once, to the cells, and
+            # the colors are derived from those
+            map_file = MapIO.Open(image_obj)
+            self.image_data = map_file.Cells()
+            image = MapIO.ArrayToWxImage(map_file.RGB())
             image_file = image_obj
-            
-            # Load as a PIL image so that we can "flip" the data (otherwise it's wrong)
-            pil_img = Image.open(image_obj)
-            pil_img_flip = pil_img.transpose(Image.FLIP_TOP_BOTTOM)
-            
-            image = self.PilImageToWxImage(pil_img)
-            image_flip = self.PilImageToWxImage(pil_img_flip)            
-            image_file = image_obj
-            self.image_data = image_flip.GetData()[0::3]
-            self.image_data_format = "byte"
-            
-        except AttributeError:
-            # Creates the image directly from a wx.Image object (used when refreshing a live map)
-            image = image_obj
-            image_file = self.ros.GetDefaultFilename()
-            self.image_data = self.ros.image_data
-            self.image_data_format = "int"    
-        
-        self.image_width = image.GetHeight() # Case where metadata was not set
+            self.image_data_format = "int"
+            self.SetMapMetadata(map_file.width, map_file.resolution, 
+                                gs.Origin(map_file.origin[:2]), map_file.height)
+            self.origin_yaw = map_file.origin[2]
+        else:
+            try:
+                # Creates the image from a file (used when loading a .png map file)
+                self.image_data = []
+                image_file = image_obj
+                
+                # Load as a PIL image so that we can "flip" the data (otherwise it's wrong)
+                pil_img = Image.open(image_obj)
+                pil_img_flip = pil_img.transpose(Image.FLIP_TOP_BOTTOM)
+                
+                image = self.PilImageToWxImage(pil_img)
+                image_flip = self.PilImageToWxImage(pil_img_flip)            
+                image_file = image_obj
+                self.image_data = image_flip.GetData()[0::3]
+                self.image_data_format = "byte"
+                
+            except AttributeError:
+                # Creates the image directly from a wx.Image object (used when refreshing a 
+                # live map) together with the OccupancyGrid data it was made from
+                image = image_obj
+                image_file = self.ros.GetDefaultFilename()
+                if image_data is None:
+                    image_data = self.ros.image_data
+                self.image_data = image_data
+                self.image_data_format = "int"    
+                orient = self.ros.origin_orient
+                if orient is not None:
+                    self.origin_yaw = 2*math.atan2(orient.z, orient.w)
+        
+        self.image_width = image.GetWidth()
+        self.image_height = image.GetHeight()
         self.update_imglimits = True
         
         self.img = self.Canvas.AddScaledBitmap( image, 
                                   (0,0), 
                                   Height=image.GetHeight(), 
                                   Position = 'bl')    
+        self.AddGraphLayers()
         self.LoadNodes()
         self.LoadEdges()
         self.GenerateConnectionMatrix()
@@ -2494,9 +3358,9 @@ class MapFrame(wx.Frame):
         self.Layout()        
         self.ZoomToFit()
         
-        et = datetime.now()
+        span.Stop()
         self.RestoreModes('SetImage')
         self.Canvas.Draw(True)
 
         if self.modes['verbose']:
-            print "Set map image. Time taken: %s" % str(et-st)
+            print "Set map image. Time taken: %.3fs" % span.elapsed
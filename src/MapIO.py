@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+'''
+Reading and writing maps in the map_server format: a .yaml file with the metadata and a
+binary .pgm (P5) image with one grey level per cell.
+
+    image: warehouse.pgm
+    resolution: 0.050000
+    origin: [-100.000000, -20.000000, 0.000000]
+    negate: 0
+    occupied_thresh: 0.65
+    free_thresh: 0.196
+
+The pixels of a .pgm are not read when the map is opened: the file is mapped with
+numpy.memmap and decoded to OccupancyGrid values (0 free, 100 occupied, -1 unknown) with
+a lookup table, in a single pass, when the cells are first needed. The resolution and
+origin come from the .yaml file. Maps are written directly from the occupancy values,
+as map_saver does, without going through an image library.
+
+@author: jon
+'''
+
+import os
+import numpy as np
+
+# Colors of the OccupancyGrid cell values, indexed by (value & 0xFF)
+MAP_COLORS = np.empty((256,3), dtype=np.uint8)
+MAP_COLORS[:] = (100,100,92)        # unknown (dark grey), also used for unexpected values
+MAP_COLORS[0] = (230,230,230)       # known (light grey)
+MAP_COLORS[1:101] = (0,0,0)         # blocked (black)
+
+# map_server defaults
+DEFAULT_RESOLUTION  = 0.05
+FREE_THRESH         = 0.196
+OCCUPIED_THRESH     = 0.65
+
+# Grey levels written by map_saver, and the cell values they stand for
+PGM_FREE            = 254
+PGM_OCCUPIED        = 0
+PGM_UNKNOWN         = 205
+SAVE_FREE_MAX       = 0     # cells with values 0..SAVE_FREE_MAX are written as free
+SAVE_OCCUPIED_MIN   = 65    # cells with values >= SAVE_OCCUPIED_MIN are written as occupied
+
+MAP_SERVER_EXTENSIONS = ('.yaml', '.yml', '.pgm')
+
+def IsMapServerFile(filename):
+    if not isinstance(filename, basestring):
+        return False
+    return os.path.splitext(filename)[1].lower() in MAP_SERVER_EXTENSIONS
+
+# The graph of a map is kept next to it, with the extension ".graph"
+def GraphFilename(map_filename):
+    return os.path.splitext(map_filename)[0] + ".graph"
+
+#---------------------------------------------------------------------------------------------#
+#    A map opened from a .yaml or .pgm file. 'pixels' is the memory-mapped image, with the    #
+#    top row first; Cells() and RGB() decode it on first use.                                 #
+#---------------------------------------------------------------------------------------------#
+class MapFile(object):
+    def __init__(self, image, resolution=DEFAULT_RESOLUTION, origin=(0.0, 0.0, 0.0),
+                 negate=0, occupied_thresh=OCCUPIED_THRESH, free_thresh=FREE_THRESH,
+                 mode='trinary'):
+        self.image = image
+        self.resolution = float(resolution)
+        self.origin = tuple(float(v) for v in origin)
+        self.pixels, self.maxval = ReadPGM(image)
+        self.height, self.width = self.pixels.shape
+        self.lut = OccupancyLUT(self.maxval, negate, occupied_thresh, free_thresh, mode)
+        self.cells = None
+
+    # OccupancyGrid values as a flat int8 array, bottom row first (the layout of /map)
+    def Cells(self):
+        if self.cells is None:
+            self.cells = self.lut[self.pixels[::-1]].ravel()
+        return self.cells
+
+    # Display colors, top row first
+    def RGB(self):
+        if self.cells is not None:
+            rgb = MAP_COLORS[self.cells.view(np.uint8)]
+            return rgb.reshape(self.height, self.width, 3)[::-1]
+        return MAP_COLORS[self.lut.view(np.uint8)[self.pixels]]
+
+#---------------------------------------------------------------------------------------------#
+#    Creates a wx.Image from an RGB array (height x width x 3), e.g. from MapFile.RGB(). wx   #
+#    is only imported here, so that the rest of the module can be used without it.           #
+#---------------------------------------------------------------------------------------------#
+def ArrayToWxImage(rgb):
+    import wx
+    wx_img = wx.EmptyImage(rgb.shape[1], rgb.shape[0])
+    wx_img.SetData(np.ascontiguousarray(rgb).tostring())
+    return wx_img
+
+#---------------------------------------------------------------------------------------------#
+#    Opens a map from its .yaml file, or from a .pgm file (whose .yaml file, if there is one, #
+#    has the same name).                                                                      #
+#---------------------------------------------------------------------------------------------#
+def Open(filename):
+    base, ext = os.path.splitext(filename)
+    if ext.lower() == '.pgm':
+        for yaml_ext in ('.yaml', '.yml'):
+            if os.path.exists(base + yaml_ext):
+                return Open(base + yaml_ext)
+        return MapFile(filename)
+
+    info = ReadYAML(filename)
+    image = info.pop('image')
+    if not os.path.isabs(image):
+        image = os.path.join(os.path.dirname(os.path.abspath(filename)), image)
+    keys = ('resolution', 'origin', 'negate', 'occupied_thresh', 'free_thresh', 'mode')
+    return MapFile(image, **dict((k, info[k]) for k in keys if k in info))
+
+def ReadYAML(filename):
+    import yaml
+    f = open(filename, 'r')
+    try:
+        info = yaml.safe_load(f)
+    finally:
+        f.close()
+    if not isinstance(info, dict) or 'image' not in info:
+        raise ValueError("%s is not a map_server map file" % filename)
+    return info
+
+#---------------------------------------------------------------------------------------------#
+#    Maps a binary PGM file. Returns (pixels, maxval), where pixels is a read-only memmap of  #
+#    shape (height, width); nothing is read beyond the header until the pixels are used.      #
+#---------------------------------------------------------------------------------------------#
+def ReadPGM(filename):
+    f = open(filename, 'rb')
+    try:
+        header = f.read(1024)
+    finally:
+        f.close()
+
+    # Header: magic, width, height, maxval, separated by whitespace and comments, then a
+    # single whitespace character before the pixels
+    fields = []
+    pos = 0
+    while len(fields) < 4:
+        while pos < len(header) and header[pos].isspace():
+            pos += 1
+        if pos < len(header) and header[pos] == '#':
+            while pos < len(header) and header[pos] not in '\r\n':
+                pos += 1
+            continue
+        start = pos
+        while pos < len(header) and not header[pos].isspace():
+            pos += 1
+        if start == pos:
+            raise ValueError("%s: truncated PGM header" % filename)
+        fields.append(header[start:pos])
+
+    if fields[0] != 'P5':
+        raise ValueError("%s: only binary (P5) PGM files are supported" % filename)
+    width, height, maxval = [int(v) for v in fields[1:]]
+    dtype = np.uint8 if maxval < 256 else np.dtype('>u2')
+    pixels = np.memmap(filename, dtype=dtype, mode='r', offset=pos+1, shape=(height, width))
+    return pixels, maxval
+
+#---------------------------------------------------------------------------------------------#
+#    Lookup table from grey level to OccupancyGrid value, following map_server: a pixel's     #
+#    occupancy is (maxval-p)/maxval (p/maxval if negate is set).                              #
+#---------------------------------------------------------------------------------------------#
+def OccupancyLUT(maxval, negate=0, occupied_thresh=OCCUPIED_THRESH, free_thresh=FREE_THRESH,
+                 mode='trinary'):
+    p = np.arange(maxval+1, dtype=float)
+    if negate:
+        occ = p / maxval
+    else:
+        occ = (maxval - p) / maxval
+
+    if mode == 'raw':
+        # The grey level itself, as map_server stores it in the int8 cells
+        return (np.arange(maxval+1) & 0xFF).astype(np.uint8).view(np.int8)
+    lut = np.empty(maxval+1, dtype=np.int8)
+    if mode == 'scale':
+        scaled = 99 * (occ - free_thresh) / (occupied_thresh - free_thresh)
+        lut[:] = np.clip(np.round(scaled), 0, 99)
+    else:
+        lut[:] = -1
+    lut[occ > occupied_thresh] = 100
+    lut[occ < free_thresh] = 0
+    return lut
+
+#---------------------------------------------------------------------------------------------#
+#    Writes a map as 'filename' (.yaml) and a .pgm image with the same name. 'grid' holds     #
+#    OccupancyGrid values as a (height, width) array, bottom row first; 'origin' has x and y  #
+#    attributes. Both files are written under temporary names and then renamed.               #
+#---------------------------------------------------------------------------------------------#
+def SaveMap(filename, grid, resolution, origin, yaw=0.0):
+    base = os.path.splitext(filename)[0]
+    yaml_filename = base + '.yaml'
+    pgm_filename = base + '.pgm'
+
+    WritePGM(pgm_filename, grid)
+    text = ("image: %s\n"
+            "resolution: %f\n"
+            "origin: [%f, %f, %f]\n"
+            "negate: 0\n"
+            "occupied_thresh: %s\n"
+            "free_thresh: %s\n") % (os.path.basename(pgm_filename), float(resolution),
+                                    origin.x, origin.y, yaw, OCCUPIED_THRESH, FREE_THRESH)
+    tmp_filename = yaml_filename + ".tmp"
+    f = open(tmp_filename, 'w')
+    f.write(text)
+    f.close()
+    os.rename(tmp_filename, yaml_filename)
+    return yaml_filename
+
+def WritePGM(filename, grid):
+    grid = np.asarray(grid)
+    height, width = grid.shape
+    pixels = np.empty(grid.shape, dtype=np.uint8)
+    pixels[:] = PGM_UNKNOWN
+    pixels[(grid >= 0) & (grid <= SAVE_FREE_MAX)] = PGM_FREE
+    pixels[grid >= SAVE_OCCUPIED_MIN] = PGM_OCCUPIED
+
+    tmp_filename = filename + ".tmp"
+    f = open(tmp_filename, 'wb')
+    f.write("P5\n%i %i\n255\n" % (width, height))
+    f.write(np.ascontiguousarray(pixels[::-1]).tostring())
+    f.close()
+    os.rename(tmp_filename, filename)
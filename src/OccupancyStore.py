@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+'''
+Windowed access to the occupancy data of the current map.
+
+A map is width x height cells, stored row by row (the flat index of cell (x, y) is
+y*width + x) as either the OccupancyGrid values of a live map ('int') or the grey levels
+of a map file ('byte'). The store keeps two 2D views of it, both indexed as [y, x]:
+
+    - raw: the map data itself, without a copy
+    - grid: the cells converted to Sampling.FREE, UNKNOWN and OCCUPIED, built on first
+      use CHUNK_ROWS rows at a time
+
+Grids of more than MEMMAP_CELLS cells are kept in a memory-mapped temporary file, so only
+the pages that are actually read are held in memory. Window() returns a view of a
+sub-region and Chunks() walks the grid in horizontal bands, so callers can work on large
+maps without building full-size temporary arrays.
+
+@author: jon
+'''
+
+import os
+import tempfile
+import numpy as np
+import Sampling
+
+CHUNK_ROWS      = 256               # rows converted or scanned at a time
+MEMMAP_CELLS    = 32*1024*1024      # grids with more cells than this are kept on disk
+FREE_BYTE       = 230               # color of free cells in map files
+
+class OccupancyStore(object):
+    def __init__(self, image_data, data_format, width, height, memmap_cells=MEMMAP_CELLS):
+        self.width = int(width)
+        self.height = int(height)
+        self.format = data_format
+        self.memmap_cells = memmap_cells
+        self.raw = RawArray(image_data, data_format, self.width, self.height)
+        self.grid = None
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+#---------------------------------------------------------------------------------------------#
+#    Returns the canonical grid, converting the map data on first use.                        #
+#---------------------------------------------------------------------------------------------#
+    def Grid(self):
+        if self.grid is None:
+            if self.width*self.height > self.memmap_cells:
+                fd, path = tempfile.mkstemp(prefix='map_view_', suffix='.occ')
+                os.close(fd)
+                grid = np.memmap(path, dtype=np.int8, mode='w+', shape=self.shape)
+                # The mapping stays valid; the file goes away with the last reference to it
+                os.remove(path)
+            else:
+                grid = np.empty(self.shape, dtype=np.int8)
+            for y0 in range(0, self.height, CHUNK_ROWS):
+                y1 = min(y0+CHUNK_ROWS, self.height)
+                grid[y0:y1] = Classify(self.raw[y0:y1], self.format)
+            self.grid = grid
+        return self.grid
+
+    # True if the region [x0,x1) x [y0,y1) lies entirely inside the map
+    def Contains(self, x0, y0, x1, y1):
+        return x0 >= 0 and y0 >= 0 and x1 <= self.width and y1 <= self.height
+
+#---------------------------------------------------------------------------------------------#
+#    Returns a view of the region [x0,x1) x [y0,y1), clipped to the map. The view is taken    #
+#    from the raw map data if 'raw' is True, from the canonical grid otherwise.               #
+#---------------------------------------------------------------------------------------------#
+    def Window(self, x0, y0, x1, y1, raw=False):
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        source = self.raw if raw else self.Grid()
+        return source[y0:max(y0, y1), x0:max(x0, x1)]
+
+    # Yields (y0, rows) for consecutive bands of at most 'rows' rows of the grid
+    def Chunks(self, rows=CHUNK_ROWS):
+        grid = self.Grid()
+        for y0 in range(0, self.height, rows):
+            yield y0, grid[y0:y0+rows]
+
+#---------------------------------------------------------------------------------------------#
+#    Returns the map data as a (height, width) array without copying it where possible.       #
+#---------------------------------------------------------------------------------------------#
+def RawArray(image_data, data_format, width, height):
+    if data_format == 'byte':
+        data = np.frombuffer(image_data, dtype=np.uint8)
+    else:
+        data = np.asarray(image_data, dtype=np.int8)
+    if data.size != width*height:
+        raise ValueError("Map data has %i cells, expected %ix%i" % (data.size, width, height))
+    return data.reshape((height, width))
+
+#---------------------------------------------------------------------------------------------#
+#    Converts raw cells to Sampling.FREE, UNKNOWN and OCCUPIED, using the same thresholds as  #
+#    MapFrame.CheckEdgeLocation().                                                            #
+#---------------------------------------------------------------------------------------------#
+def Classify(cells, data_format):
+    out = np.empty(cells.shape, dtype=np.int8)
+    if data_format == 'byte':
+        out[:] = Sampling.OCCUPIED
+        out[cells >= 50] = Sampling.UNKNOWN
+        out[cells >= 150] = Sampling.FREE
+    else:
+        out[:] = Sampling.FREE
+        out[cells < 0] = Sampling.UNKNOWN
+        out[cells > 0] = Sampling.OCCUPIED
+    return out
@@ -1,32 +1,189 @@
 #!/usr/bin/env python
 
-import time
-import threading
+'''
+Background job execution for work that would otherwise stall the GUI thread.
+
+A JobQueue owns a bounded queue and a number of QueueThread workers. Work is submitted
+as Job objects:
+
+    job = QueueThread.Job(GraphAnalysis.Analyze, (nodes, edges, grid),
+                          kind='analysis', on_done=self.ShowAnalysis)
+    self.jobs.Submit(job)
+
+- on_done(result) and on_error(exception) are called on the GUI thread (wx.CallAfter),
+  so they may touch wx objects. The job function itself must not.
+- Every job has a CancelToken. Cancelled jobs are skipped if they haven't started, and
+  their result is dropped if they have. Long jobs can accept the token (cancellable=True
+  passes it as the 'token' keyword argument) and stop early.
+- Jobs submitted with coalesce=True supersede any pending job of the same kind, which is
+  cancelled: only the latest map refresh or analysis request is worked on.
+- The queue is bounded. Submit() returns False when it is full (the job is dropped) and
+  the caller reports that the queue is busy; block=True waits for a free slot instead,
+  which must not be done on the GUI thread.
+
+@author: jon
+'''
+
+import wx
 import Queue
+import threading
+import traceback
+import Instrument
 from threading import Thread
 
+JOB_WORKERS     = 1         # default number of worker threads
+JOB_QUEUE_SIZE  = 16        # default maximum number of queued jobs
+
+class Cancelled(Exception):
+    pass
+
+class CancelToken(object):
+    __slots__ = ('cancelled',)
+
+    def __init__(self):
+        self.cancelled = False
+
+    def Cancel(self):
+        self.cancelled = True
+
+    def Check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+#---------------------------------------------------------------------------------------------#
+#    A unit of work: fn(*args) run on a worker thread, with optional GUI-thread callbacks.    #
+#---------------------------------------------------------------------------------------------#
+class Job(object):
+    def __init__(self, fn, args=(), kind=None, on_done=None, on_error=None,
+                 coalesce=False, cancellable=False):
+        self.fn = fn
+        self.args = args
+        self.kind = kind or getattr(fn, '__name__', 'job')
+        self.on_done = on_done
+        self.on_error = on_error
+        self.coalesce = coalesce
+        self.cancellable = cancellable
+        self.token = CancelToken()
+        self.finished = False
+
+    def Cancel(self):
+        self.token.Cancel()
+
+    @property
+    def cancelled(self):
+        return self.token.cancelled
+
+    def Run(self):
+        if self.cancellable:
+            return self.fn(*self.args, token=self.token)
+        return self.fn(*self.args)
+
+#---------------------------------------------------------------------------------------------#
+#    Bounded job queue served by one or more worker threads.                                  #
+#---------------------------------------------------------------------------------------------#
+class JobQueue(object):
+    def __init__(self, num_workers=JOB_WORKERS, max_size=JOB_QUEUE_SIZE):
+        self.q = Queue.Queue(max_size)
+        self.lock = threading.Lock()
+        self.pending = {}           # kind -> latest job of that kind that hasn't finished
+        self.workers = []
+        for i in range(num_workers):
+            worker = QueueThread(self)
+            worker.start()
+            self.workers.append(worker)
+
+#---------------------------------------------------------------------------------------------#
+#    Queues a job. It is registered as the pending job of its kind before it is queued, so    #
+#    that a worker cannot finish it first; the job it supersedes is only cancelled once it    #
+#    has been queued. Returns False (and keeps the older job) if the queue is full.           #
+#---------------------------------------------------------------------------------------------#
+    def Submit(self, job, block=False, timeout=None):
+        with self.lock:
+            old = self.pending.get(job.kind)
+            self.pending[job.kind] = job
+        try:
+            self.q.put(job, block, timeout)
+        except Queue.Full:
+            with self.lock:
+                if self.pending.get(job.kind) is job:
+                    if old is not None and not old.finished:
+                        self.pending[job.kind] = old
+                    else:
+                        del self.pending[job.kind]
+            Instrument.Count('jobs_rejected')
+            return False
+        if old is not None and job.coalesce:
+            with self.lock:
+                old.Cancel()
+            Instrument.Count('jobs_coalesced')
+        return True
+
+    # Cancels the latest job of the given kind
+    def Cancel(self, kind):
+        with self.lock:
+            job = self.pending.pop(kind, None)
+        if job is not None:
+            job.Cancel()
+
+    def Finished(self, job):
+        with self.lock:
+            job.finished = True
+            if self.pending.get(job.kind) is job:
+                del self.pending[job.kind]
+
+    def Busy(self, kind):
+        with self.lock:
+            return kind in self.pending
+
+    def Stop(self):
+        with self.lock:
+            for job in self.pending.values():
+                job.Cancel()
+            self.pending.clear()
+        for worker in self.workers:
+            worker.stopped = True
+
+#---------------------------------------------------------------------------------------------#
+#    Worker thread. Runs jobs from the queue and posts their results to the GUI thread.       #
+#---------------------------------------------------------------------------------------------#
 class QueueThread(Thread):
     def __init__(self, parent):
         self.stopped = False
         self.parent = parent
         Thread.__init__(self)
+        self.daemon = True
 
     def run(self):
         while not self.stopped:
             try:
-                item = self.parent.q.get(timeout=1)
+                job = self.parent.q.get(timeout=1)
             except Queue.Empty:
-                continue     
+                continue
             try:
-                fn = item[0]
-                args = item[1:]
-                if self.parent.modes['verbose']:
-                    print str(fn)[13:].split()[0] + "()"
-                fn(*args)
-            except TypeError:
-                fn = item
-                if self.parent.modes['verbose']:
-                    print str(fn)[13:].split()[0] + "()"
-                fn()
-               
-            self.parent.q.task_done()
\ No newline at end of file
+                self.Execute(job)
+            finally:
+                self.parent.Finished(job)
+                self.parent.q.task_done()
+
+    def Execute(self, job):
+        if job.cancelled:
+            Instrument.Count('jobs_cancelled')
+            return
+        span = Instrument.Span("QueueThread.%s" % job.kind)
+        try:
+            result = job.Run()
+        except Cancelled:
+            Instrument.Count('jobs_cancelled')
+            return
+        except Exception, e:
+            span.Stop()
+            if job.on_error is not None:
+                wx.CallAfter(job.on_error, e)
+            else:
+                traceback.print_exc()
+            return
+        span.Stop()
+        if job.cancelled:
+            Instrument.Count('jobs_cancelled')
+        elif job.on_done is not None:
+            wx.CallAfter(job.on_done, result)
@@ -15,13 +15,17 @@ from nav_msgs.msg import GridCells                          #@UnresolvedImport
 from geometry_msgs.msg import PoseWithCovarianceStamped     #@UnresolvedImport
 from geometry_msgs.msg import Twist                         #@UnresolvedImport
 import Image
-import ImageOps
+import QueueThread
+import Dispatch
+import MapIO
+from MapIO import MAP_COLORS
 
 from move_base_msgs.msg import MoveBaseActionGoal           #@UnresolvedImport
 from move_base_msgs.msg import MoveBaseActionResult         #@UnresolvedImport      
 
 FILENAME = "map.png"
-MAX_COUNT = 3
+RING_SIZE = 32      # event messages (route, destination, status) kept between two drains
+WRITE_SNAPSHOT = True   # write the live map to FILENAME (in the background) after a refresh
 
 class ROSNode():
     
@@ -49,15 +53,18 @@ class ROSNode():
         self.obstacles_2 = None
                  
         self.image_width = 1000
+        self.image_height = 1000
         self.resolution = None
         self.refresh = False
         self.image = None
+        self.rgb = None
+        self.map_requests = []
         self.filename = FILENAME 
-        self.count = 0
         
         self.parent = parent
         self.pose_pub = rospy.Publisher('initialpose', PoseWithCovarianceStamped)
         self.goal_pub = rospy.Publisher('move_base/goal', MoveBaseActionGoal)              
+        self.tour_pub = rospy.Publisher('map_view/tour', Int32MultiArray)
     
     def Publish2DPoseEstimate(self, point, orient):
         pwc = PoseWithCovarianceStamped()
@@ -75,6 +82,15 @@ class ROSNode():
         ag.goal.target_pose.pose.orientation.z = orient[2]
         ag.goal.target_pose.pose.orientation.w = orient[3]
         self.goal_pub.publish(ag)     
+
+#---------------------------------------------------------------------------------------------#    
+#    Publishes a tour planned by MapFrame.PlanTour() in the same format as the                #
+#    "node_traveller/route" topic: the node ids in the order they are visited.                #
+#---------------------------------------------------------------------------------------------#
+    def PublishTour(self, route):
+        msg = Int32MultiArray()
+        msg.data = [int(n) for n in route]
+        self.tour_pub.publish(msg)
     
     def Listen(self):
         self.refresh = False
@@ -85,33 +101,48 @@ class ROSNode():
         rospy.Subscriber("node_traveller/route", Int32MultiArray, self.RouteCB)
         rospy.Subscriber("move_base/result", MoveBaseActionResult, self.StatusCB)
         rospy.Subscriber("move_base_node/local_costmap/obstacles", GridCells, self.ObsCB)
-#         rospy.Subscriber("move_base_node/local_costmap/inflated_obstacles", GridCells, self.ObsCB2)
+        rospy.Subscriber("move_base_node/local_costmap/inflated_obstacles", GridCells, self.ObsCB2)
         
         if __name__ == '__main__':
             rospy.spin()       
 
+#---------------------------------------------------------------------------------------------#    
+#    The rospy callbacks below only store the message in the dispatcher (see Dispatch). The   #
+#    On* handlers are called on the GUI thread when the dispatcher is drained.                #
+#---------------------------------------------------------------------------------------------#
+    def StartDispatch(self):
+        self.dispatch = Dispatch.Dispatcher(self.parent)
+        self.dispatch.Register('route', self.OnRoute, RING_SIZE)
+        self.dispatch.Register('dest', self.OnDest, RING_SIZE)
+        self.dispatch.Register('status', self.OnStatus, RING_SIZE)
+        self.dispatch.Register('pose', self.OnPose)
+        self.dispatch.Register('obstacles', self.OnObstacles)
+        self.dispatch.Register('inflated', self.OnInflatedObstacles)
+        self.dispatch.Register('map', self.OnMap)
+        self.dispatch.Start()
+
 #---------------------------------------------------------------------------------------------#    
 #    Callback function for the "/node_traveller/dest" topic.                                  #
 #    -> Highlights the robot's current destination.                                           #
 #---------------------------------------------------------------------------------------------#                
     def DestCB(self, data):
-        dest = int(data.data) 
-        wx.CallAfter(self.mframe.HighlightDestination, dest)      
+        self.dispatch.Post('dest', int(data.data))
+        
+    def OnDest(self, dest):
+        self.mframe.HighlightDestination(dest)      
 
 #---------------------------------------------------------------------------------------------#    
 #    Callback function for the "/amcl_pose" topic.                                            #
 #    -> Moves the graphical robot representation to a new pose.                               #
 #---------------------------------------------------------------------------------------------#    
     def PoseCB(self, data):
-        try:
-            self.pose_pos = data.pose.pose.position
-            self.pose_orient = data.pose.pose.orientation                
-            destination = (self.pose_pos.x, self.pose_pos.y)
-            orient = self.pose_orient
-            wx.CallAfter(self.mframe.MoveRobotTo, destination, orient, True)
-            
-        except wx.PyDeadObjectError:
-            print "EXIT"       
+        self.pose_pos = data.pose.pose.position
+        self.pose_orient = data.pose.pose.orientation                
+        self.dispatch.Post('pose', ((self.pose_pos.x, self.pose_pos.y), self.pose_orient))
+        
+    def OnPose(self, pose):
+        destination, orient = pose
+        self.mframe.MoveRobotTo(destination, orient, True)
 
 #---------------------------------------------------------------------------------------------#    
 #    Callback function for the "move_base/result" topic.                                      #
@@ -120,106 +151,148 @@ class ROSNode():
     def StatusCB(self, data):
         status = int(data.status.status)
         if status == 3:
-            wx.CallAfter(self.mframe.OnReachDestination)
+            self.dispatch.Post('status', status)
+            
+    def OnStatus(self, status):
+        self.mframe.OnReachDestination()
 
 #---------------------------------------------------------------------------------------------#    
 #    Callback function for the "node_traveller/route" topic.                                  #
 #    -> Draws the route in the map viewer.                                                    #
 #---------------------------------------------------------------------------------------------#
     def RouteCB(self, data):
-        route = data.data
-        wx.CallAfter(self.mframe.DrawRoute, route, False)
+        self.dispatch.Post('route', list(data.data))
+        
+    def OnRoute(self, route):
+        self.mframe.DrawRoute(route, False)
         if route[0] != -1:
             self.parent.mp.ep.btn_rte.Enable(True)
         else:
             self.parent.mp.ep.btn_rte.Enable(False)
-        wx.Yield()
 
 #---------------------------------------------------------------------------------------------#    
 #    Callback functions for the "move_base/local_costmap/*obstacles" topics.                  #
-#    -> Draws the obstacles in the map viewer (currently unused)                              #
+#    -> Draws the obstacles in the map viewer (rate-limited by MapFrame.DrawObstacles)        #
 #---------------------------------------------------------------------------------------------#        
     def ObsCB(self, data):
         self.obstacles_1 = data.cells        
-        
-        if self.count % MAX_COUNT == 0:
-#             wx.CallAfter(self.mframe.DrawObstacles, self.obstacles_2, 'inf')
-            wx.CallAfter(self.mframe.DrawObstacles, self.obstacles_1, 'obs')
-        self.count = self.count+1
+        self.dispatch.Post('obstacles', self.obstacles_1)
         
     def ObsCB2(self, data):
         self.obstacles_2 = data.cells
+        self.dispatch.Post('inflated', self.obstacles_2)
+        
+    def OnObstacles(self, cells):
+        self.mframe.DrawObstacles(cells, 'obs')
+        
+    def OnInflatedObstacles(self, cells):
+        self.mframe.DrawObstacles(cells, 'inf')
             
 #---------------------------------------------------------------------------------------------#
 #    Callback function for the "/map" topic.                                                  #
-#    Turns the OccupancyGrid map data into an image.                                          #
+#    Turns the OccupancyGrid map data into an image. The conversion runs as a job on the      #
+#    map viewer's worker queue; a newer map cancels a conversion that hasn't finished yet.    #
 #---------------------------------------------------------------------------------------------#   
     def MapCB(self, data):
-        wx.Yield()       
+        self.dispatch.Post('map', data)
+        
+    def OnMap(self, data):
         self.parent.mp.btn_rf.Enable(False)
-        self.parent.mp.btn_rf.SetLabel("Updating Map...")  
-               
-        array_length = len(data.data)
-        self.image_width = int(np.sqrt(array_length))
-        self.resolution = self.Truncate(data.info.resolution, 5)
-        self.origin_pos = data.info.origin.position
-        self.origin_orient = data.info.origin.orientation        
-        
-        color_data = self.TranslateToRGB(data.data)    
-        img=Image.new('RGB', (self.image_width,self.image_width))
-        img.putdata(color_data)  
-        # Rotate and flip image (otherwise it won't match the real map)
-        img = img.rotate(180)
-        img_mirror = ImageOps.mirror(img)
-        
-        if not self.refresh:
-            try:
-                os.remove(self.filename)
-            except OSError:
-                pass        
-            img_mirror.save(self.filename)
-            if self.mframe.modes['verbose']:         
-                print "Map file created. (%s)" % self.filename
-            self.refresh = True
+        self.parent.mp.btn_rf.SetLabel("Updating Map...")
+        job = QueueThread.Job(self.ProcessMap, (data,), kind='map', coalesce=True,
+                              on_done=self.OnMapProcessed, on_error=self.OnMapError)
+        if not self.mframe.jobs.Submit(job):
+            self.OnMapError("the job queue is busy")
+        
+    def OnMapError(self, e):
+        print "Could not convert the map: %s" % e
+        self.parent.mp.btn_rf.SetLabel("View Live Map")       
+        self.parent.mp.btn_rf.Enable(True)
+        
+#---------------------------------------------------------------------------------------------#
+#    Runs on the worker thread. Nothing is stored on self here: a newer map may be processed  #
+#    before OnMapProcessed() runs, so the image, cells and metadata are returned together.    #
+#---------------------------------------------------------------------------------------------#
+    def ProcessMap(self, data):
+        width = int(data.info.width)
+        height = int(data.info.height)
+        resolution = self.Truncate(data.info.resolution, 5)
+        
+        # The cells are converted to an int8 array once; it is kept as the map data
+        cells = np.asarray(data.data, dtype=np.int8)
+        if cells.size != width*height:
+            raise ValueError("OccupancyGrid has %i cells, expected %ix%i" % 
+                             (cells.size, width, height))
+        
+        # Flip vertically (otherwise it won't match the real map)
+        rgb = self.TranslateToRGB(cells).reshape(height, width, 3)[::-1]
         
         # Creates the wx.Image to be passed to the ZoomPanel
-        self.image = self.PilImageToWxImage(img_mirror)
-        self.image_data = data.data
-        wx.CallAfter(self.mframe.SetMapMetadata, self.image_width,
-                     self.resolution,self.origin_pos)
-        if self.mframe.current_map == self.GetDefaultFilename():
-            print "set image"
-            wx.CallAfter(self.mframe.SetImage, self.image)  
+        image = MapIO.ArrayToWxImage(rgb)
+        return (image, cells, rgb, width, height, resolution, 
+                data.info.origin.position, data.info.origin.orientation)
+        
+    # Called on the GUI thread once ProcessMap() is done, with its result
+    def OnMapProcessed(self, result):
+        (self.image, self.image_data, self.rgb, self.image_width, self.image_height,
+         self.resolution, self.origin_pos, self.origin_orient) = result
+        image, cells = result[:2]
+        self.mframe.SetMapMetadata(self.image_width, self.resolution, self.origin_pos, 
+                                   self.image_height)
+        self.QueueSnapshot()
+        if self.map_requests:
+            requests, self.map_requests = self.map_requests, []
+            for callback in requests:
+                callback(image, cells)
+        elif self.mframe.current_map == self.GetDefaultFilename():
+            self.mframe.SetImage(image, cells)  
             
         self.parent.mp.btn_rf.SetLabel("View Live Map")       
         self.parent.mp.btn_rf.Enable(True)
+        
+#---------------------------------------------------------------------------------------------#    
+#    Calls callback(image, image_data) on the GUI thread with the live map: right away if a   #
+#    map has already been received, otherwise as soon as the next one has been processed.    #
+#---------------------------------------------------------------------------------------------#
+    def RequestMap(self, callback):
+        if self.image is not None:
+            self.QueueSnapshot()
+            callback(self.image, self.image_data)
+        else:
+            self.map_requests.append(callback)
+            
+    # Writes the map file once after every refresh, on the worker queue
+    def QueueSnapshot(self):
+        if self.refresh or not WRITE_SNAPSHOT:
+            return
+        job = QueueThread.Job(self.SaveSnapshot, (self.filename, self.rgb), 
+                              kind='snapshot', coalesce=True)
+        if self.mframe.jobs.Submit(job):
+            self.refresh = True
 
 #---------------------------------------------------------------------------------------------#    
-#    Creates a wx.Image object from the data in a PIL Image                                   #
+#    Writes the live map to a PNG file. The file is written under a temporary name and then   #
+#    renamed, so a reader never sees a partly written map.                                    #
 #---------------------------------------------------------------------------------------------#
-    def PilImageToWxImage(self, pil_img):
-        wx_img = wx.EmptyImage( self.image_width, self.image_width )
-        wx_img.SetData( pil_img.convert( 'RGB' ).tostring() )
-        return wx_img        
-    
+    def SaveSnapshot(self, filename, rgb=None):
+        if rgb is None:
+            rgb = self.rgb
+        h, w = rgb.shape[:2]
+        img = Image.fromstring('RGB', (w, h), np.ascontiguousarray(rgb).tostring())
+        tmp_filename = filename + ".tmp"
+        img.save(tmp_filename, 'PNG')
+        os.rename(tmp_filename, filename)
+        if self.mframe.modes['verbose']:         
+            print "Map file created. (%s)" % filename
+
 #---------------------------------------------------------------------------------------------#    
-#    Translates an OccupancyGrid into pixel colors for the map                                #
+#    Translates an OccupancyGrid into pixel colors for the map (one RGB row per cell)         #
 #    To work correctly, dark grey RGB should be >50 and light grey RGB should be >150         #
 #---------------------------------------------------------------------------------------------#
     def TranslateToRGB(self, input_array): 
-        output_array=[]
-        
-        for element in input_array:            
-            if element==-1:
-                output_array.append((100,100,92)) #unknown (dark grey)
-            elif element==0:
-                output_array.append((230,230,230)) #known (light grey)
-            elif element<=100:
-                output_array.append((0,0,0))   #blocked (black)
-            else:
-                pass #unexpected value
-                    
-        return output_array
+        # Cell values are int8; viewed as uint8, -1 becomes 255
+        cells = np.asarray(input_array, dtype=np.int8).view(np.uint8)
+        return MAP_COLORS[cells]
     
     def Truncate(self, f, n):
         return ('%.*f' % (n + 1, f))[:-1]  
@@ -231,6 +304,7 @@ class ROSNode():
         return self.filename    
     def SetAttributes(self):        
         self.mframe = self.parent.mp.mframe 
+        self.StartDispatch()
     
     
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+'''
+Shortest paths over the graph (MapFrame.nodelist / MapFrame.edgelist).
+
+The planner keeps an adjacency list built once per graph. ShortestPath() runs A* with a
+binary heap, using the straight-line distance as the heuristic. Distances() runs Dijkstra
+from one node and caches the result, and AllPairs() builds the full distance matrix used
+for tour planning from those cached searches.
+
+Edge weights are Edge.m_length (metres). If any edge or node has no metric data (graphs
+created before the map metadata was known), pixel lengths and coordinates are used
+instead.
+
+@author: jon
+'''
+
+import heapq
+import numpy as np
+
+INF = float('inf')
+
+class RoutePlanner(object):
+
+    def __init__(self, nodelist, edgelist):
+        self.num_nodes = len(nodelist)
+        self.metric = (all(edge.m_length is not None for edge in edgelist) and
+                       all(node.m_coords is not None for node in nodelist))
+        if self.metric:
+            self.coords = [tuple(node.m_coords) for node in nodelist]
+        else:
+            self.coords = [tuple(node.coords) for node in nodelist]
+
+        # adj[node] is a list of (neighbor, weight)
+        self.adj = [[] for node in nodelist]
+        for edge in edgelist:
+            a = int(edge.node1)
+            b = int(edge.node2)
+            weight = edge.m_length if self.metric else edge.length
+            self.adj[a].append((b, weight))
+            self.adj[b].append((a, weight))
+
+        self.trees = {}         # source -> (distances, predecessors)
+        self.all_pairs = None
+
+    def Heuristic(self, a, b):
+        (x1, y1), (x2, y2) = self.coords[a], self.coords[b]
+        return ((x2-x1)**2 + (y2-y1)**2) ** 0.5
+
+#---------------------------------------------------------------------------------------------#
+#    A* search. Returns (route, cost) where route is the list of node ids from start to goal, #
+#    or (None, inf) if the goal can't be reached.                                             #
+#---------------------------------------------------------------------------------------------#
+    def ShortestPath(self, start, goal):
+        if start in self.trees:
+            return self.PathFromTree(start, goal)
+
+        dist = {start: 0.0}
+        pred = {start: None}
+        heap = [(self.Heuristic(start, goal), 0.0, start)]
+        closed = set()
+
+        while heap:
+            f, g, v = heapq.heappop(heap)
+            if v == goal:
+                return self.Unwind(pred, goal), g
+            if v in closed:
+                continue
+            closed.add(v)
+            for w, weight in self.adj[v]:
+                ng = g + weight
+                if ng < dist.get(w, INF):
+                    dist[w] = ng
+                    pred[w] = v
+                    heapq.heappush(heap, (ng + self.Heuristic(w, goal), ng, w))
+        return None, INF
+
+#---------------------------------------------------------------------------------------------#
+#    Dijkstra from 'source' to every node. Returns (distances, predecessors) as lists and     #
+#    caches them.                                                                             #
+#---------------------------------------------------------------------------------------------#
+    def Distances(self, source):
+        try:
+            return self.trees[source]
+        except KeyError:
+            pass
+
+        dist = [INF]*self.num_nodes
+        pred = [None]*self.num_nodes
+        dist[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            d, v = heapq.heappop(heap)
+            if d > dist[v]:
+                continue
+            for w, weight in self.adj[v]:
+                nd = d + weight
+                if nd < dist[w]:
+                    dist[w] = nd
+                    pred[w] = v
+                    heapq.heappush(heap, (nd, w))
+
+        self.trees[source] = (dist, pred)
+        return dist, pred
+
+    def PathFromTree(self, source, target):
+        dist, pred = self.Distances(source)
+        if dist[target] == INF:
+            return None, INF
+        return self.Unwind(pred, target), dist[target]
+
+    def Unwind(self, pred, target):
+        route = [target]
+        while pred[route[-1]] is not None:
+            route.append(pred[route[-1]])
+        route.reverse()
+        return route
+
+#---------------------------------------------------------------------------------------------#
+#    Returns the NxN matrix of shortest path lengths (inf where there is no path). The        #
+#    matrix and the search trees behind it are cached, so routes between any two nodes can   #
+#    be recovered afterwards with PathFromTree() at no extra cost.                            #
+#---------------------------------------------------------------------------------------------#
+    def AllPairs(self):
+        if self.all_pairs is None:
+            matrix = np.empty((self.num_nodes, self.num_nodes))
+            for source in range(self.num_nodes):
+                matrix[source] = self.Distances(source)[0]
+            self.all_pairs = matrix
+        return self.all_pairs
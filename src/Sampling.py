@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+'''
+Sampling strategies used by MapFrame.GenerateGraph() to place PRM nodes.
+
+Every sampler takes the occupancy grid returned by MapFrame.GetOccupancyGrid() (a 2D
+array indexed as grid[y, x], see FREE/UNKNOWN/OCCUPIED below), the map limits returned
+by FindImageLimit() and a seed. Sample(count) returns two integer arrays (x, y) of
+candidate pixel coordinates. Candidates are generated in vectorized batches; the
+obstacle-biased samplers may return fewer than 'count' candidates.
+
+Samplers with the same seed and the same map always return the same candidates.
+
+@author: jon
+'''
+
+import numpy as np
+
+# Canonical cell values of the occupancy grid
+FREE        = 0
+UNKNOWN     = -1
+OCCUPIED    = 100
+
+SOBOL_BITS  = 30
+
+#---------------------------------------------------------------------------------------------#
+#    Base class. 'bounds' is (bottom, top, left, right) as returned by FindImageLimit().      #
+#    Subclasses define Sample(count), see above.                                              #
+#---------------------------------------------------------------------------------------------#
+class Sampler(object):
+    def __init__(self, grid, bounds, seed=None, **kwargs):
+        self.grid = grid
+        self.bounds = bounds[:4]
+        self.rs = np.random.RandomState(seed)
+        self.drawn = 0              # Number of candidates produced so far
+
+    # Maps unit-square coordinates to pixel coordinates inside the bounds
+    def _Scale(self, u, v):
+        b, t, l, r = self.bounds
+        x = (l + (r-l)*u).astype(np.int64)
+        y = (b + (t-b)*v).astype(np.int64)
+        return x, y
+
+    def _Clip(self, x, y):
+        h, w = self.grid.shape
+        return np.clip(x, 0, w-1), np.clip(y, 0, h-1)
+
+#---------------------------------------------------------------------------------------------#
+#    Uniform random sampling inside the map limits (the original GenerateGraph behaviour)     #
+#---------------------------------------------------------------------------------------------#
+class UniformSampler(Sampler):
+    def Sample(self, count):
+        self.drawn += count
+        return self._Scale(self.rs.random_sample(count), self.rs.random_sample(count))
+
+#---------------------------------------------------------------------------------------------#
+#    Halton sequence in bases 2 and 3. The seed selects a random (Cranley-Patterson) shift,   #
+#    which keeps the low discrepancy of the sequence.                                         #
+#---------------------------------------------------------------------------------------------#
+class HaltonSampler(Sampler):
+    def __init__(self, grid, bounds, seed=None, **kwargs):
+        Sampler.__init__(self, grid, bounds, seed)
+        self.index = 1
+        self.shift = self.rs.random_sample(2)
+
+    def Sample(self, count):
+        idx = np.arange(self.index, self.index+count, dtype=np.int64)
+        self.index += count
+        self.drawn += count
+        u = (RadicalInverse(idx, 2) + self.shift[0]) % 1.0
+        v = (RadicalInverse(idx, 3) + self.shift[1]) % 1.0
+        return self._Scale(u, v)
+
+def RadicalInverse(indices, base):
+    result = np.zeros(len(indices))
+    i = indices.copy()
+    f = 1.0/base
+    while np.any(i > 0):
+        result += f * (i % base)
+        i //= base
+        f /= base
+    return result
+
+#---------------------------------------------------------------------------------------------#
+#    2D Sobol sequence (dimension 1 is van der Corput, dimension 2 uses the primitive         #
+#    polynomial x+1). The seed selects a random digital shift.                                #
+#---------------------------------------------------------------------------------------------#
+class SobolSampler(Sampler):
+    def __init__(self, grid, bounds, seed=None, **kwargs):
+        Sampler.__init__(self, grid, bounds, seed)
+        self.index = 1
+        self.v1 = [1 << (SOBOL_BITS-1-j) for j in range(SOBOL_BITS)]
+        self.v2 = [1 << (SOBOL_BITS-1)]
+        for j in range(1, SOBOL_BITS):
+            self.v2.append(self.v2[-1] ^ (self.v2[-1] >> 1))
+        self.shift = self.rs.randint(0, 1 << SOBOL_BITS, size=2)
+
+    def Sample(self, count):
+        idx = np.arange(self.index, self.index+count, dtype=np.int64)
+        self.index += count
+        self.drawn += count
+        a = np.zeros(count, dtype=np.int64) ^ self.shift[0]
+        b = np.zeros(count, dtype=np.int64) ^ self.shift[1]
+        for j in range(SOBOL_BITS):
+            bit = (idx >> j) & 1
+            if not bit.any():
+                break
+            a ^= bit * self.v1[j]
+            b ^= bit * self.v2[j]
+        scale = float(1 << SOBOL_BITS)
+        return self._Scale(a/scale, b/scale)
+
+#---------------------------------------------------------------------------------------------#
+#    Uniform sampling over the free cells only. 'free_cells' is a flat array of indices into  #
+#    the grid (see MapFrame.GetFreeCells); if it isn't given, all free cells inside the       #
+#    bounds are used. Every candidate is a free cell, so none are rejected against obstacles. #
+#---------------------------------------------------------------------------------------------#
+class FreeCellSampler(Sampler):
+    def __init__(self, grid, bounds, seed=None, free_cells=None, **kwargs):
+        Sampler.__init__(self, grid, bounds, seed)
+        if free_cells is None:
+            free_cells = FreeCells(grid == FREE, self.bounds)
+        self.free_cells = free_cells
+
+    def Sample(self, count):
+        self.drawn += count
+        if len(self.free_cells) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        idx = self.free_cells[self.rs.randint(0, len(self.free_cells), size=count)]
+        w = self.grid.shape[1]
+        return idx % w, idx // w
+
+#---------------------------------------------------------------------------------------------#
+#    Returns the flat indices of the cells of the boolean 'free' mask that lie inside the     #
+#    bounds and pass the obstacle test of MapFrame.CheckNodeLocation() with w = clearance.    #
+#---------------------------------------------------------------------------------------------#
+def FreeCells(free, bounds=None, clearance=0):
+    free = ClearBorder(free, clearance)
+    if bounds is not None:
+        b, t, l, r = bounds[:4]
+        mask = np.zeros(free.shape, dtype=bool)
+        mask[b:t, l:r] = free[b:t, l:r]
+        free = mask
+    return np.flatnonzero(free)
+
+#---------------------------------------------------------------------------------------------#
+#    The obstacle test of MapFrame.CheckNodeLocation() for every cell at once: a cell (x, y)  #
+#    is kept if the square [x-r, x+r] x [y-r, y+r] is inside the mask and the cells of its    #
+#    border tested there are set, i.e. rows y-r and y+r and columns x-r and x+r, each from    #
+#    -r to r-1. Run sums come from cumulative sums, so the cost does not depend on r.         #
+#---------------------------------------------------------------------------------------------#
+def ClearBorder(mask, r):
+    if r <= 0:
+        return mask.copy()
+    h, w = mask.shape
+    k = 2*r + 1
+    out = np.zeros(mask.shape, dtype=bool)
+    if h < k or w < k:
+        return out
+    blocked = (~mask).astype(np.int32)
+    rows = np.zeros((h, w+1), dtype=np.int32)
+    rows[:, 1:] = blocked.cumsum(1)
+    cols = np.zeros((h+1, w), dtype=np.int32)
+    cols[1:, :] = blocked.cumsum(0)
+    # runs[y, x]: blocked cells in row y from x to x+2r-1 (and likewise in column x)
+    row_runs = rows[:, 2*r:w] - rows[:, :w-2*r]
+    col_runs = cols[2*r:h, :] - cols[:h-2*r, :]
+    # For the cells (y, x) with r <= y < h-r and r <= x < w-r
+    top = row_runs[:h-2*r, :w-2*r]
+    bottom = row_runs[2*r:, :w-2*r]
+    left = col_runs[:h-2*r, :w-2*r]
+    right = col_runs[:h-2*r, 2*r:]
+    out[r:h-r, r:w-r] = (top == 0) & (bottom == 0) & (left == 0) & (right == 0)
+    return out
+
+#---------------------------------------------------------------------------------------------#
+#    Gaussian sampling: pairs of points a normally distributed distance apart. A pair is      #
+#    kept (as its free point) only if the other point is an obstacle, which concentrates      #
+#    the samples along obstacle boundaries.                                                   #
+#---------------------------------------------------------------------------------------------#
+class GaussianSampler(Sampler):
+    def __init__(self, grid, bounds, seed=None, sigma=10.0, **kwargs):
+        Sampler.__init__(self, grid, bounds, seed)
+        self.sigma = sigma
+
+    def Sample(self, count):
+        self.drawn += count
+        x1, y1 = self._Scale(self.rs.random_sample(count), self.rs.random_sample(count))
+        x2, y2 = self._Clip(x1 + np.round(self.rs.normal(0, self.sigma, count)).astype(np.int64),
+                            y1 + np.round(self.rs.normal(0, self.sigma, count)).astype(np.int64))
+        c1 = self.grid[y1, x1]
+        c2 = self.grid[y2, x2]
+        keep1 = (c1 == FREE) & (c2 == OCCUPIED)
+        keep2 = (c2 == FREE) & (c1 == OCCUPIED)
+        return (np.concatenate((x1[keep1], x2[keep2])),
+                np.concatenate((y1[keep1], y2[keep2])))
+
+#---------------------------------------------------------------------------------------------#
+#    Bridge sampling: the midpoint of two obstacle points a short distance apart is kept if   #
+#    it is free. This favours narrow passages such as doorways and corridors.                 #
+#---------------------------------------------------------------------------------------------#
+class BridgeSampler(Sampler):
+    def __init__(self, grid, bounds, seed=None, sigma=10.0, **kwargs):
+        Sampler.__init__(self, grid, bounds, seed)
+        self.sigma = sigma
+
+    def Sample(self, count):
+        self.drawn += count
+        x1, y1 = self._Scale(self.rs.random_sample(count), self.rs.random_sample(count))
+        x2, y2 = self._Clip(x1 + np.round(self.rs.normal(0, self.sigma, count)).astype(np.int64),
+                            y1 + np.round(self.rs.normal(0, self.sigma, count)).astype(np.int64))
+        xm = (x1 + x2) // 2
+        ym = (y1 + y2) // 2
+        keep = ((self.grid[y1, x1] == OCCUPIED) & (self.grid[y2, x2] == OCCUPIED) &
+                (self.grid[ym, xm] == FREE))
+        return xm[keep], ym[keep]
+
+SAMPLERS = {
+    'uniform':  UniformSampler,
+    'halton':   HaltonSampler,
+    'sobol':    SobolSampler,
+    'free':     FreeCellSampler,
+    'gaussian': GaussianSampler,
+    'bridge':   BridgeSampler,
+}
+
+SAMPLER_NAMES = ['uniform', 'halton', 'sobol', 'free', 'gaussian', 'bridge']
+
+def CreateSampler(name, grid, bounds, seed=None, **kwargs):
+    try:
+        klass = SAMPLERS[name]
+    except KeyError:
+        raise ValueError("Unknown sampler '%s' (expected one of %s)" %
+                         (name, ", ".join(SAMPLER_NAMES)))
+    return klass(grid, bounds, seed, **kwargs)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+'''
+Selection of nodes or edges, by id.
+
+A Selection is an array with one entry per id: 0 if the id is not selected, otherwise the
+rank of the id in the order of selection (1 for the first one selected). Testing an id is
+an array lookup, and a box, a lasso or a condition on the graph selects its ids with a few
+numpy operations, however many there are. The order is kept for the commands that depend
+on it: CreateEdges() connects the nodes in the order they were clicked.
+
+Add(), Remove() and Clear() return the ids whose state has changed, so that the caller can
+recolor only those, in one pass:
+
+    changed = self.sel_nodes.Add(np.flatnonzero(mask))
+    self.PaintNodes(changed)
+
+@author: jon
+'''
+
+import numpy as np
+
+class Selection(object):
+    def __init__(self):
+        self.rank = np.zeros(0, dtype=np.int64)
+        self.count = 0
+        self.next_rank = 1
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, ID):
+        return 0 <= ID < len(self.rank) and self.rank[ID] > 0
+
+    def __iter__(self):
+        return iter(self.Ids().tolist())
+
+    def __getitem__(self, i):
+        return int(self.Ids()[i])
+
+    # The selected ids, in the order they were selected
+    def Ids(self):
+        ids = np.flatnonzero(self.rank)
+        return ids[np.argsort(self.rank[ids], kind='mergesort')]
+
+    # The selection as a boolean array of 'size' entries
+    def Mask(self, size):
+        mask = np.zeros(size, dtype=bool)
+        n = min(size, len(self.rank))
+        mask[:n] = self.rank[:n] > 0
+        return mask
+
+    def Grow(self, size):
+        if size > len(self.rank):
+            self.rank = np.concatenate((self.rank, np.zeros(size-len(self.rank), dtype=np.int64)))
+
+#---------------------------------------------------------------------------------------------#
+#    Selects ids, in the order given (ids selected twice keep their first rank). Returns the  #
+#    ids that were not already selected.                                                      #
+#---------------------------------------------------------------------------------------------#
+    def Add(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if len(ids) == 0:
+            return ids
+        self.Grow(ids.max()+1)
+        first = np.sort(np.unique(ids, return_index=True)[1])
+        ids = ids[first]
+        new = ids[self.rank[ids] == 0]
+        self.rank[new] = self.next_rank + np.arange(len(new))
+        self.next_rank += len(new)
+        self.count += len(new)
+        return new
+
+    # Deselects ids. Returns the ids that were selected.
+    def Remove(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        ids = np.unique(ids[ids < len(self.rank)])
+        old = ids[self.rank[ids] > 0]
+        self.rank[old] = 0
+        self.count -= len(old)
+        return old
+
+    # Deselects everything. Returns the ids that were selected.
+    def Clear(self):
+        old = np.flatnonzero(self.rank)
+        self.rank[:] = 0
+        self.count = 0
+        self.next_rank = 1
+        return old
+
+    # Follows a renumbering: 'keep' has one entry per old id, True for the ids that remain
+    def Compact(self, keep):
+        keep = np.asarray(keep, dtype=bool)
+        self.Grow(len(keep))
+        self.rank = self.rank[:len(keep)][keep]
+        self.count = int(np.count_nonzero(self.rank))
+
+#---------------------------------------------------------------------------------------------#
+#    Returns a boolean array, True for the points (n, 2) inside the polygon (a list of        #
+#    vertices), by the even-odd rule. The polygon is closed automatically.                    #
+#---------------------------------------------------------------------------------------------#
+def PointsInPolygon(points, polygon):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    polygon = np.asarray(polygon, dtype=float).reshape(-1, 2)
+    x = points[:, 0]
+    y = points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    if len(polygon) < 3:
+        return inside
+    for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        if y1 == y2:
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        xc = x1 + (y - y1)*(x2 - x1)/(y2 - y1)
+        inside ^= crosses & (x < xc)
+    return inside
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+'''
+Tour planning: an order in which to visit every node of the graph, starting from a given
+node, that keeps the total travelled distance short.
+
+Distances between nodes are shortest path lengths (RoutePlanner.AllPairs()), so the tour
+works on any connected graph, not only on complete ones. The tour is built with the
+nearest-neighbour heuristic and then improved with 2-opt and Or-opt moves until no move
+helps or the time budget runs out. Each local search step evaluates all candidate
+positions for a move at once with numpy.
+
+The tour is open: it starts at the start node and ends wherever is cheapest. Nodes that
+can't be reached from the start node are left out and reported.
+
+@author: jon
+'''
+
+import time
+import numpy as np
+
+TIME_BUDGET = 2.0       # seconds
+MAX_SEGMENT = 3         # longest segment moved by Or-opt
+EPS         = 1e-9
+
+#---------------------------------------------------------------------------------------------#
+#    Plans a tour from 'start' with a RoutePlanner. Returns a dict with the nodes in visiting #
+#    order ('visits'), the full node-by-node route to drive ('route'), its length ('cost'),   #
+#    the length of the initial nearest-neighbour tour ('initial_cost'), the nodes that could  #
+#    not be reached ('unreachable') and the time taken. Improvement stops early if the        #
+#    cancellation token (see QueueThread.CancelToken) is cancelled.                           #
+#---------------------------------------------------------------------------------------------#
+def PlanTour(planner, start, time_budget=TIME_BUDGET, token=None):
+    st = time.time()
+    deadline = st + time_budget
+    dist = planner.AllPairs()
+
+    reachable = np.flatnonzero(np.isfinite(dist[start]))
+    nodes = np.concatenate(([start], reachable[reachable != start]))
+    D = dist[np.ix_(nodes, nodes)]
+
+    order = NearestNeighbourTour(D, 0)
+    initial_cost = TourLength(order, D)
+    cost = initial_cost
+    while time.time() < deadline:
+        if token is not None and token.cancelled:
+            break
+        order = TwoOpt(order, D, deadline)
+        order = OrOpt(order, D, deadline)
+        new_cost = TourLength(order, D)
+        if new_cost > cost - EPS:
+            break
+        cost = new_cost
+    cost = TourLength(order, D)
+
+    visits = [int(n) for n in nodes[order]]
+    route = [visits[0]]
+    for a, b in zip(visits[:-1], visits[1:]):
+        route.extend(planner.PathFromTree(a, b)[0][1:])
+
+    return {
+        'visits': visits,
+        'route': route,
+        'cost': cost,
+        'initial_cost': initial_cost,
+        'unreachable': sorted(set(range(planner.num_nodes)) - set(visits)),
+        'time': time.time() - st,
+    }
+
+def TourLength(order, D):
+    t = np.asarray(order)
+    return float(D[t[:-1], t[1:]].sum())
+
+#---------------------------------------------------------------------------------------------#
+#    Nearest-neighbour construction over the distance matrix D, starting at index 'start'.   #
+#---------------------------------------------------------------------------------------------#
+def NearestNeighbourTour(D, start):
+    m = len(D)
+    visited = np.zeros(m, dtype=bool)
+    visited[start] = True
+    order = [start]
+    for i in range(m-1):
+        row = np.where(visited, np.inf, D[order[-1]])
+        nxt = int(row.argmin())
+        visited[nxt] = True
+        order.append(nxt)
+    return order
+
+#---------------------------------------------------------------------------------------------#
+#    2-opt: reverses the segment order[i..j] whenever that shortens the tour. For each i the  #
+#    gain of every j is computed at once and the best one is applied. The first node stays   #
+#    in place; the last one may change since the tour is open.                                #
+#---------------------------------------------------------------------------------------------#
+def TwoOpt(order, D, deadline):
+    t = np.array(order)
+    m = len(t)
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for i in range(1, m-1):
+            a, b = t[i-1], t[i]
+            c = t[i+1:]                 # candidate segment ends, j = i+1 .. m-1
+            d = t[i+2:]                 # the nodes after them (none for j = m-1)
+            delta = D[a, c] - D[a, b]
+            delta[:-1] += D[b, d] - D[c[:-1], d]
+            j = int(delta.argmin())
+            if delta[j] < -EPS:
+                j += i+1
+                t[i:j+1] = t[i:j+1][::-1].copy()
+                improved = True
+    return list(t)
+
+#---------------------------------------------------------------------------------------------#
+#    Or-opt: moves a segment of 1 to MAX_SEGMENT consecutive nodes (possibly reversed) to     #
+#    the best other place in the tour, when that shortens it.                                 #
+#---------------------------------------------------------------------------------------------#
+def OrOpt(order, D, deadline, max_segment=MAX_SEGMENT):
+    t = np.array(order)
+    m = len(t)
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for length in range(1, max_segment+1):
+            i = 1
+            while i+length <= m and time.time() < deadline:
+                seg = t[i:i+length]
+                p = t[i-1]
+                if i+length < m:
+                    n = t[i+length]
+                    removed = D[p, seg[0]] + D[seg[-1], n] - D[p, n]
+                else:
+                    removed = D[p, seg[0]]
+
+                rest = np.concatenate((t[:i], t[i+length:]))
+                best = None
+                for first, last, reverse in ((seg[0], seg[-1], False), (seg[-1], seg[0], True)):
+                    # added[k]: cost of inserting the segment after rest[k]
+                    added = np.empty(len(rest))
+                    added[:-1] = D[rest[:-1], first] + D[last, rest[1:]] - D[rest[:-1], rest[1:]]
+                    added[-1] = D[rest[-1], first]
+                    k = int(added.argmin())
+                    if best is None or added[k] < best[0]:
+                        best = (added[k], k, reverse)
+                    if length == 1:
+                        break
+
+                added, k, reverse = best
+                if added - removed < -EPS:
+                    if reverse:
+                        seg = seg[::-1]
+                    t = np.concatenate((rest[:k+1], seg, rest[k+1:]))
+                    improved = True
+                i += 1
+    return list(t)
+
+def Summary(tour):
+    lines = ["Tour of %i nodes (%i steps): %.2f (nearest neighbour: %.2f), planned in %.3fs" %
+             (len(tour['visits']), len(tour['route'])-1, tour['cost'], tour['initial_cost'],
+              tour['time'])]
+    if tour['unreachable']:
+        lines.append("%i node(s) can't be reached from the start: %s" %
+                     (len(tour['unreachable']), ", ".join(str(n) for n in tour['unreachable'])))
+    return "\n".join(lines)
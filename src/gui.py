@@ -10,11 +10,13 @@ import math
 import ROSNode
 import Resources
 import subprocess
-from datetime import datetime
+import Instrument
+import Sampling
+import MapIO
 from MapFrame import MapFrame
 
 APP_SIZE        = (240,425)
-APP_SIZE_EXP    = (240,652)
+APP_SIZE_EXP    = (240,690)
 BUTTON_COLOR    = (119,41,83)
 BUTTON_SIZE     = (180,30)
 BUTTON_SIZE_SM  = (85,30)
@@ -132,7 +134,7 @@ class MainPanel(wx.Panel):
         self.buttons = []
         self.btn_disabled = []
         self.contents = []        
-        self.gg_const = {'n':100, 'k':5, 'd':20, 'w':8, 'e':80}
+        self.gg_const = {'n':100, 'k':5, 'd':20, 'w':8, 'e':80, 'sampler':'uniform', 'seed':None}
         
         # Set parent frame value
         self.pf = parent 
@@ -289,8 +291,9 @@ class MainPanel(wx.Panel):
             self.mframe.file_menu.Enable(key, boolean)
                 
 #---------------------------------------------------------------------------------------------#    
-#    Starts a listener process which listens on the "/map" topic. Once the listener has       #
-#    exported the map file, it is passed to ZoomPanel, which sets the image in the viewer     #
+#    Shows the live map from the "/map" topic. The map comes straight from the listener's     #
+#    memory: if no map has been received yet, OnLiveMap() is called when the first one has    #
+#    been processed instead of polling for it.                                                #
 #---------------------------------------------------------------------------------------------#                
     def OnRefreshMap(self, event):
         self.ros.refresh = False
@@ -327,22 +330,16 @@ class MainPanel(wx.Panel):
         if self.verbose:
             print "Retrieving data from /map topic..."  
                 
-        try:
-            map_file = self.ros.GetDefaultFilename()
-            self.mframe.SetTitle("Map Viewer    |    %s" % map_file)
-            
-            # Update some statuses
-            self.EnableButtons(self.btn_disabled, True)
-            self.SetSaveStatus(False)     
-            
-            while self.ros.image is None:
-                time.sleep(0.5)          
-            self.mframe.SetImage(self.ros.image)
-            
-        except IndexError:
-            # Image not found
-            pass        
+        map_file = self.ros.GetDefaultFilename()
+        self.mframe.SetTitle("Map Viewer    |    %s" % map_file)
+        
+        # Update some statuses
+        self.EnableButtons(self.btn_disabled, True)
+        self.SetSaveStatus(False)     
+        self.ros.RequestMap(self.OnLiveMap)
         
+    def OnLiveMap(self, image, image_data):
+        self.mframe.SetImage(image, image_data)
         self.mframe.Show()   
         self.mframe.KillBusyDialog()
         wx.EndBusyCursor()
@@ -350,7 +347,8 @@ class MainPanel(wx.Panel):
         self.Layout()             
 
 #---------------------------------------------------------------------------------------------#    
-#    Shows a file dialog allowing the user to select a map file (.png format)                 #
+#    Shows a file dialog allowing the user to select a map file (.png, or map_server .yaml or #
+#    .pgm format)                                                                             #
 #---------------------------------------------------------------------------------------------#    
     def OnOpen(self, event): 
           
@@ -373,7 +371,9 @@ class MainPanel(wx.Panel):
             ok = False
             while not ok:
                 # Open a file dialog for the user to select a file            
-                filters = 'Image files (*.png)|*.png'
+                filters = ('Map files (*.png;*.yaml;*.pgm)|*.png;*.yaml;*.pgm|'
+                           'Image files (*.png)|*.png|'
+                           'map_server maps (*.yaml;*.pgm)|*.yaml;*.pgm')
                 dlg = wx.FileDialog(self, message="Open Map File", defaultDir=os.getcwd(), 
                                     defaultFile="", wildcard=filters, style=wx.FD_OPEN)
                 
@@ -390,7 +390,7 @@ class MainPanel(wx.Panel):
                         dlg.Destroy()
                         continue
                     
-                    st = datetime.now()
+                    span = Instrument.Span('OpenMap')
                     msg = "Loading map..."
                     self.mframe.SetBusyDialog(msg)
                     wx.BeginBusyCursor()
@@ -406,10 +406,7 @@ class MainPanel(wx.Panel):
                     # Import the node data. For this to work, the node file must have the same
                     # name as the map file, but with the extension ".graph"
                     try:
-                        graph_filename = "%sgraph" % filename.rstrip("png")
-                        graph_file = open(graph_filename, "r")
-                        self.mframe.ImportGraph(graph_file)
-                        graph_file.close()
+                        self.mframe.OpenGraph(MapIO.GraphFilename(filename))
                     except IOError:
                         self.mframe.ClearGraph()
                         self.mframe.ImportGraph(None)
@@ -420,11 +417,11 @@ class MainPanel(wx.Panel):
                     self.EnableButtons(self.btn_disabled, True)              
                     self.SetSaveStatus(True)
                     
-                    et = datetime.now()
+                    span.Stop()
                     self.mframe.Show()
     #                 self.mframe.NavCanvas.Show()
     #                 if self.verbose:
-                    print "Loaded map %s. Time taken: %s" % (filename, (et-st))
+                    print "Loaded map %s. Time taken: %.3fs" % (filename, span.elapsed)
                 
                 ok = True             
                 dlg.Destroy()
@@ -434,7 +431,7 @@ class MainPanel(wx.Panel):
 #    Saves the current map, overwriting the old version.                                      #
 #---------------------------------------------------------------------------------------------#   
     def OnSave(self, event):   
-        st = datetime.now() 
+        span = Instrument.Span('SaveMap')
         current_map = self.mframe.current_map 
         if current_map is [] or os.path.basename(current_map)==self.ros.GetDefaultFilename():
             self.OnSaveAs(event)  
@@ -442,39 +439,40 @@ class MainPanel(wx.Panel):
             shutil.move(current_map,current_map)
             
             # The graph filename must be the same as the map filename (except the extension)
-            graph_filename = "%sgraph" % current_map.rstrip("png")
-            graph_file = open(graph_filename, "w")
-            self.mframe.ExportGraph(graph_file)
-            graph_file.close()
+            # Only the changes since the last save are written
+            graph_filename = MapIO.GraphFilename(current_map)
+            self.mframe.SaveGraph(graph_filename)
             
 #             if self.verbose:
-            et = datetime.now()
-            print "Saved map %s. Time taken: %s" % (current_map, (et-st))
+            span.Stop()
+            print "Saved map %s. Time taken: %.3fs" % (current_map, span.elapsed)
             self.SetSaveStatus(True) 
     
     
 #---------------------------------------------------------------------------------------------#    
 #    Opens a file dialog and lets the user save a map. The map file is stored as a *.png      #
-#    image, and the graph data is stored as a *.graph file with the same name as the map.     #
+#    image or as a map_server *.yaml/*.pgm pair, and the graph data is stored as a *.graph    #
+#    file with the same name as the map.                                                      #
 #---------------------------------------------------------------------------------------------# 
     def OnSaveAs(self, event):
         ok = False
         while not ok:
-            filters = 'Map files (*.png)|*.png'
+            filters = 'Map files (*.png)|*.png|map_server maps (*.yaml)|*.yaml'
             dlg = wx.FileDialog(self, message="Save Map File", defaultDir=os.getcwd(), 
                                 defaultFile="", wildcard=filters, style=wx.FD_SAVE|
                                 wx.FD_OVERWRITE_PROMPT)
             
             if dlg.ShowModal() == wx.ID_OK:   
-                st = datetime.now()   
+                span = Instrument.Span('SaveMapAs')
                 # Save the file to the path given by the user         
                 current_map = self.mframe.current_map
                 filename = dlg.GetPath()
                 basename = os.path.basename(filename)
                 
-                if basename[-4:] != ".png":
+                if basename[-4:] != ".png" and not MapIO.IsMapServerFile(basename):
                     dlg2 = wx.MessageDialog(self,
-                    "Filename \'%s\' is invalid.\nMust end with \'.png\'" % basename, 
+                    "Filename \'%s\' is invalid.\nMust end with \'.png\' or \'.yaml\'" % 
+                    basename, 
                     "Error", wx.ICON_ERROR|wx.OK)
                     dlg2.ShowModal()
                     dlg2.Destroy()                
@@ -491,21 +489,28 @@ class MainPanel(wx.Panel):
                     dlg.Destroy()
                     continue
                 
-                try:
-                    shutil.copy(current_map,filename)
-                except shutil.Error:
-                    shutil.move(filename, filename)
+                if MapIO.IsMapServerFile(filename):
+                    # map_server format: written from the occupancy values of the map
+                    filename = self.mframe.ExportMap(filename)
+                elif os.path.basename(current_map) == self.ros.GetDefaultFilename():
+                    # Live map: write the image from memory
+                    self.ros.SaveSnapshot(filename)
+                elif MapIO.IsMapServerFile(current_map):
+                    self.ros.SaveSnapshot(filename, self.mframe.GetMapRGB())
+                else:
+                    try:
+                        shutil.copy(current_map,filename)
+                    except shutil.Error:
+                        shutil.move(filename, filename)
                 
                 # The graph filename must be the same as the map filename (except the extension)
-                graph_filename = "%sgraph" % filename.rstrip("png")
-                graph_file = open(graph_filename, "w")
-                self.mframe.ExportGraph(graph_file)
-                graph_file.close()            
+                graph_filename = MapIO.GraphFilename(filename)
+                self.mframe.SaveGraph(graph_filename)
                 self.mframe.current_map = filename
                 
+                span.Stop()
                 if self.mframe.modes['verbose']:  
-                    et = datetime.now()
-                    print "Saved map %s. Time taken: %s" % (filename, (et-st))         
+                    print "Saved map %s. Time taken: %.3fs" % (filename, span.elapsed)
                 self.SetSaveStatus(True) 
                 self.mframe.SetTitle("Map Viewer    |    %s" % dlg.GetFilename())
                 
@@ -542,6 +547,7 @@ class MainPanel(wx.Panel):
             dlg.Destroy()
         
         self.mframe.ClearGraph()      
+        self.mframe.ImportGraph(None)
         self.mframe.Clear()
         self.mframe.Hide()
         self.EnableButtons(self.btn_disabled, False)
@@ -564,6 +570,8 @@ class MainPanel(wx.Panel):
                 return
             dlg.Destroy()   
             
+        self.ros.dispatch.Stop()
+        self.mframe.jobs.Stop()
         self.mframe.Close()
         self.pf.Close()        
                 
@@ -766,6 +774,24 @@ class SettingsPanel(wx.Panel):
         self.chk_co = wx.CheckBox(self, label="Enable console output",
                                   pos=(10,547))
         self.chk_co.SetValue(True)
+        
+        # Sampler Choice and Seed
+        self.lbl_smp = wx.StaticText(self, label="Sampler", size=(55,20), pos=(10,585))
+        self.lbl_text.append(self.lbl_smp)
+        
+        self.cho_smp = wx.Choice(self, choices=Sampling.SAMPLER_NAMES, size=(90,27), pos=(65,580))
+        self.cho_smp.SetStringSelection(self.Parent.mp.gg_const['sampler'])
+        
+        self.lbl_seed = wx.StaticText(self, label="Seed", size=(35,20), pos=(160,585))
+        self.lbl_text.append(self.lbl_seed)
+        
+        self.txt_seed = wx.TextCtrl(self, size=(40,25), pos=(192,581),
+                                    style=wx.NO_BORDER|wx.TE_CENTER)
+        self.txt_seed.SetMaxLength(5)
+        self.txt_seed.SetFont(self.pf.font)
+        self.txt_seed.SetToolTipString("Leave empty for a different graph every time")
+        self.txt_seed.SetForegroundColour(TXT_FG_COLOR)
+        self.txt_seed.SetBackgroundColour(TXT_BG_COLOR)
                 
         # Ok button
         btn_ok = wx.Button(self, label="Accept", size=(95,30), 
@@ -875,6 +901,8 @@ class SettingsPanel(wx.Panel):
             d = int( self.txt_d.GetValue() )
             w = int( self.txt_w.GetValue() )
             e = int( self.txt_e.GetValue() )
+            seed = self.txt_seed.GetValue().strip()
+            seed = int(seed) if seed else None
         except ValueError:
             dlg = wx.MessageDialog(self,
                 "Invalid value", "Error", wx.ICON_ERROR)
@@ -882,7 +910,7 @@ class SettingsPanel(wx.Panel):
             dlg.Destroy()
             return
             
-        if n<0 or k<0 or d<0 or w<0 or e<0:
+        if n<0 or k<0 or d<0 or w<0 or e<0 or (seed is not None and seed<0):
             dlg = wx.MessageDialog(self,
             "Positive integers only", "Error", wx.ICON_ERROR)
             dlg.ShowModal() 
@@ -891,8 +919,10 @@ class SettingsPanel(wx.Panel):
         
         wx.CallAfter(self.pf.mp.mframe.ShowObstacles, self.chk_obs.GetValue() )
          
-        self.pf.mp.gg_const = {'n':n, 'k':k, 'd':d, 'w':w, 'e':e}
-        self.pf.mp.mframe.gg_const = {'n':n, 'k':k, 'd':d, 'w':w, 'e':e}      
+        # Update in place so that MapFrame (which shares the dict) sees the new values
+        self.pf.mp.gg_const.update({'n':n, 'k':k, 'd':d, 'w':w, 'e':e, 'seed':seed,
+                                    'sampler':self.cho_smp.GetStringSelection()})
+        self.pf.mp.mframe.gg_const = self.pf.mp.gg_const
         self.Hide()
         self.pf.SetMinSize(APP_SIZE)
         self.pf.SetSize(APP_SIZE)   
@@ -905,6 +935,9 @@ class SettingsPanel(wx.Panel):
         self.Hide()
         for key,txt in self.txtbxs.iteritems():
             txt.SetValue(self.GetDefaultValue(txt))               
+        self.cho_smp.SetStringSelection(self.pf.mp.gg_const['sampler'])
+        seed = self.pf.mp.gg_const['seed']
+        self.txt_seed.SetValue("" if seed is None else str(seed))
         self.pf.SetMinSize(APP_SIZE)
         self.pf.SetSize(APP_SIZE)
         self.pf.mp.Show()        
@@ -1172,7 +1205,8 @@ class ExplorePanel(wx.Panel):
             dlg.Destroy()   
         
         map_file = self.mframe.current_map 
-        graph_file = "%sgraph" % map_file.rstrip("png")        
+        graph_file = MapIO.GraphFilename(map_file)        
+        self.mframe.CompactGraph()
         term = """gnome-terminal -e 'bash -c \
         "rosrun node_traveller travel.py _graph:=%s; exec bash\"'"""
         self.proc = subprocess.Popen(term % graph_file, shell=True)
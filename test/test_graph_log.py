@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+'''
+Tests for GraphLog: the snapshot/log protocol (torn records, interrupted compactions) and
+Replay(), which has to leave a graph in the same state as MapFrame.ApplyEdit().
+
+The ApplyEdit() comparison needs wxPython and a display (run under xvfb-run on a headless
+machine); it is skipped if wx cannot be imported.
+
+@author: jon
+'''
+
+import os
+import sys
+import shutil
+import pickle
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import GraphLog
+import GraphStructs as gs
+
+try:
+    import wx
+except ImportError:
+    wx = None
+
+RES     = 0.05
+COORDS  = [(10, 10), (60, 10), (60, 60), (10, 60), (110, 35)]
+LINKS   = [(0, 1), (1, 2), (2, 3), (3, 0), (1, 4), (2, 4)]
+
+def Metadata():
+    return [200, RES, gs.Origin((-5.0, -5.0)), 100]
+
+def MakeGraph():
+    metadata = Metadata()
+    nodes = [GraphLog.MakeNode(i, xy, RES, metadata[2]) for i, xy in enumerate(COORDS)]
+    edges = [GraphLog.MakeEdge(j, a, b, nodes, RES) for j, (a, b) in enumerate(LINKS)]
+    return [nodes, edges, metadata]
+
+# Nodes as (id, coords) and edges as (id, node1, node2, length), for comparisons
+def GraphKey(nodes, edges):
+    return ([(node.id, (round(node.coords[0], 6), round(node.coords[1], 6)))
+             for node in nodes],
+            [(edge.id, int(edge.node1), int(edge.node2), round(edge.length, 6))
+             for edge in edges])
+
+# One delta of each kind, as MapFrame.RecordEdit() records them, valid on MakeGraph()
+def Deltas():
+    return [('node', 5, (110, 85)),
+            ('edge', 6, 4, 5),
+            ('move', [2, 5], (5, -3)),
+            ('delete', [(1, (60, 10))], [(0, 0, 1), (1, 1, 2), (4, 1, 4)]),
+            ('delete', [], [(0, 1, 2)])]
+
+def ReplayedGraph(deltas):
+    graph = MakeGraph()
+    GraphLog.Replay(graph, [('edit', delta, False) for delta in deltas])
+    return graph
+
+class GraphLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'map.graph')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def Open(self):
+        graph, log = GraphLog.Open(self.filename)
+        return GraphKey(graph[0], graph[1]), log
+
+    # Creates the graph file and saves each delta, one Flush() per delta
+    def Save(self, deltas):
+        graph = MakeGraph()
+        log = GraphLog.Create(self.filename, graph)
+        for delta in deltas:
+            log.Add(delta, False)
+            log.Flush(graph[2])
+        return log
+
+#---------------------------------------------------------------------------------------------#
+#    Replay() of every delta kind, and of its undo                                            #
+#---------------------------------------------------------------------------------------------#
+    def test_replay_deltas(self):
+        graph = ReplayedGraph(Deltas())
+        nodes, edges = GraphKey(graph[0], graph[1])
+        self.assertEqual([ID for ID, xy in nodes], range(5))
+        self.assertEqual(nodes[1], (1, (65, 57)))       # node 2, moved and renumbered
+        self.assertEqual(nodes[4], (4, (115, 82)))      # node 5, appended and moved
+        self.assertEqual([e[:3] for e in edges], [(0, 2, 0), (1, 1, 3), (2, 3, 4)])
+
+    def test_undo_restores_graph(self):
+        deltas = Deltas()
+        for i in range(len(deltas)):
+            graph = ReplayedGraph(deltas[:i+1])
+            GraphLog.Replay(graph, [('edit', deltas[i], True)])
+            expected = ReplayedGraph(deltas[:i])
+            self.assertEqual(GraphKey(graph[0], graph[1]),
+                             GraphKey(expected[0], expected[1]), deltas[i][0])
+
+    def test_meta_record(self):
+        metadata = Metadata()
+        metadata[1] = 0.1
+        graph = MakeGraph()
+        GraphLog.Replay(graph, [('meta', metadata), ('edit', ('node', 5, (20, 30)), False)])
+        self.assertEqual(graph[2][1], 0.1)
+        self.assertAlmostEqual(graph[0][5].m_coords[0], -3.0)
+        self.assertAlmostEqual(graph[0][5].m_coords[1], -2.0)
+
+#---------------------------------------------------------------------------------------------#
+#    Open() after Create() and Flush()                                                        #
+#---------------------------------------------------------------------------------------------#
+    def test_open_replays_log(self):
+        self.Save(Deltas())
+        expected = ReplayedGraph(Deltas())
+        key, log = self.Open()
+        self.assertEqual(key, GraphKey(expected[0], expected[1]))
+        self.assertEqual(log.count, len(Deltas()))
+
+    def test_create_removes_old_log(self):
+        self.Save(Deltas())
+        GraphLog.Create(self.filename, MakeGraph())
+        self.assertFalse(os.path.exists(GraphLog.LogFilename(self.filename)))
+        graph = MakeGraph()
+        self.assertEqual(self.Open()[0], GraphKey(graph[0], graph[1]))
+
+    def test_log_of_other_snapshot_is_ignored(self):
+        self.Save(Deltas())
+        log_data = open(GraphLog.LogFilename(self.filename), 'rb').read()
+        graph = MakeGraph()
+        graph[0].pop()
+        GraphLog.Create(self.filename, graph)
+        GraphLog.WriteFile(GraphLog.LogFilename(self.filename), log_data)
+        self.assertEqual(self.Open()[0], GraphKey(graph[0], graph[1]))
+
+#---------------------------------------------------------------------------------------------#
+#    A record torn by a crash is dropped with everything after it, and overwritten by the     #
+#    next save                                                                                #
+#---------------------------------------------------------------------------------------------#
+    def test_torn_tail_record(self):
+        deltas = Deltas()
+        self.Save(deltas)
+        log_filename = GraphLog.LogFilename(self.filename)
+        data = open(log_filename, 'rb').read()
+        GraphLog.WriteFile(log_filename, data[:-3])
+
+        records, end = GraphLog.ReadLog(log_filename)
+        self.assertEqual(len(records), len(deltas))      # 'snapshot' and all but the last
+        self.assertEqual(end, len(data) - len(GraphLog.Frame(('edit', deltas[-1], False))))
+        expected = ReplayedGraph(deltas[:-1])
+        key, log = self.Open()
+        self.assertEqual(key, GraphKey(expected[0], expected[1]))
+
+        # The next save replaces the torn record
+        log.Add(deltas[-1], False)
+        log.Flush(Metadata())
+        expected = ReplayedGraph(deltas)
+        self.assertEqual(self.Open()[0], GraphKey(expected[0], expected[1]))
+
+    def test_corrupted_record(self):
+        deltas = Deltas()
+        log = self.Save(deltas)
+        log_filename = GraphLog.LogFilename(self.filename)
+        data = open(log_filename, 'rb').read()
+        pos = len(GraphLog.Frame(('snapshot', log.crc)))
+        pos += len(GraphLog.Frame(('edit', deltas[0], False))) + GraphLog.FRAME.size + 1
+        data = data[:pos] + chr(ord(data[pos]) ^ 0xff) + data[pos+1:]
+        GraphLog.WriteFile(log_filename, data)
+
+        expected = ReplayedGraph(deltas[:1])
+        self.assertEqual(self.Open()[0], GraphKey(expected[0], expected[1]))
+
+#---------------------------------------------------------------------------------------------#
+#    Compaction, complete and interrupted at each step (see EditLog.Compact())                #
+#---------------------------------------------------------------------------------------------#
+    def test_compact(self):
+        deltas = Deltas()
+        log = self.Save(deltas[:3])
+        self.assertEqual(log.Compact(), 3)
+        self.assertEqual(log.count, 0)
+        log.Add(deltas[3], False)
+        log.Add(deltas[4], False)
+        log.Flush(Metadata())
+
+        expected = ReplayedGraph(deltas)
+        key, log = self.Open()
+        self.assertEqual(key, GraphKey(expected[0], expected[1]))
+        self.assertEqual(log.count, 2)
+
+    # Writes the files as a compaction of the first 'count' deltas leaves them after the
+    # given step, then saves the remaining deltas as if they were made meanwhile
+    def Interrupt(self, step, count):
+        deltas = Deltas()
+        self.Save(deltas)
+        log_filename = GraphLog.LogFilename(self.filename)
+        compacted = ReplayedGraph(deltas[:count])
+        data = pickle.dumps(compacted, GraphLog.PICKLE_PROTOCOL)
+        if step >= 2:
+            f = open(log_filename, 'ab')
+            f.write(GraphLog.Frame(('compacted', GraphLog.Checksum(data), count)))
+            f.close()
+        if step >= 3:
+            GraphLog.WriteFile(self.filename, data)
+
+    def test_interrupted_before_marker(self):
+        self.Interrupt(1, 3)
+        expected = ReplayedGraph(Deltas())
+        self.assertEqual(self.Open()[0], GraphKey(expected[0], expected[1]))
+
+    def test_interrupted_after_marker(self):
+        self.Interrupt(2, 3)
+        expected = ReplayedGraph(Deltas())
+        self.assertEqual(self.Open()[0], GraphKey(expected[0], expected[1]))
+
+    def test_interrupted_after_snapshot(self):
+        self.Interrupt(3, 3)
+        expected = ReplayedGraph(Deltas())
+        key, log = self.Open()
+        self.assertEqual(key, GraphKey(expected[0], expected[1]))
+
+        # Open() finished the compaction: the log now starts from the new snapshot
+        records, end = GraphLog.ReadLog(GraphLog.LogFilename(self.filename))
+        self.assertEqual(records[0], ('snapshot', log.crc))
+        self.assertEqual(len(records), 1 + len(Deltas()) - 3)
+        log.Add(('node', 5, (30, 30)), False)
+        log.Flush(Metadata())
+        expected = ReplayedGraph(Deltas() + [('node', 5, (30, 30))])
+        self.assertEqual(self.Open()[0], GraphKey(expected[0], expected[1]))
+
+#---------------------------------------------------------------------------------------------#
+#    Replay() against MapFrame.ApplyEdit(), on a MapFrame hosted as in Benchmark.py           #
+#---------------------------------------------------------------------------------------------#
+@unittest.skipIf(wx is None, "needs wxPython")
+class ApplyEditTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        import Benchmark
+        cls.app, cls.frame, cls.mf = Benchmark.CreateHost()
+        cls.mf.SetModes('ApplyEditTest', {'redraw':False})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.frame.Destroy()
+
+    def LoadGraph(self):
+        mf = self.mf
+        mf.ClearGraph()
+        graph = MakeGraph()
+        mf.SetNodeList(graph[0])
+        mf.SetEdgeList(graph[1])
+        mf.SetMapMetadata(*graph[2])
+        mf.SetImage(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps',
+                                 'map2.png'))
+        mf.journal.Clear()
+
+    def test_deltas_match_apply_edit(self):
+        self.LoadGraph()
+        deltas = Deltas()
+        for i, delta in enumerate(deltas):
+            self.mf.ApplyEdit(delta, False)
+            expected = ReplayedGraph(deltas[:i+1])
+            self.assertEqual(GraphKey(self.mf.nodelist, self.mf.edgelist),
+                             GraphKey(expected[0], expected[1]), delta[0])
+
+    def test_undo_matches_apply_edit(self):
+        self.LoadGraph()
+        deltas = Deltas()
+        for delta in deltas:
+            self.mf.ApplyEdit(delta, False)
+        for i in reversed(range(len(deltas))):
+            self.mf.ApplyEdit(deltas[i], True)
+            expected = ReplayedGraph(deltas[:i])
+            self.assertEqual(GraphKey(self.mf.nodelist, self.mf.edgelist),
+                             GraphKey(expected[0], expected[1]), deltas[i][0])
+
+if __name__ == '__main__':
+    unittest.main()
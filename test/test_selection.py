@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+'''
+Tests for Selection: the rank kept for the order of selection, the ids returned by Add(),
+Remove() and Clear() for recoloring, Compact() after the graph is renumbered, and
+PointsInPolygon() for lasso selection.
+
+@author: jon
+'''
+
+import os
+import sys
+import math
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from Selection import Selection, PointsInPolygon
+
+SQUARE  = [(0, 0), (10, 0), (10, 10), (0, 10)]
+NOTCH   = [(0, 0), (10, 0), (10, 10), (5, 5), (0, 10)]      # concave, notch on top
+
+# A five-pointed star drawn in one stroke: its center is covered twice
+def Star(radius=10.0):
+    corners = [(radius*math.cos(math.pi/2 + 2*math.pi*i/5),
+                radius*math.sin(math.pi/2 + 2*math.pi*i/5)) for i in range(5)]
+    return [corners[(2*i) % 5] for i in range(5)]
+
+class SelectionTest(unittest.TestCase):
+    def Selected(self, sel):
+        return list(sel)
+
+#---------------------------------------------------------------------------------------------#
+#    Add(): ids keep the rank of their first selection                                        #
+#---------------------------------------------------------------------------------------------#
+    def test_add_keeps_order(self):
+        sel = Selection()
+        self.assertEqual(sel.Add([5, 2, 7]).tolist(), [5, 2, 7])
+        self.assertEqual(sel.Add([1]).tolist(), [1])
+        self.assertEqual(self.Selected(sel), [5, 2, 7, 1])
+        self.assertEqual(sel[0], 5)
+        self.assertEqual(sel[-1], 1)
+        self.assertEqual(len(sel), 4)
+
+    def test_add_duplicates(self):
+        sel = Selection()
+        self.assertEqual(sel.Add([3, 1, 3, 0, 1]).tolist(), [3, 1, 0])
+        self.assertEqual(sel.Add([0, 4, 3]).tolist(), [4])   # 0 and 3 were selected
+        self.assertEqual(self.Selected(sel), [3, 1, 0, 4])
+        self.assertEqual(len(sel), 4)
+
+    def test_add_nothing(self):
+        sel = Selection()
+        self.assertEqual(sel.Add([]).tolist(), [])
+        self.assertEqual(len(sel), 0)
+        self.assertFalse(0 in sel)
+
+    def test_contains_and_mask(self):
+        sel = Selection()
+        sel.Add([4, 1])
+        self.assertTrue(1 in sel)
+        self.assertFalse(2 in sel)
+        self.assertFalse(10 in sel)
+        self.assertFalse(-1 in sel)
+        self.assertEqual(sel.Mask(6).tolist(), [False, True, False, False, True, False])
+        self.assertEqual(sel.Mask(3).tolist(), [False, True, False])
+
+#---------------------------------------------------------------------------------------------#
+#    Remove() and Clear() return the ids that were selected                                   #
+#---------------------------------------------------------------------------------------------#
+    def test_remove(self):
+        sel = Selection()
+        sel.Add([5, 2, 7, 1])
+        self.assertEqual(sel.Remove([7, 3, 2, 7, 100]).tolist(), [2, 7])
+        self.assertEqual(self.Selected(sel), [5, 1])
+        self.assertEqual(len(sel), 2)
+        self.assertEqual(sel.Remove([7]).tolist(), [])
+
+        # A removed id selected again goes after the others
+        sel.Add([2])
+        self.assertEqual(self.Selected(sel), [5, 1, 2])
+
+    def test_clear(self):
+        sel = Selection()
+        sel.Add([5, 2, 7])
+        self.assertEqual(sel.Clear().tolist(), [2, 5, 7])
+        self.assertEqual(len(sel), 0)
+        self.assertEqual(self.Selected(sel), [])
+        self.assertEqual(sel.Clear().tolist(), [])
+        sel.Add([7, 2])
+        self.assertEqual(self.Selected(sel), [7, 2])
+
+#---------------------------------------------------------------------------------------------#
+#    Compact() after the graph is renumbered                                                  #
+#---------------------------------------------------------------------------------------------#
+    def test_compact_keeps_order(self):
+        sel = Selection()
+        sel.Add([4, 1, 3])
+        sel.Compact([True, True, False, True, True])    # id 2 is deleted
+        self.assertEqual(self.Selected(sel), [3, 1, 2])
+        self.assertEqual(len(sel), 3)
+
+    def test_compact_deleted_selected(self):
+        sel = Selection()
+        sel.Add([4, 1, 3])
+        sel.Compact([True, True, True, False, True])    # id 3 is deleted
+        self.assertEqual(self.Selected(sel), [3, 1])
+        self.assertEqual(len(sel), 2)
+        sel.Add([0])
+        self.assertEqual(self.Selected(sel), [3, 1, 0])
+
+    def test_compact_grows(self):
+        sel = Selection()
+        sel.Add([1])
+        sel.Compact([False, True, True, True])          # more ids than ever selected
+        self.assertEqual(self.Selected(sel), [0])
+        self.assertEqual(sel.Mask(3).tolist(), [True, False, False])
+
+#---------------------------------------------------------------------------------------------#
+#    PointsInPolygon(): even-odd rule, degenerate polygons                                    #
+#---------------------------------------------------------------------------------------------#
+    def test_square(self):
+        points = [(5, 5), (1, 9), (-1, 5), (11, 5), (5, -1), (5, 11)]
+        self.assertEqual(PointsInPolygon(points, SQUARE).tolist(),
+                         [True, True, False, False, False, False])
+
+    def test_concave(self):
+        points = [(5, 2), (5, 8), (1, 8), (9, 8)]
+        self.assertEqual(PointsInPolygon(points, NOTCH).tolist(), [True, False, True, True])
+
+    def test_even_odd(self):
+        points = [(0, 0), (0, 7), (-20, 0)]             # center, a point of the star, outside
+        self.assertEqual(PointsInPolygon(points, Star()).tolist(), [False, True, False])
+
+    def test_closed_polygon(self):
+        # The first vertex repeated at the end changes nothing
+        points = [(5, 5), (11, 5)]
+        self.assertEqual(PointsInPolygon(points, SQUARE + SQUARE[:1]).tolist(),
+                         PointsInPolygon(points, SQUARE).tolist())
+
+    def test_degenerate(self):
+        points = [(0, 0), (5, 0), (5, 5)]
+        self.assertEqual(PointsInPolygon(points, []).tolist(), [False]*3)
+        self.assertEqual(PointsInPolygon(points, [(0, 0)]).tolist(), [False]*3)
+        self.assertEqual(PointsInPolygon(points, [(0, 0), (10, 0)]).tolist(), [False]*3)
+        self.assertEqual(PointsInPolygon(points, [(0, 0), (5, 0), (10, 0)]).tolist(),
+                         [False]*3)
+        self.assertEqual(PointsInPolygon(points, [(0, 0), (5, 5), (10, 10)]).tolist(),
+                         [False]*3)
+
+    def test_no_points(self):
+        self.assertEqual(PointsInPolygon([], SQUARE).tolist(), [])
+
+if __name__ == '__main__':
+    unittest.main()